@@ -0,0 +1,1103 @@
+# app/asgi.py
+"""
+Modo de servicio asíncrono (ASGI) de la API bancaria.
+
+Expone el mismo contrato /auth/* y /bank/* que app.main (payloads, códigos de estado y
+mensajes) sobre Starlette y asyncpg: mientras una petición espera a PostgreSQL, el mismo
+proceso atiende otras. bcrypt corre en el pool de hilos de app.security sin bloquear el
+event loop. Reutiliza las sentencias de app/queries.py, los validadores, el log de
+seguridad y la caché de tokens verificados.
+
+Uso (dependencias en requirements-async.txt; migraciones aplicadas con python -m app.migrations):
+    uvicorn app.asgi:app --host 0.0.0.0 --port 8000 --workers 4
+"""
+import asyncio
+import contextlib
+import functools
+import os
+import re
+import time
+from decimal import Decimal
+
+import asyncpg
+import jwt
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from .bulk import (
+    CsvLineParser, RejectionLog, bulk_summary, deposit_copy_line, evaluate_batch_transfers, parse_jsonl_line
+)
+from .cache import balance_cache, balance_from_row, cached_balance_async, invalidate_balances
+from .custom_logger import log_event, log_stats
+from .hot_accounts import hot_account_stats, schedule_fold
+from .db import (
+    DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD, DB_POOL_TIMEOUT, DB_REPLICA_DSNS, get_replicas, pin_to_primary,
+    replica_stats
+)
+from .idempotency import (
+    IDEMPOTENCY_HEADER, REPLAYED_HEADER, IdempotencyConflict, IdempotencyError, cached, idempotency_stats,
+    record, replay, request_context, schedule_purge
+)
+from .ledger import PaginationError, batch_movements, decode_cursor, page_limit, schedule_partitions, transactions_page
+from .log_archive import LogQueryError, query as query_security_log
+from .metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE, METRICS_ENABLED, observe_component, register_collector,
+    render as render_metrics, request_done, request_finished, request_started, unregister_collector
+)
+from .profiling import (
+    PROFILE_ENABLED, PROFILE_HEADER, PROFILE_ID_HEADER, discard as discard_profile, record_statement,
+    start as start_profile, stop as stop_profile, wants_profile
+)
+from .ratelimit import client_ip, get_rate_limiter, rate_limit_stats
+from .queries import (
+    WITHDRAW_SQL, TRANSFER_SQL, CREDIT_PAYMENT_SQL, PAY_CREDIT_BALANCE_SQL,
+    BATCH_TRANSFER_LOCK_SQL, BATCH_TRANSFER_APPLY_SQL, BULK_DEPOSIT_STAGING_SQL,
+    BULK_DEPOSIT_LOCK_SQL, BULK_DEPOSIT_APPLY_SQL, BULK_DEPOSIT_UNKNOWN_SQL, BALANCE_SQL,
+    DEPOSIT_SQL, TRANSACTIONS_PAGE_SQL, STATEMENT_SQL, STATEMENT_COUNT_SQL, STATEMENT_SLOT_SQL,
+    STATEMENT_JOB_INSERT_SQL, STATEMENT_JOB_SQL, IDEMPOTENCY_LOOKUP_SQL, IDEMPOTENCY_STORE_SQL, LOGIN_SQL
+)
+from .security import (
+    TokenError, verify_token, encode_jwt, resolve_secret_key, hash_password_async, check_password_async,
+    bcrypt_stats, token_cache_stats
+)
+from .statements import (
+    STATEMENT_FETCH_SIZE, StatementEncoder, StatementError, check_size, check_slot, count_params, export_stats,
+    get_job_runner, job_from_row, job_params, job_path, slot_params, statement_dates, statement_filename,
+    statement_params
+)
+from .validators import validar_cedula, validar_celular, validar_username, validar_password
+
+# Pool asyncpg por proceso: las conexiones se comparten entre muchas peticiones concurrentes
+ASYNC_DB_POOL_MIN = int(os.environ.get('ASYNC_DB_POOL_MIN', '2'))
+ASYNC_DB_POOL_MAX = int(os.environ.get('ASYNC_DB_POOL_MAX', '20'))
+BATCH_TRANSFER_MAX_ITEMS = int(os.environ.get('BATCH_TRANSFER_MAX_ITEMS', '10000'))
+
+_PARAM_RE = re.compile(r'%\((\w+)\)s|%s')
+
+@functools.lru_cache(maxsize=None)
+def to_asyncpg(sql):
+    """
+    Convierte placeholders de psycopg2 (%(nombre)s o %s) a los $n de asyncpg.
+    Devuelve (sql, claves): claves son los nombres, o posiciones para %s, en orden de $n.
+    """
+    keys = []
+    positional = 0
+    def replace(match):
+        nonlocal positional
+        key = match.group(1)
+        if key is None:
+            key = positional
+            positional += 1
+        if key not in keys:
+            keys.append(key)
+        return f"${keys.index(key) + 1}"
+    return _PARAM_RE.sub(replace, sql), tuple(keys)
+
+def _args(sql, params):
+    converted, keys = to_asyncpg(sql)
+    return (converted, *[params[key] for key in keys])
+
+async def fetchrow(conn, sql, params=()):
+    return await conn.fetchrow(*_args(sql, params))
+
+async def fetch(conn, sql, params=()):
+    return await conn.fetch(*_args(sql, params))
+
+async def _fetchtuple(conn, sql, params=()):
+    """Fila como tupla, igual que las que devuelve once() al repetir un resultado guardado."""
+    row = await fetchrow(conn, sql, params)
+    return tuple(row) if row is not None else None
+
+# ---------------- Errores y validación ----------------
+
+class HTTPError(Exception):
+    """Equivalente de api.abort: se responde {"message": ...} con el código indicado."""
+
+    def __init__(self, status, message, body=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.body = body
+        self.headers = None
+
+def abort(status, message):
+    raise HTTPError(status, message)
+
+NUMBER, INTEGER, STRING, LIST = 'number', 'integer', 'string', 'array'
+
+def _type_ok(value, kind):
+    if kind == STRING:
+        return isinstance(value, str)
+    if kind == LIST:
+        return isinstance(value, list)
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) if kind == INTEGER else isinstance(value, (int, float))
+
+def _validate(data, model, prefix=''):
+    """Valida el payload como lo hace flask-restx con validate=True; devuelve {campo: error}."""
+    errors = {}
+    for field, (kind, required, *enum) in model.items():
+        if field not in data or data[field] is None:
+            if required:
+                errors[prefix + field] = f"'{field}' is a required property"
+            continue
+        if not _type_ok(data[field], kind):
+            errors[prefix + field] = f"{data[field]!r} is not of type '{kind}'"
+        elif enum and data[field] not in enum[0]:
+            errors[prefix + field] = f"{data[field]!r} is not one of {list(enum[0])}"
+    return errors
+
+async def payload(request, model):
+    try:
+        data = await request.json()
+    except ValueError:
+        raise HTTPError(400, "Failed to decode JSON object")
+    if not isinstance(data, dict):
+        raise HTTPError(400, "Input payload validation failed", {"errors": {"": "Se esperaba un objeto JSON"}, "message": "Input payload validation failed"})
+    errors = _validate(data, model)
+    if model is BATCH_TRANSFER_MODEL and isinstance(data.get('transfers'), list):
+        for index, item in enumerate(data['transfers']):
+            if not isinstance(item, dict):
+                errors[f"transfers.{index}"] = f"{item!r} is not of type 'object'"
+            else:
+                errors.update(_validate(item, TRANSFER_MODEL, f"transfers.{index}."))
+    if errors:
+        raise HTTPError(400, "Input payload validation failed", {"errors": errors, "message": "Input payload validation failed"})
+    return data
+
+LOGIN_MODEL = {'username': (STRING, True), 'password': (STRING, True)}
+REGISTER_MODEL = {
+    'nombres': (STRING, True), 'apellidos': (STRING, True), 'direccion': (STRING, False),
+    'cedula': (STRING, True), 'celular': (STRING, True), 'username': (STRING, True),
+    'password': (STRING, True), 'email': (STRING, True),
+}
+DEPOSIT_MODEL = {'account_number': (INTEGER, True), 'amount': (NUMBER, True)}
+AMOUNT_MODEL = {'amount': (NUMBER, True)}
+TRANSFER_MODEL = {'target_username': (STRING, True), 'amount': (NUMBER, True)}
+BATCH_TRANSFER_MODEL = {'transfers': (LIST, True), 'mode': (STRING, False, ('all_or_nothing', 'best_effort'))}
+STATEMENT_JOB_MODEL = {'from': (STRING, True), 'to': (STRING, False), 'username': (STRING, False)}
+
+# ---------------- Infraestructura de endpoints ----------------
+
+def _ip(request):
+    """IP del cliente; detrás de TRUSTED_PROXY_HOPS proxies, la que registraron en X-Forwarded-For."""
+    return client_ip(request.client.host if request.client else 'N/A', request.headers.get('x-forwarded-for'))
+
+def log(request, level, message, status_code='-', user_id='anonymous'):
+    log_event(level, message, status_code=status_code, user_id=user_id, ip_address=_ip(request))
+
+async def _idempotency_context(request, user, idempotent):
+    fingerprint_args = {'method': request.method, 'path': request.url.path}
+    if idempotent == 'stream':
+        fingerprint_args.update(
+            query=request.url.query.encode(), content_type=request.headers.get('content-type', ''),
+            content_length=int(request.headers.get('content-length') or 0)
+        )
+    else:
+        fingerprint_args['body'] = await request.body()
+    return request_context(user['id'], request.headers.get(IDEMPOTENCY_HEADER), **fingerprint_args)
+
+def endpoint(action=None, roles=None, idempotent=False):
+    """
+    Decora un handler `async def h(request, user) -> (body, status)`; un Response se devuelve tal cual.
+    roles=None: sin autenticación; () cualquier usuario autenticado; ('cajero',) restringe el rol.
+    Con `action` registra inicio, éxito y error como log_endpoint en el modo WSGI.
+    idempotent=True acepta Idempotency-Key (contexto en request.state.idempotency para once());
+    'stream' para cuerpos leídos en streaming, cuya huella no incluye el contenido.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            schedule_partitions()
+            user = None
+            if roles is not None:
+                try:
+                    user = verify_token(request.headers.get("Authorization", ""), request.app.state.secret_key)
+                except TokenError as e:
+                    abort(401, str(e))
+                if roles and user.get('role') not in roles:
+                    abort(403, f"Rol '{user.get('role')}' no autorizado para esta operación. Roles permitidos: {', '.join(roles)}")
+            request.state.user = user
+            user_id = user['id'] if user else 'anonymous'
+            ctx = None
+            if action:
+                log(request, 'INFO', f"Inicio de {action}", '-', user_id)
+            try:
+                try:
+                    if idempotent:
+                        ctx = request.state.idempotency = await _idempotency_context(request, user, idempotent)
+                    result = await handler(request, user)
+                except IdempotencyError as e:
+                    raise HTTPError(e.code, str(e))
+            except HTTPError as e:
+                if action:
+                    log(request, 'ERROR', f"Error en {action}: {e.status}: {e.message}", e.status, user_id)
+                if ctx is not None and ctx.replayed:
+                    e.headers = {REPLAYED_HEADER: 'true'}
+                raise
+            if isinstance(result, Response):
+                body, status = None, result.status_code
+            else:
+                body, status = result
+            if action:
+                log(request, 'INFO', f"Éxito de {action}", status, user_id)
+            headers = {REPLAYED_HEADER: 'true'} if ctx is not None and ctx.replayed else None
+            return result if body is None else JSONResponse(body, status, headers=headers)
+        return wrapper
+    return decorator
+
+def connection(request):
+    """Conexión del pool asyncpg; si no hay una libre en DB_POOL_TIMEOUT segundos se responde 503."""
+    return request.app.state.pool.acquire(timeout=DB_POOL_TIMEOUT)
+
+async def run_read_only(request, work, user_id=None):
+    """
+    Equivale a db.run_read_only(): devuelve `await work(conn)` con una conexión de una réplica
+    al día (retraso y escrituras recientes de `user_id`) o del primario. Si la réplica no entrega
+    la conexión o la pierde durante el bloque, deja de recibir lecturas hasta la próxima medición
+    y `work` se repite en el primario; un statement_timeout no se repite.
+    """
+    replicas = get_replicas()
+    index = replicas.choose(user_id) if replicas is not None else None
+    if index is not None:
+        pool = request.app.state.replica_pools[index]
+        try:
+            conn = await pool.acquire(timeout=DB_POOL_TIMEOUT)
+        except (OSError, asyncpg.PostgresError, asyncio.TimeoutError):
+            replicas.mark_failed(index)
+        else:
+            try:
+                return await work(conn)
+            except asyncpg.QueryCanceledError:
+                raise
+            # Una conexión cerrada por el servidor se separa del pool: asyncpg responde InterfaceError
+            except (OSError, asyncpg.PostgresConnectionError, asyncpg.exceptions.OperatorInterventionError,
+                    asyncpg.InterfaceError):
+                replicas.mark_failed(index)
+            finally:
+                await pool.release(conn)
+    async with connection(request) as conn:
+        return await work(conn)
+
+async def once(request, conn, compute):
+    """
+    Equivale a idempotency.once(): ejecuta `await compute()` y guarda su resultado con la
+    Idempotency-Key de la solicitud en una misma transacción, o devuelve el resultado ya guardado.
+    Sin clave solo ejecuta `compute()`.
+    """
+    ctx = getattr(request.state, 'idempotency', None)
+    if ctx is None:
+        return await compute()
+    schedule_purge()
+    result = cached(ctx)
+    if ctx.replayed:
+        return result
+    while True:
+        row = await fetchrow(conn, IDEMPOTENCY_LOOKUP_SQL, ctx.params())
+        if row is not None:
+            return replay(ctx, tuple(row))
+        try:
+            async with conn.transaction():
+                result = await compute()
+                if await fetchrow(conn, IDEMPOTENCY_STORE_SQL, ctx.params(result)) is None:
+                    # Otra solicitud con la misma clave confirmó primero: se revierte lo hecho
+                    raise IdempotencyConflict()
+        except IdempotencyConflict:
+            # La búsqueda siguiente devuelve su resultado; si esa clave venció o se purgó entre
+            # tanto, la operación se ejecuta de nuevo
+            record('conflicts')
+            continue
+        record('stored')
+        return result
+
+# ---------------- Authentication Endpoints ----------------
+
+@endpoint()
+async def login(request, _):
+    data = await payload(request, LOGIN_MODEL)
+    username = data.get("username")
+    password = data.get("password")
+    try:
+        get_rate_limiter().check('login', ip=_ip(request), username=username)
+    except TooManyRequests as e:
+        log(request, 'WARNING', f"Login limitado para usuario '{username}': {e.description}", 429)
+        raise
+    async def find_user(conn):
+        return await fetchrow(conn, LOGIN_SQL, {'username': username})
+
+    user_data = await run_read_only(request, find_user)
+    if user_data is None and DB_REPLICA_DSNS:
+        # Un cliente recién registrado puede no haber llegado todavía a la réplica
+        async with connection(request) as conn:
+            user_data = await find_user(conn)
+
+    if user_data and await check_password_async(bytes(user_data['password']), password):
+        token = encode_jwt(user_data['id'], user_data['role'], username, request.app.state.secret_key)
+        if not token:
+            log(request, 'ERROR', f"Error generando token para usuario '{username}'", 500, user_data['id'])
+            abort(500, "Error interno generando token de autenticación")
+        log(request, 'INFO', f"Login exitoso para usuario '{username}'", 200, user_data['id'])
+        return {"message": "Login exitoso", "token": token}, 200
+    log(request, 'WARNING', f"Intento de login fallido para usuario '{username}'", 401)
+    abort(401, "Credenciales inválidas.")
+
+@endpoint()
+async def logout(request, _):
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
+        log(request, 'WARNING', "Logout sin header válido", 401)
+        abort(401, "Token de autorización ausente o en formato incorrecto")
+    try:
+        user_id = jwt.decode(auth_header.split(" ")[1], request.app.state.secret_key, algorithms=['HS256']).get('sub', 'unknown')
+    except jwt.ExpiredSignatureError:
+        log(request, 'WARNING', "Logout con token expirado", 401, 'unknown')
+        abort(401, "El token ha expirado.")
+    except jwt.InvalidTokenError:
+        log(request, 'WARNING', "Logout con token inválido", 401, 'unknown')
+        abort(401, "Token inválido.")
+    log(request, 'INFO', "Logout exitoso", 200, user_id)
+    return {"message": "Logout exitoso. Por favor, descarte el token."}, 200
+
+@endpoint()
+async def register(request, _):
+    data = await payload(request, REGISTER_MODEL)
+    try:
+        get_rate_limiter().check('register', ip=_ip(request))
+    except TooManyRequests as e:
+        log(request, 'WARNING', f"Registro limitado: {e.description}", 429)
+        raise
+
+    if not validar_cedula(data['cedula']):
+        log(request, 'WARNING', f"Registro fallido: cédula inválida {data['cedula']}", 400)
+        abort(400, "El número de cédula proporcionado no es válido.")
+    if not validar_celular(data['celular']):
+        log(request, 'WARNING', f"Registro fallido: celular inválido {data['celular']}", 400)
+        abort(400, "El número de celular debe tener 10 dígitos y empezar con 09.")
+    if not validar_username(data['username'], data['nombres'], data['apellidos']):
+        log(request, 'WARNING', f"Registro fallido: username inválido '{data['username']}'", 400)
+        abort(400, "El nombre de usuario es inválido o contiene información personal.")
+    info_personal = {'nombres': data['nombres'], 'apellidos': data['apellidos'], 'cedula': data['cedula']}
+    if not validar_password(data['password'], info_personal):
+        log(request, 'WARNING', f"Registro fallido: contraseña débil para usuario '{data['username']}'", 400)
+        abort(400, "La contraseña no cumple con los requisitos de seguridad.")
+
+    # Desde una réplica: si no vio un registro muy reciente, la restricción única responde igual con 409
+    async def check_duplicates(conn):
+        if await conn.fetchval("SELECT 1 FROM bank.users WHERE username = $1", data['username']):
+            log(request, 'WARNING', f"Registro fallido: username duplicado '{data['username']}'", 409)
+            abort(409, "El nombre de usuario ya está en uso.")
+        if await conn.fetchval("SELECT 1 FROM bank.users WHERE email = $1", data['email']):
+            log(request, 'WARNING', f"Registro fallido: email duplicado '{data['email']}'", 409)
+            abort(409, "El correo electrónico ya está registrado.")
+
+    await run_read_only(request, check_duplicates)
+
+    # El hash se calcula sin retener una conexión del pool
+    password_hash = await hash_password_async(data['password'])
+
+    async with connection(request) as conn:
+        try:
+            async with conn.transaction():
+                user_id = await conn.fetchval(
+                    "INSERT INTO bank.users (username, password, role, full_name, email) VALUES ($1, $2, 'cliente', $3, $4) RETURNING id",
+                    data['username'], password_hash, f"{data['nombres']} {data['apellidos']}", data['email']
+                )
+                await conn.execute(
+                    """INSERT INTO bank.clients (user_id, nombres, apellidos, direccion, cedula, celular, ip_registro)
+                       VALUES ($1, $2, $3, $4, $5, $6, $7)""",
+                    user_id, data['nombres'], data['apellidos'], data.get('direccion'),
+                    data['cedula'], data['celular'], _ip(request)
+                )
+                await conn.execute("INSERT INTO bank.accounts (balance, user_id) VALUES (0, $1)", user_id)
+                await conn.execute("INSERT INTO bank.credit_cards (limit_credit, balance, user_id) VALUES (1000, 0, $1)", user_id)
+        except asyncpg.UniqueViolationError as e:
+            log(request, 'ERROR', f"Error en registro para {data['username']}: {e}", 500)
+            detail = str(e).lower()
+            if 'username' in detail:
+                abort(409, "El nombre de usuario ya está en uso.")
+            elif 'email' in detail:
+                abort(409, "El correo electrónico ya está registrado.")
+            elif 'cedula' in detail:
+                abort(409, "La cédula ya está registrada.")
+            abort(409, "Ya existe un registro con esos datos.")
+        except asyncpg.PostgresError as e:
+            log(request, 'ERROR', f"Error en registro para {data['username']}: {e}", 500)
+            abort(500, "Ocurrió un error interno durante el registro.")
+    # Sus primeras lecturas (saldo) no deben ir a una réplica que aún no tiene la cuenta
+    pin_to_primary(user_id)
+    log(request, 'INFO', f"Nuevo cliente registrado exitosamente: {data['username']}", 201, user_id)
+    return {"message": "Cliente registrado exitosamente."}, 201
+
+# ---------------- Banking Operation Endpoints ----------------
+
+def _amount(data):
+    """Monto del payload como Decimal (asyncpg no adapta float a NUMERIC)."""
+    return Decimal(str(data.get("amount", 0)))
+
+@endpoint("Depósito", roles=('cajero',), idempotent=True)
+async def deposit(request, user):
+    data = await payload(request, DEPOSIT_MODEL)
+    amount = _amount(data)
+    if amount <= 0:
+        log(request, 'WARNING', f"Intento de depósito inválido: amount={data['amount']}", 400, user['id'])
+        abort(400, "El monto debe ser mayor que cero")
+
+    async def apply():
+        row = await fetchrow(conn, DEPOSIT_SQL, {'account_id': data['account_number'], 'amount': amount, 'cajero_id': user['id']})
+        if row is None:
+            # Dentro de la transacción de once(): la clave no queda guardada
+            log(request, 'ERROR', f"Cuenta no encontrada: {data['account_number']}", 404, user['id'])
+            abort(404, "Cuenta no encontrada")
+        return tuple(row)
+
+    async with connection(request) as conn:
+        new_balance, account_user_id = await once(request, conn, apply)
+    invalidate_balances(account_user_id)
+    schedule_fold()
+    return {"message": "Depósito exitoso", "new_balance": float(new_balance)}, 200
+
+@endpoint(roles=())
+async def balance(request, user):
+    async def load():
+        row = await run_read_only(request, lambda conn: fetchrow(conn, BALANCE_SQL, {'user_id': user['id']}), user['id'])
+        return balance_from_row(row)
+    value = await cached_balance_async(user['id'], load)
+    if value is None:
+        log(request, 'ERROR', "Cuenta no encontrada para consulta de saldo", 404, user['id'])
+        abort(404, "Cuenta no encontrada")
+    return dict(value), 200
+
+@endpoint(roles=())
+async def transactions(request, user):
+    try:
+        limit = page_limit(request.query_params.get('limit'))
+        before_created_at, before_id = decode_cursor(request.query_params.get('cursor'))
+    except PaginationError as e:
+        log(request, 'WARNING', f"Paginación inválida en historial: {e}", 400, user['id'])
+        abort(400, str(e))
+    rows = await run_read_only(request, lambda conn: fetch(conn, TRANSACTIONS_PAGE_SQL, {
+        'user_id': user['id'], 'before_created_at': before_created_at, 'before_id': before_id, 'limit': limit
+    }), user['id'])
+    return transactions_page([tuple(row) for row in rows], limit), 200
+
+def _statement_dates(request, user, date_from, date_to):
+    try:
+        return statement_dates(date_from, date_to)
+    except StatementError as e:
+        log(request, 'WARNING', f"Estado de cuenta inválido: {e}", 400, user['id'])
+        abort(400, str(e))
+
+async def _statement_owner(request, user, username):
+    """user_id del estado de cuenta: el del usuario autenticado, u otro cliente si quien pide es cajero."""
+    if not username or username == user['username']:
+        return user['id']
+    if user['role'] != 'cajero':
+        log(request, 'WARNING', f"Estado de cuenta de otro usuario sin rol cajero: {username}", 403, user['id'])
+        abort(403, "Solo un cajero puede exportar el estado de cuenta de otro usuario")
+    async with connection(request) as conn:
+        row = await fetchrow(conn, "SELECT id FROM bank.users WHERE username = %(username)s", {'username': username})
+    if row is None:
+        log(request, 'WARNING', f"Estado de cuenta de usuario inexistente: {username}", 404, user['id'])
+        abort(404, "Usuario no encontrado")
+    return row['id']
+
+def _accepts_gzip(request):
+    """Equivale a request.accept_encodings['gzip'] > 0 de werkzeug."""
+    for item in request.headers.get('accept-encoding', '').split(','):
+        coding, _, params = item.partition(';')
+        if coding.strip().lower() not in ('gzip', '*'):
+            continue
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+class ReleasingStreamingResponse(StreamingResponse):
+    """StreamingResponse que ejecuta `release` al terminar el envío, también si el cliente corta."""
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self._release()
+
+@endpoint("Estado de cuenta", roles=())
+async def statement(request, user):
+    date_from, date_to = _statement_dates(request, user, request.query_params.get('from'), request.query_params.get('to'))
+    owner_id = await _statement_owner(request, user, request.query_params.get('username'))
+    
+    # La conexión queda prestada hasta que termina el envío, no solo durante el handler
+    pool = request.app.state.pool
+    conn = await pool.acquire(timeout=DB_POOL_TIMEOUT)
+    
+    async def close():
+        try:
+            with contextlib.suppress(asyncpg.PostgresError, asyncpg.InterfaceError):
+                await conn.execute("ROLLBACK")
+        finally:
+            await pool.release(conn)
+    
+    try:
+        await conn.execute("BEGIN")
+        check_slot(await fetchrow(conn, STATEMENT_SLOT_SQL, slot_params()))
+        check_size((await fetchrow(conn, STATEMENT_COUNT_SQL, count_params(owner_id, date_from, date_to)))[0])
+    except StatementError as e:
+        await close()
+        log(request, 'WARNING', f"Estado de cuenta demasiado grande para descarga en línea: {e}", 400, user['id'])
+        abort(400, str(e))
+    except BaseException:
+        await close()
+        raise
+    
+    compress = _accepts_gzip(request)
+    encoder = StatementEncoder(compress)
+    
+    async def body():
+        cursor = await conn.cursor(*_args(STATEMENT_SQL, statement_params(owner_id, date_from, date_to)))
+        yield encoder.header()
+        while True:
+            rows = await cursor.fetch(STATEMENT_FETCH_SIZE)
+            if not rows:
+                break
+            chunk = encoder.encode(rows)
+            if chunk:
+                yield chunk
+        yield encoder.finish()
+    
+    async def finished():
+        # Revierte (libera el turno) y devuelve la conexión al terminar o si el cliente corta
+        await close()
+        if encoder.finished:
+            log(request, 'INFO', f"Estado de cuenta enviado: {encoder.rows} movimientos", 200, user['id'])
+        else:
+            log(request, 'WARNING', f"Estado de cuenta interrumpido tras {encoder.rows} movimientos", 200, user['id'])
+    
+    headers = {
+        'Content-Disposition': f'attachment; filename="{statement_filename(date_from, date_to)}"',
+        'Vary': 'Accept-Encoding',
+    }
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+    return ReleasingStreamingResponse(body(), finished, media_type='text/csv', headers=headers)
+
+@endpoint("Exportación de estado de cuenta", roles=(), idempotent=True)
+async def statement_jobs(request, user):
+    data = await payload(request, STATEMENT_JOB_MODEL)
+    date_from, date_to = _statement_dates(request, user, data.get('from'), data.get('to'))
+    owner_id = await _statement_owner(request, user, data.get('username'))
+
+    async def insert():
+        return job_from_row(await _fetchtuple(conn, STATEMENT_JOB_INSERT_SQL, job_params(user['id'], owner_id, date_from, date_to)))
+
+    async with connection(request) as conn:
+        job = await once(request, conn, insert)
+    if request.state.idempotency is None or not request.state.idempotency.replayed:
+        get_job_runner().wake()
+    job["message"] = "Exportación encolada"
+    return job, 202
+
+async def _statement_job(request, user):
+    job_id = request.path_params['job_id']
+    async with connection(request) as conn:
+        row = await fetchrow(conn, STATEMENT_JOB_SQL, {'id': job_id, 'requested_by': user['id']})
+    if row is None:
+        log(request, 'WARNING', f"Trabajo de exportación no encontrado: {job_id}", 404, user['id'])
+        abort(404, "Trabajo de exportación no encontrado")
+    return job_from_row(tuple(row))
+
+@endpoint(roles=())
+async def statement_job(request, user):
+    return await _statement_job(request, user), 200
+
+@endpoint(roles=())
+async def statement_job_download(request, user):
+    job = await _statement_job(request, user)
+    if job['status'] != 'done':
+        abort(409, f"La exportación no está lista (estado: {job['status']})")
+    path = job_path(job['job_id'])
+    if not os.path.exists(path):
+        log(request, 'ERROR', f"Archivo de exportación ausente: {job['job_id']}", 410, user['id'])
+        abort(410, "El archivo de la exportación ya no está disponible")
+    return FileResponse(path, media_type='application/gzip', filename=statement_filename(job['from'], job['to'], compressed=True))
+
+@endpoint("Retiro", roles=(), idempotent=True)
+async def withdraw(request, user):
+    data = await payload(request, AMOUNT_MODEL)
+    amount = _amount(data)
+    if amount <= 0:
+        log(request, 'WARNING', f"Intento de retiro inválido: amount={data['amount']}", 400, user['id'])
+        abort(400, "El monto debe ser mayor que cero")
+    async with connection(request) as conn:
+        current_balance, new_balance = await once(
+            request, conn, lambda: _fetchtuple(conn, WITHDRAW_SQL, {'user_id': user['id'], 'amount': amount})
+        )
+    invalidate_balances(user['id'])
+    if current_balance is None:
+        log(request, 'ERROR', "Cuenta del usuario no encontrada para retiro", 404, user['id'])
+        abort(404, "Cuenta no encontrada")
+    if new_balance is None:
+        log(request, 'WARNING', f"Fondos insuficientes: balance={float(current_balance)}, requested={data['amount']}", 400, user['id'])
+        abort(400, "Fondos insuficientes")
+    return {"message": "Retiro exitoso", "new_balance": float(new_balance)}, 200
+
+@endpoint("Transferencia", roles=(), idempotent=True)
+async def transfer(request, user):
+    data = await payload(request, TRANSFER_MODEL)
+    target_username = data.get("target_username")
+    amount = _amount(data)
+    if not target_username or amount <= 0:
+        log(request, 'WARNING', f"Datos inválidos para transferencia: target={target_username}, amount={data['amount']}", 400, user['id'])
+        abort(400, "Datos inválidos")
+    if target_username == user['username']:
+        log(request, 'WARNING', "Intento de transferencia a la misma cuenta", 400, user['id'])
+        abort(400, "No se puede transferir a la misma cuenta")
+    async with connection(request) as conn:
+        sender_balance, target_user_id, _, new_balance, _ = await once(request, conn, lambda: _fetchtuple(
+            conn, TRANSFER_SQL, {'sender_id': user['id'], 'target_username': target_username, 'amount': amount}
+        ))
+    invalidate_balances(user['id'], target_user_id)
+    schedule_fold()
+    if sender_balance is None:
+        log(request, 'ERROR', "Cuenta del remitente no encontrada", 404, user['id'])
+        abort(404, "Cuenta del remitente no encontrada")
+    if new_balance is None:
+        if sender_balance < amount:
+            log(request, 'WARNING', f"Fondos insuficientes para transferencia: balance={float(sender_balance)}, requested={data['amount']}", 400, user['id'])
+            abort(400, "Fondos insuficientes")
+        if target_user_id is None:
+            log(request, 'ERROR', f"Usuario destino no encontrado: {target_username}", 404, user['id'])
+            abort(404, "Usuario destino no encontrado")
+        log(request, 'ERROR', f"Cuenta destino no encontrada para usuario: {target_username}", 404, user['id'])
+        abort(404, "Cuenta destino no encontrada")
+    return {"message": "Transferencia exitosa", "new_balance": float(new_balance)}, 200
+
+@endpoint("Transferencia por lotes", roles=(), idempotent=True)
+async def batch_transfer(request, user):
+    data = await payload(request, BATCH_TRANSFER_MODEL)
+    items = data.get("transfers") or []
+    mode = data.get("mode") or 'all_or_nothing'
+    if not items:
+        log(request, 'WARNING', "Lote de transferencias vacío", 400, user['id'])
+        abort(400, "El lote no contiene transferencias")
+    if len(items) > BATCH_TRANSFER_MAX_ITEMS:
+        log(request, 'WARNING', f"Lote de transferencias demasiado grande: {len(items)}", 400, user['id'])
+        abort(400, f"El lote admite como máximo {BATCH_TRANSFER_MAX_ITEMS} transferencias")
+
+    usernames = sorted({item['target_username'] for item in items})
+    touched_user_ids = []
+
+    async def apply_batch():
+        async with conn.transaction():
+            targets = {}
+            target_user_ids = {}
+            sender_account_id = sender_balance = None
+            for username, target_user_id, account_id, balance in await fetch(
+                    conn, BATCH_TRANSFER_LOCK_SQL, {'sender_id': user['id'], 'usernames': usernames}):
+                if username is None:
+                    sender_account_id, sender_balance = account_id, balance
+                else:
+                    targets[username] = account_id
+                    target_user_ids[username] = target_user_id
+            if sender_account_id is None:
+                log(request, 'ERROR', "Cuenta del remitente no encontrada", 404, user['id'])
+                abort(404, "Cuenta del remitente no encontrada")
+
+            results, deltas, remaining = evaluate_batch_transfers(items, targets, sender_balance, user['username'])
+            failed = sum(1 for r in results if r["status"] == "rejected")
+            if failed and mode == 'all_or_nothing':
+                for r in results:
+                    if r["status"] == "applied":
+                        r["status"] = "not_applied"
+                log(request, 'WARNING', f"Lote rechazado: {failed} de {len(items)} transferencias inválidas", 400, user['id'])
+                # Devolver el cuerpo desde dentro del bloque revierte la transacción (nada se aplicó)
+                raise HTTPError(400, "Lote rechazado: ninguna transferencia fue aplicada", {
+                    "message": "Lote rechazado: ninguna transferencia fue aplicada",
+                    "mode": mode, "applied": 0, "rejected": failed, "results": results
+                })
+
+            new_balance = sender_balance
+            if deltas:
+                deltas[sender_account_id] -= sender_balance - remaining
+                account_ids = list(deltas)
+                rows = await fetch(conn, BATCH_TRANSFER_APPLY_SQL, {
+                    'account_ids': account_ids,
+                    'deltas': [deltas[account_id] for account_id in account_ids],
+                    **batch_movements(results, targets, target_user_ids, user['id'], sender_account_id)
+                })
+                new_balance = dict((row[0], row[1]) for row in rows)[sender_account_id]
+        touched_user_ids.extend(target_user_ids.values())
+        return {
+            "message": "Lote procesado" if failed else "Lote aplicado exitosamente",
+            "mode": mode,
+            "applied": len(items) - failed,
+            "rejected": failed,
+            "total_amount": float(sender_balance - remaining),
+            "new_balance": float(new_balance),
+            "results": results
+        }
+
+    async with connection(request) as conn:
+        body = await once(request, conn, apply_batch)
+    invalidate_balances(user['id'], *touched_user_ids)
+    return body, 200
+
+async def _request_lines(request):
+    """Líneas del cuerpo a medida que llegan los fragmentos (memoria acotada al fragmento más largo)."""
+    line_no = 0
+    buffer = b''
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            line_no += 1
+            yield line_no, line.decode('utf-8', errors='replace').rstrip('\r')
+    if buffer:
+        yield line_no + 1, buffer.decode('utf-8', errors='replace').rstrip('\r')
+
+@endpoint("Depósito masivo", roles=('cajero',), idempotent='stream')
+async def bulk_deposit(request, user):
+    fmt = (request.query_params.get('format') or '').lower()
+    if not fmt:
+        fmt = 'jsonl' if 'json' in request.headers.get('content-type', '') else 'csv'
+    if fmt not in ('csv', 'jsonl'):
+        log(request, 'WARNING', f"Formato de depósito masivo no soportado: {fmt}", 400, user['id'])
+        abort(400, "Formato no soportado: use csv o jsonl")
+    parse = CsvLineParser(('account_number', 'amount')).parse if fmt == 'csv' else parse_jsonl_line
+    rejections = RejectionLog()
+    received = 0
+
+    async def copy_source():
+        nonlocal received
+        async for line_no, text in _request_lines(request):
+            record = parse(text)
+            if record is False:
+                continue
+            received += 1
+            line = deposit_copy_line(line_no, record, rejections)
+            if line is not None:
+                yield line.encode('utf-8')
+
+    async def apply_deposits():
+        async with conn.transaction():
+            await conn.execute(BULK_DEPOSIT_STAGING_SQL)
+            await conn.copy_to_table('deposit_staging', source=copy_source(), columns=('line_no', 'account_id', 'amount'))
+            await conn.execute(BULK_DEPOSIT_LOCK_SQL)
+            applied = tuple(await fetchrow(conn, BULK_DEPOSIT_APPLY_SQL, {'cajero_id': user['id']}))
+            unknown = [tuple(row) for row in await fetch(conn, BULK_DEPOSIT_UNKNOWN_SQL, {'limit': rejections.limit})]
+        return bulk_summary(received, applied, unknown, rejections)
+
+    # Con Idempotency-Key repetida se devuelve el resumen guardado sin leer el cuerpo
+    async with connection(request) as conn:
+        summary = await once(request, conn, apply_deposits)
+    # Sin la lista de cuentas acreditadas (pueden ser miles) se invalidan todos los saldos
+    invalidate_balances('*')
+    log(request, 'INFO', f"Depósito masivo: {summary['rows_applied']} filas aplicadas, {summary['rows_rejected']} rechazadas", 200, user['id'])
+    summary["message"] = "Depósitos masivos procesados" if summary["rows_rejected"] else "Depósitos masivos aplicados"
+    return summary, 200
+
+@endpoint("Pago a crédito", roles=(), idempotent=True)
+async def credit_payment(request, user):
+    data = await payload(request, AMOUNT_MODEL)
+    amount = _amount(data)
+    if amount <= 0:
+        log(request, 'WARNING', f"Monto inválido para compra a crédito: {data['amount']}", 400, user['id'])
+        abort(400, "El monto debe ser mayor que cero")
+    async with connection(request) as conn:
+        limit_credit, current_debt, new_credit_balance = await once(request, conn, lambda: _fetchtuple(
+            conn, CREDIT_PAYMENT_SQL, {'user_id': user['id'], 'amount': amount}
+        ))
+    invalidate_balances(user['id'])
+    if limit_credit is None:
+        log(request, 'ERROR', "Tarjeta de crédito no encontrada", 404, user['id'])
+        abort(404, "Tarjeta de crédito no encontrada")
+    limit_credit = float(limit_credit)
+    if new_credit_balance is None:
+        available_credit = limit_credit - float(current_debt)
+        log(request, 'WARNING', f"Límite de crédito excedido: available={available_credit}, requested={data['amount']}", 400, user['id'])
+        abort(400, f"Límite de crédito insuficiente. Disponible: {available_credit}")
+    new_credit_balance = float(new_credit_balance)
+    return {
+        "message": "Compra a crédito exitosa",
+        "amount_charged": data['amount'],
+        "credit_card_debt": new_credit_balance,
+        "available_credit": limit_credit - new_credit_balance
+    }, 200
+
+@endpoint("Abono tarjeta", roles=(), idempotent=True)
+async def pay_credit_balance(request, user):
+    data = await payload(request, AMOUNT_MODEL)
+    amount = _amount(data)
+    if amount <= 0:
+        log(request, 'WARNING', f"Monto inválido para abono a tarjeta: {data['amount']}", 400, user['id'])
+        abort(400, "El monto debe ser mayor que cero")
+    async with connection(request) as conn:
+        account_balance, card_id, new_account_balance, new_credit_debt = await once(request, conn, lambda: _fetchtuple(
+            conn, PAY_CREDIT_BALANCE_SQL, {'user_id': user['id'], 'amount': amount}
+        ))
+    invalidate_balances(user['id'])
+    if account_balance is None:
+        log(request, 'ERROR', "Cuenta no encontrada para abono a tarjeta", 404, user['id'])
+        abort(404, "Cuenta no encontrada")
+    if account_balance < amount:
+        log(request, 'WARNING', f"Fondos insuficientes para abono: balance={float(account_balance)}, requested={data['amount']}", 400, user['id'])
+        abort(400, "Fondos insuficientes en la cuenta")
+    if card_id is None:
+        log(request, 'ERROR', "Tarjeta de crédito no encontrada", 404, user['id'])
+        abort(404, "Tarjeta de crédito no encontrada")
+    return {
+        "message": "Pago de deuda de tarjeta exitoso",
+        "account_balance": float(new_account_balance),
+        "credit_card_debt": float(new_credit_debt)
+    }, 200
+
+# ---------------- Operational Endpoints ----------------
+
+@endpoint(roles=('cajero',))
+async def stats(request, _):
+    return worker_stats(request.app), 200
+
+@endpoint(roles=('cajero',))
+async def security_log(request, user):
+    params = request.query_params
+    search = functools.partial(
+        query_security_log, user_id=params.get('user_id'), ip=params.get('ip'), since=params.get('from'),
+        until=params.get('to'), level=params.get('level'), limit=params.get('limit')
+    )
+    try:
+        # Lectura de disco y descompresión fuera del event loop
+        result = await asyncio.get_running_loop().run_in_executor(None, search)
+    except LogQueryError as e:
+        log(request, 'WARNING', f"Consulta de log de seguridad inválida: {e}", 400, user['id'])
+        abort(400, str(e))
+    log(request, 'INFO', f"Consulta de log de seguridad: {dict(params)} -> {len(result['entries'])} entradas", 200, user['id'])
+    return result, 200
+
+def _asyncpg_pool_stats(pool):
+    return {
+        "pid": os.getpid(),
+        "min": pool.get_min_size(),
+        "max": pool.get_max_size(),
+        "size": pool.get_size(),
+        "idle": pool.get_idle_size(),
+    }
+
+def worker_stats(app):
+    replicas = replica_stats()
+    for replica, pool in zip(replicas['replicas'], app.state.replica_pools):
+        replica['pool'] = _asyncpg_pool_stats(pool)
+    return {
+        "db_pool": _asyncpg_pool_stats(app.state.pool),
+        "replicas": replicas,
+        "security_log": log_stats(),
+        "bcrypt": bcrypt_stats(),
+        "token_cache": token_cache_stats(),
+        "balance_cache": balance_cache.stats(),
+        "statement_exports": export_stats(),
+        "idempotency": idempotency_stats(),
+        "rate_limit": rate_limit_stats(),
+        "hot_accounts": hot_account_stats()
+    }
+
+async def metrics(request):
+    """Métricas de todos los workers en formato de texto de Prometheus."""
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+# ---------------- Métricas ----------------
+
+class MetricsMiddleware:
+    """
+    Cuenta y mide cada solicitud como los hooks de métricas de app.main: la duración llega
+    hasta el inicio de la respuesta y el endpoint es la plantilla de la ruta que la atendió.
+    """
+
+    def __init__(self, app, endpoints):
+        self.app = app
+        self.endpoints = endpoints
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        recorded = False
+
+        def record(status):
+            nonlocal recorded
+            recorded = True
+            # El router deja en el scope el handler de la ruta elegida
+            endpoint = self.endpoints.get(scope.get('endpoint'), 'unmatched')
+            request_finished(endpoint, scope['method'], status, time.perf_counter() - started)
+
+        async def send_timed(message):
+            if message['type'] == 'http.response.start' and not recorded:
+                record(message['status'])
+            await send(message)
+
+        request_started()
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            if not recorded:
+                # Excepción no manejada: la respuesta 500 la arma ServerErrorMiddleware
+                record(500)
+            request_done()
+
+class ProfilingMiddleware:
+    """Perfila las solicitudes elegidas por profiling.wants_profile, como los hooks de app.main."""
+
+    def __init__(self, app, endpoints):
+        self.app = app
+        self.endpoints = endpoints
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = Request(scope).headers
+        reason = wants_profile(headers.get(PROFILE_HEADER), headers.get("Authorization"), scope['app'].state.secret_key)
+        if not reason:
+            await self.app(scope, receive, send)
+            return
+        session = start_profile(scope['method'], scope['path'], requested=reason == 'requested')
+
+        async def send_profiled(message):
+            if message['type'] == 'http.response.start':
+                endpoint = self.endpoints.get(scope.get('endpoint'), 'unmatched')
+                profile_id = stop_profile(session, endpoint, message['status'])
+                # Las solicitudes de la muestra al azar no revelan el id a su cliente
+                if session.requested:
+                    message = dict(message, headers=list(message.get('headers', [])) + [
+                        (PROFILE_ID_HEADER.lower().encode(), profile_id.encode())
+                    ])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            discard_profile(session)
+
+def _record_query(query):
+    observe_component('postgres', query.elapsed)
+    record_statement(query.query, query.elapsed)
+
+async def _time_queries(conn):
+    """init del pool asyncpg: cada sentencia suma su duración a las métricas y al perfil de la solicitud."""
+    conn.add_query_logger(_record_query)
+
+# ---------------- Manejadores de error ----------------
+
+def _user_id(request):
+    user = getattr(request.state, 'user', None)
+    return user['id'] if user else 'anonymous'
+
+async def handle_http_error(request, e):
+    log(request, 'WARNING', f"HTTP error: {e.message}", e.status, _user_id(request))
+    return JSONResponse(e.body if e.body is not None else {"message": e.message}, e.status, headers=e.headers)
+
+async def handle_retry_after(request, e):
+    """
+    bcrypt o exportaciones en línea saturados (503) o límite de intentos excedido (429):
+    mismo código y Retry-After que en el modo WSGI.
+    """
+    log(request, 'WARNING', f"HTTP error: {e.description}", e.code, _user_id(request))
+    return JSONResponse({"message": e.description}, e.code, headers={'Retry-After': str(e.retry_after)})
+
+async def handle_pool_timeout(request, e):
+    log(request, 'ERROR', "Pool de conexiones agotado", 503, _user_id(request))
+    return JSONResponse({"message": "Servicio temporalmente saturado. Intente nuevamente."}, 503, headers={'Retry-After': '1'})
+
+async def handle_uncaught_exception(request, e):
+    log(request, 'ERROR', f"Excepción no manejada: {str(e)}", 500, _user_id(request))
+    return JSONResponse({"message": "Error interno del servidor"}, 500)
+
+# ---------------- Application Factory ----------------
+
+def create_app():
+    """Construye la aplicación ASGI; el pool asyncpg se crea al arrancar el event loop de cada worker."""
+    routes = [
+        Route('/auth/login', login, methods=['POST']),
+        Route('/auth/logout', logout, methods=['POST']),
+        Route('/auth/register', register, methods=['POST']),
+        Route('/bank/balance', balance, methods=['GET']),
+        Route('/bank/transactions', transactions, methods=['GET']),
+        Route('/bank/statement', statement, methods=['GET']),
+        Route('/bank/statements/jobs', statement_jobs, methods=['POST']),
+        Route('/bank/statements/jobs/{job_id}', statement_job, methods=['GET']),
+        Route('/bank/statements/jobs/{job_id}/download', statement_job_download, methods=['GET']),
+        Route('/bank/deposit', deposit, methods=['POST']),
+        Route('/bank/deposits/bulk', bulk_deposit, methods=['POST']),
+        Route('/bank/withdraw', withdraw, methods=['POST']),
+        Route('/bank/transfer', transfer, methods=['POST']),
+        Route('/bank/transfers/batch', batch_transfer, methods=['POST']),
+        Route('/bank/credit-payment', credit_payment, methods=['POST']),
+        Route('/bank/pay-credit-balance', pay_credit_balance, methods=['POST']),
+        Route('/ops/stats', stats, methods=['GET']),
+        Route('/ops/security-log', security_log, methods=['GET']),
+    ]
+    if METRICS_ENABLED:
+        routes.append(Route('/metrics', metrics, methods=['GET']))
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        app.state.pool = await asyncpg.create_pool(
+            host=DB_HOST, port=int(DB_PORT), database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
+            min_size=ASYNC_DB_POOL_MIN, max_size=ASYNC_DB_POOL_MAX,
+            init=_time_queries if METRICS_ENABLED or PROFILE_ENABLED else None
+        )
+        # Sin conexiones iniciales: una réplica caída no impide arrancar, solo recibe lecturas al volver
+        app.state.replica_pools = [
+            await asyncpg.create_pool(
+                dsn=dsn, min_size=0, max_size=ASYNC_DB_POOL_MAX,
+                init=_time_queries if METRICS_ENABLED or PROFILE_ENABLED else None
+            )
+            for dsn in DB_REPLICA_DSNS
+        ]
+        get_replicas()
+        log_stats()
+        bcrypt_stats()
+        get_job_runner().wake()
+        collector = functools.partial(worker_stats, app)
+        register_collector(collector)
+        try:
+            yield
+        finally:
+            unregister_collector(collector)
+            for pool in app.state.replica_pools:
+                await pool.close()
+            await app.state.pool.close()
+
+    endpoints = {route.endpoint: route.path for route in routes}
+    middleware = []
+    if METRICS_ENABLED:
+        middleware.append(Middleware(MetricsMiddleware, endpoints=endpoints))
+    if PROFILE_ENABLED:
+        middleware.append(Middleware(ProfilingMiddleware, endpoints=endpoints))
+    app = Starlette(
+        routes=routes,
+        middleware=middleware,
+        lifespan=lifespan,
+        exception_handlers={
+            HTTPError: handle_http_error,
+            ServiceUnavailable: handle_retry_after,
+            TooManyRequests: handle_retry_after,
+            asyncio.TimeoutError: handle_pool_timeout,
+            Exception: handle_uncaught_exception,
+        },
+    )
+    app.state.secret_key = resolve_secret_key()
+    return app
+
+app = create_app()
@@ -0,0 +1,256 @@
+# app/bulk.py
+import codecs
+import csv
+import json
+import os
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+
+from .queries import (
+    BULK_DEPOSIT_STAGING_SQL, BULK_DEPOSIT_COPY_SQL, BULK_DEPOSIT_LOCK_SQL,
+    BULK_DEPOSIT_APPLY_SQL, BULK_DEPOSIT_UNKNOWN_SQL
+)
+
+# Máximo de filas rechazadas que se detallan en la respuesta (el total siempre se informa)
+BULK_REJECTED_SAMPLE = int(os.environ.get('BULK_REJECTED_SAMPLE', '100'))
+
+MAX_ACCOUNT_ID = 2 ** 31 - 1
+
+def evaluate_batch_transfers(items, targets, sender_balance, sender_username):
+    """
+    Evalúa en orden los ítems de un lote de transferencias contra el saldo restante del remitente.
+    `targets` mapea username -> id de cuenta (None si el usuario no tiene cuenta).
+    Devuelve (resultados por ítem, deltas por id de cuenta destino, saldo restante).
+    """
+    results = []
+    deltas = defaultdict(Decimal)
+    remaining = sender_balance
+    for index, item in enumerate(items):
+        target_username = item['target_username']
+        amount = Decimal(str(item['amount']))
+        if amount <= 0:
+            error = "El monto debe ser mayor que cero"
+        elif target_username == sender_username:
+            error = "No se puede transferir a la misma cuenta"
+        elif target_username not in targets:
+            error = "Usuario destino no encontrado"
+        elif targets[target_username] is None:
+            error = "Cuenta destino no encontrada"
+        elif remaining < amount:
+            error = "Fondos insuficientes"
+        else:
+            error = None
+            remaining -= amount
+            deltas[targets[target_username]] += amount
+        result = {"index": index, "target_username": target_username, "amount": float(amount),
+                  "status": "applied" if error is None else "rejected"}
+        if error:
+            result["error"] = error
+        results.append(result)
+    return results, deltas, remaining
+
+class RejectionLog:
+    """Acumula filas rechazadas: cuenta todas pero solo guarda una muestra acotada."""
+
+    def __init__(self, limit=BULK_REJECTED_SAMPLE):
+        self.limit = limit
+        self.count = 0
+        self.sample = []
+
+    def add(self, line_no, reason, **extra):
+        self.count += 1
+        if len(self.sample) < self.limit:
+            self.sample.append(dict({"line": line_no, "reason": reason}, **extra))
+
+    def as_dict(self):
+        return {
+            "rows_rejected": self.count,
+            "rejected": sorted(self.sample, key=lambda r: r["line"])[:self.limit],
+            "rejected_truncated": self.count > len(self.sample)
+        }
+
+class CopyStream:
+    """Objeto tipo archivo para `copy_expert` que produce las líneas bajo demanda (memoria constante)."""
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size) if self._buffer else next(self._lines, '')
+
+def _csv_header(row, fieldnames):
+    """Devuelve las columnas normalizadas si la fila es un encabezado con `fieldnames`, o None."""
+    normalized = [cell.strip().lower() for cell in row]
+    return normalized if set(normalized) == set(fieldnames) else None
+
+def _csv_record(row, header):
+    """Fila CSV -> dict según `header`; None si el número de columnas no coincide. Filas vacías -> False."""
+    if not row or not any(cell.strip() for cell in row):
+        return False
+    if len(row) != len(header):
+        return None
+    return {key: value.strip() for key, value in zip(header, row)}
+
+def iter_csv_records(stream, fieldnames):
+    """
+    Lee un CSV línea a línea desde un stream binario y produce (línea, dict).
+    La primera fila se toma como encabezado si coincide con `fieldnames`; si no, se usan
+    las columnas en ese orden. Filas con un número de columnas distinto producen (línea, None).
+    """
+    # Bytes no UTF-8 se reemplazan para que la fila se rechace sin abortar la carga completa
+    reader = csv.reader(codecs.iterdecode(stream, 'utf-8', errors='replace'))
+    header = list(fieldnames)
+    first = True
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error:
+            yield reader.line_num, None
+            continue
+        record = _csv_record(row, header)
+        if record is False:
+            continue
+        if first:
+            first = False
+            detected = _csv_header(row, fieldnames)
+            if detected:
+                header = detected
+                continue
+        yield reader.line_num, record
+
+class CsvLineParser:
+    """
+    Convierte líneas sueltas de CSV en registros (modo ASGI, donde el cuerpo llega por
+    fragmentos asíncronos). Mismas reglas que iter_csv_records, sin campos multilínea.
+    """
+
+    def __init__(self, fieldnames):
+        self.fieldnames = fieldnames
+        self.header = list(fieldnames)
+        self.first = True
+
+    def parse(self, line):
+        """Devuelve el dict de la línea, None si es inválida o False si debe omitirse."""
+        try:
+            row = next(csv.reader([line]), [])
+        except csv.Error:
+            return None
+        record = _csv_record(row, self.header)
+        if record is False:
+            return False
+        if self.first:
+            self.first = False
+            detected = _csv_header(row, self.fieldnames)
+            if detected:
+                self.header = detected
+                return False
+        return record
+
+def parse_jsonl_line(line):
+    """Convierte una línea de JSON lines en dict; None si es inválida o False si está vacía."""
+    line = line.strip()
+    if not line:
+        return False
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) else None
+
+def iter_jsonl_records(stream):
+    """Lee JSON lines desde un stream binario y produce (línea, dict); líneas inválidas producen (línea, None)."""
+    for line_no, raw in enumerate(stream, start=1):
+        record = parse_jsonl_line(raw)
+        if record is not False:
+            yield line_no, record
+
+def deposit_copy_line(line_no, record, rejections):
+    """Valida un depósito y lo convierte en una línea de COPY; si es inválido lo registra y devuelve None."""
+    if record is None:
+        rejections.add(line_no, "Formato inválido")
+        return None
+    try:
+        account_id = int(str(record.get('account_number')).strip())
+    except (TypeError, ValueError):
+        rejections.add(line_no, "Número de cuenta inválido")
+        return None
+    if not (1 <= account_id <= MAX_ACCOUNT_ID):
+        rejections.add(line_no, "Número de cuenta inválido")
+        return None
+    try:
+        amount = Decimal(str(record.get('amount')).strip())
+    except (InvalidOperation, ValueError):
+        rejections.add(line_no, "Monto inválido")
+        return None
+    if not amount.is_finite():
+        rejections.add(line_no, "Monto inválido")
+        return None
+    if amount <= 0:
+        rejections.add(line_no, "El monto debe ser mayor que cero", account_number=account_id)
+        return None
+    return f"{line_no}\t{account_id}\t{amount}\n"
+
+def _deposit_copy_lines(records, rejections, stats):
+    """Valida cada depósito y lo convierte a una línea de COPY; los inválidos se registran como rechazados."""
+    for line_no, record in records:
+        stats['rows_received'] += 1
+        line = deposit_copy_line(line_no, record, rejections)
+        if line is not None:
+            yield line
+
+def bulk_summary(rows_received, applied, unknown, rejections):
+    """
+    Arma la respuesta de depósitos masivos: `applied` es (cuentas, filas, monto) del UPDATE y
+    `unknown` las filas de BULK_DEPOSIT_UNKNOWN_SQL (línea, cuenta, total de desconocidas).
+    """
+    accounts_credited, rows_applied, total_amount = applied
+    for line_no, account_id, _ in unknown:
+        rejections.add(line_no, "Cuenta no encontrada", account_number=account_id)
+    if unknown:
+        # Las filas que el LIMIT no listó también cuentan como rechazadas
+        rejections.count += unknown[0][2] - len(unknown)
+    summary = {
+        "rows_received": rows_received,
+        "rows_applied": int(rows_applied),
+        "accounts_credited": accounts_credited,
+        "total_amount": float(total_amount)
+    }
+    summary.update(rejections.as_dict())
+    return summary
+
+def apply_bulk_deposits(conn, records, cajero_id):
+    """
+    Carga depósitos (iterable de (línea, dict) con account_number y amount) mediante COPY a una
+    tabla temporal y los aplica con un único UPDATE agregado por cuenta, registrando un
+    movimiento por fila a nombre del cajero `cajero_id`. No hace commit.
+    Devuelve el resumen de filas aplicadas y rechazadas.
+    """
+    rejections = RejectionLog()
+    stats = {'rows_received': 0}
+    cur = conn.cursor()
+    try:
+        cur.execute(BULK_DEPOSIT_STAGING_SQL)
+        cur.copy_expert(BULK_DEPOSIT_COPY_SQL, CopyStream(_deposit_copy_lines(records, rejections, stats)))
+        cur.execute(BULK_DEPOSIT_LOCK_SQL)
+        cur.execute(BULK_DEPOSIT_APPLY_SQL, {'cajero_id': cajero_id})
+        applied = cur.fetchone()
+        cur.execute(BULK_DEPOSIT_UNKNOWN_SQL, {'limit': rejections.limit})
+        unknown = cur.fetchall()
+    finally:
+        cur.close()
+    return bulk_summary(stats['rows_received'], applied, unknown, rejections)
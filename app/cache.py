@@ -0,0 +1,227 @@
+# app/cache.py
+"""
+Caché de lectura de saldos (GET /bank/balance), por user_id.
+
+Cada worker guarda en memoria (LRU con TTL) el saldo de la cuenta y la deuda de la tarjeta
+de los usuarios consultados. Después de confirmar cada operación que mueve dinero, el worker
+que la atendió marca a los usuarios afectados en una tabla compartida por los workers del host
+(BALANCE_STAMP_PATH, mapeada en memoria desde /dev/shm) con el instante de la escritura; una
+entrada cargada antes de la marca de su usuario ya no se sirve, de modo que quien escribe lee
+su propio resultado aunque la lectura la atienda otro worker. Las escrituras hechas en otro
+host o fuera de la API (scripts) se ven a más tardar al vencer BALANCE_CACHE_TTL.
+"""
+import mmap
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from .db import pin_to_primary
+
+BALANCE_CACHE_SIZE = int(os.environ.get('BALANCE_CACHE_SIZE', '10000'))
+# Antigüedad máxima de una entrada: acota la de escrituras de otros hosts
+BALANCE_CACHE_TTL = float(os.environ.get('BALANCE_CACHE_TTL', '2'))
+# Fracción de aciertos que además se leen de la base para medir entradas desactualizadas
+BALANCE_CACHE_VERIFY_RATE = float(os.environ.get('BALANCE_CACHE_VERIFY_RATE', '0.01'))
+# Marcas de escritura compartidas por los workers del host (8 bytes por entrada)
+BALANCE_STAMP_PATH = os.environ.get('BALANCE_STAMP_PATH') or os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'corebank-balance-stamps'
+)
+BALANCE_STAMP_SLOTS = int(os.environ.get('BALANCE_STAMP_SLOTS', '65536'))
+
+_STAMP = struct.Struct('=d')
+
+class WriteStamps:
+    """
+    Instante (time.monotonic, común a los procesos del host) de la última escritura confirmada
+    de los saldos de cada usuario: tabla directa de `slots` entradas en un archivo mapeado en
+    memoria, más una entrada final que vale para todos. Dos usuarios que comparten entrada se
+    invalidan juntos: el error solo cuesta lecturas de más.
+    """
+
+    def __init__(self, path, slots):
+        self.slots = slots
+        size = (slots + 1) * _STAMP.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def _offset(self, user_id):
+        return (self.slots if user_id == '*' else int(user_id) % self.slots) * _STAMP.size
+
+    def stamp(self, user_ids):
+        now = time.monotonic()
+        for user_id in user_ids:
+            offset = self._offset(user_id)
+            if _STAMP.unpack_from(self._map, offset)[0] < now:
+                _STAMP.pack_into(self._map, offset, now)
+
+    def latest(self, user_id):
+        return max(_STAMP.unpack_from(self._map, self._offset(user_id))[0],
+                   _STAMP.unpack_from(self._map, self._offset('*'))[0])
+
+class BalanceCache:
+    """LRU con TTL de saldos por user_id; una entrada vale si se cargó después de la última escritura del usuario."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._stamps = None
+        self._entries = OrderedDict()  # user_id -> (saldos, instante en que empezó su carga)
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'invalidations': 0, 'clears': 0,
+            'discarded_loads': 0, 'verified': 0, 'stale': 0, 'hit_age_total': 0.0, 'hit_age_max': 0.0,
+        }
+
+    @property
+    def stamps(self):
+        # El mapeo se hereda en un fork(): basta abrirlo una vez
+        if self._stamps is None:
+            with self._lock:
+                if self._stamps is None:
+                    self._stamps = WriteStamps(BALANCE_STAMP_PATH, BALANCE_STAMP_SLOTS)
+        return self._stamps
+
+    def get(self, user_id):
+        """Devuelve (saldos, None) en un acierto o (None, instante) para cargar y llamar a put()."""
+        stamps = self.stamps
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                value, loaded_at = entry
+                age = now - loaded_at
+                if stamps.latest(user_id) >= loaded_at:
+                    # Escrito después de cargarla, quizá en otro worker
+                    del self._entries[user_id]
+                    self._stats['invalidations'] += 1
+                elif age < self.ttl:
+                    self._entries.move_to_end(user_id)
+                    self._stats['hits'] += 1
+                    self._stats['hit_age_total'] += age
+                    self._stats['hit_age_max'] = max(self._stats['hit_age_max'], age)
+                    return value, None
+                else:
+                    del self._entries[user_id]
+                    self._stats['expired'] += 1
+            self._stats['misses'] += 1
+            return None, now
+
+    def put(self, user_id, value, loaded_at):
+        stamps = self.stamps
+        with self._lock:
+            if stamps.latest(user_id) >= loaded_at:
+                # Una escritura confirmada durante la lectura: el valor leído podría ser anterior
+                self._stats['discarded_loads'] += 1
+                return
+            self._entries[user_id] = (value, loaded_at)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, user_ids):
+        user_ids = list(user_ids)
+        self.stamps.stamp(user_ids)
+        with self._lock:
+            for user_id in user_ids:
+                if self._entries.pop(user_id, None) is not None:
+                    self._stats['invalidations'] += 1
+
+    def clear(self):
+        self.stamps.stamp(['*'])
+        with self._lock:
+            self._entries.clear()
+            self._stats['clears'] += 1
+
+    def record_verification(self, stale):
+        with self._lock:
+            self._stats['verified'] += 1
+            self._stats['stale'] += 1 if stale else 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        hits = stats['hits']
+        lookups = hits + stats['misses']
+        stats['maxsize'] = self.maxsize
+        stats['ttl'] = self.ttl
+        stats['hit_ratio'] = round(hits / lookups, 4) if lookups else 0.0
+        stats['stale_ratio'] = round(stats['stale'] / stats['verified'], 4) if stats['verified'] else 0.0
+        hit_age_total = stats.pop('hit_age_total')
+        stats['hit_age_avg_ms'] = round(hit_age_total / hits * 1000, 3) if hits else 0.0
+        stats['hit_age_max_ms'] = round(stats.pop('hit_age_max') * 1000, 3)
+        return stats
+
+balance_cache = BalanceCache(BALANCE_CACHE_SIZE, BALANCE_CACHE_TTL)
+
+def balance_from_row(row):
+    """Respuesta de GET /bank/balance a partir de una fila de BALANCE_SQL (None si no hay cuenta)."""
+    if row is None:
+        return None
+    account_balance, limit_credit, credit_debt = row
+    return {
+        "account_balance": float(account_balance),
+        "credit_limit": float(limit_credit) if limit_credit is not None else None,
+        "credit_card_debt": float(credit_debt) if credit_debt is not None else None,
+        "available_credit": float(limit_credit - credit_debt) if limit_credit is not None else None
+    }
+
+def should_verify():
+    return BALANCE_CACHE_VERIFY_RATE > 0 and random.random() < BALANCE_CACHE_VERIFY_RATE
+
+def cached_balance(user_id, loader):
+    """
+    Saldos de `user_id` desde la caché o, si no están, desde `loader()` (None si el usuario
+    no tiene cuenta; no se guarda).
+    """
+    if balance_cache.maxsize <= 0:
+        return loader()
+    value, loaded_at = balance_cache.get(user_id)
+    if loaded_at is None:
+        if should_verify():
+            balance_cache.record_verification(loader() != value)
+        return value
+    value = loader()
+    if value is not None:
+        balance_cache.put(user_id, value, loaded_at)
+    return value
+
+async def cached_balance_async(user_id, loader):
+    """Variante de cached_balance para el modo ASGI: `loader` es una corrutina."""
+    if balance_cache.maxsize <= 0:
+        return await loader()
+    value, loaded_at = balance_cache.get(user_id)
+    if loaded_at is None:
+        if should_verify():
+            balance_cache.record_verification(await loader() != value)
+        return value
+    value = await loader()
+    if value is not None:
+        balance_cache.put(user_id, value, loaded_at)
+    return value
+
+def invalidate_balances(*user_ids):
+    """
+    Invalida en todos los workers del host los saldos de los usuarios indicados ('*': de todos)
+    tras confirmar una escritura, y envía sus lecturas al primario mientras las réplicas se
+    ponen al día.
+    """
+    pin_to_primary(*user_ids)
+    if '*' in user_ids:
+        balance_cache.clear()
+    else:
+        balance_cache.invalidate(int(user_id) for user_id in user_ids if user_id is not None)
+
+def balance_cache_stats():
+    """Aciertos, invalidaciones y antigüedad de la caché de saldos del worker actual."""
+    return balance_cache.stats()
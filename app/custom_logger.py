@@ -1,37 +1,296 @@
 # app/custom_logger.py
+import atexit
 import datetime
+import os
+import queue
 import re
+import threading
+import time
 from flask import request
 
 LOG_FILE = 'security_events.log'
 
+# Escritura asíncrona por lotes: los hilos de request solo encolan la línea formateada
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', '256'))
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', '0.5'))
+# Política ante cola llena: 'drop' descarta la entrada, 'block' espera hasta LOG_BLOCK_TIMEOUT
+# segundos. En ambos casos las entradas descartadas se contabilizan en log_stats().
+LOG_OVERFLOW_POLICY = os.environ.get('LOG_OVERFLOW_POLICY', 'drop').lower()
+LOG_BLOCK_TIMEOUT = float(os.environ.get('LOG_BLOCK_TIMEOUT', '1'))
+# Tamaño máximo de cada write(); con O_APPEND cada write de líneas completas queda
+# contiguo en el archivo aunque varios workers de gunicorn escriban a la vez.
+LOG_MAX_WRITE_BYTES = 64 * 1024
+# Cada cuántos segundos se verifica si el archivo fue rotado o eliminado externamente
+# (y si corresponde rotarlo a un segmento comprimido: ver app/log_archive.py)
+LOG_REOPEN_CHECK_INTERVAL = 5.0
+
+class _MaskRule:
+    """Regla de enmascaramiento: patrón, plantilla de reemplazo y disparadores del filtro rápido."""
+
+    def __init__(self, name, pattern, replacement, triggers):
+        self.name = name
+        self.pattern = pattern
+        self.replacement = replacement
+        self.triggers = tuple(t.lower() for t in triggers)
+        self.template = replacement  # plantilla ajustada a la numeración del escáner combinado
+
+_mask_rules = {}
+_mask_scanner = None
+_mask_triggers = ()
+
+def register_mask_rule(name, pattern, replacement, triggers):
+    """
+    Registra (o reemplaza) una regla de enmascaramiento y recompila el escáner.
+    `name` debe ser un identificador válido; `triggers` son subcadenas que deben
+    aparecer en el mensaje (sin distinguir mayúsculas) para que la regla pueda aplicar.
+    Ante coincidencias en la misma posición gana la regla registrada primero.
+    """
+    _mask_rules[name] = _MaskRule(name, pattern, replacement, triggers)
+    _build_mask_scanner()
+
+def _build_mask_scanner():
+    """Combina todas las reglas en una sola expresión regular con un grupo por regla."""
+    global _mask_scanner, _mask_triggers
+    parts = []
+    group_index = 0
+    triggers = []
+    for rule in _mask_rules.values():
+        group_index += 1
+        offset = group_index
+        # Renumerar \N de la plantilla al índice que el grupo tendrá en el escáner combinado
+        rule.template = re.sub(r"\\(\d+)", lambda m, o=offset: f"\\g<{o + int(m.group(1))}>", rule.replacement)
+        parts.append(f"(?P<{rule.name}>{rule.pattern})")
+        group_index += re.compile(rule.pattern).groups
+        triggers.extend(t for t in rule.triggers if t not in triggers)
+    _mask_scanner = re.compile("|".join(parts), re.IGNORECASE) if parts else None
+    _mask_triggers = tuple(triggers)
+
+def _apply_mask_rule(match):
+    return match.expand(_mask_rules[match.lastgroup].template)
+
 def _mask_sensitive_data(message):
-    """Función interna para enmascarar datos sensibles en un mensaje de log."""
-    # Enmascarar cédulas - patrones con comillas simples y dobles
-    message = re.sub(r"(['\"]cedula['\"]\s*:\s*['\"])\d{6}(\d{4})(['\"])", r"\1******\2\3", message, flags=re.IGNORECASE)
-    # Enmascarar contraseñas - patrones con comillas simples y dobles
-    message = re.sub(r"(['\"]password['\"]\s*:\s*['\"]).*?(['\"])", r"\1********\2", message, flags=re.IGNORECASE)
-    # Enmascarar números de celular - patrones con comillas simples y dobles
-    message = re.sub(r"(['\"]celular['\"]\s*:\s*['\"])\d{6}(\d{4})(['\"])", r"\1******\2\3", message, flags=re.IGNORECASE)
-    # Enmascarar tokens JWT parcialmente
-    message = re.sub(r"(Bearer\s+)([a-zA-Z0-9_-]{10})[a-zA-Z0-9_.-]*", r"\1\2***", message, flags=re.IGNORECASE)
-    # Enmascarar emails parcialmente
-    message = re.sub(r"([a-zA-Z0-9_.+-]+)@([a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+)", r"\1***@\2", message, flags=re.IGNORECASE)
+    """Función interna para enmascarar datos sensibles en un mensaje de log (una sola pasada)."""
+    if _mask_scanner is None:
+        return message
+    # Filtro rápido: la mayoría de mensajes no contiene ningún campo sensible
+    lowered = message.lower()
+    for trigger in _mask_triggers:
+        if trigger in lowered:
+            return _mask_scanner.sub(_apply_mask_rule, message)
     return message
 
-def log_event(level, message, status_code='-', user_id='anonymous'):
+# Enmascarar cédulas - patrones con comillas simples y dobles
+register_mask_rule('cedula', r"(['\"]cedula['\"]\s*:\s*['\"])\d{6}(\d{4})(['\"])", r"\1******\2\3", ['cedula'])
+# Enmascarar contraseñas - patrones con comillas simples y dobles
+register_mask_rule('password', r"(['\"]password['\"]\s*:\s*['\"]).*?(['\"])", r"\1********\2", ['password'])
+# Enmascarar números de celular - patrones con comillas simples y dobles
+register_mask_rule('celular', r"(['\"]celular['\"]\s*:\s*['\"])\d{6}(\d{4})(['\"])", r"\1******\2\3", ['celular'])
+# Enmascarar tokens JWT parcialmente
+register_mask_rule('bearer', r"(Bearer\s+)([a-zA-Z0-9_-]{10})[a-zA-Z0-9_.-]*", r"\1\2***", ['bearer'])
+# Enmascarar emails parcialmente. El TLD distingue mayúsculas (el escáner usa IGNORECASE) para
+# que el dominio termine donde empieza la palabra siguiente: en "a@ex.comBearer ..." el dominio
+# es "ex.com" y el token Bearer que sigue también se enmascara.
+register_mask_rule(
+    'email',
+    r"([a-zA-Z0-9_.+-]+)@((?:[a-zA-Z0-9-]+\.)+(?-i:[a-z]{2,}|[A-Z][a-z]+|[A-Z]{2,}(?![a-z])))",
+    r"\1***@\2",
+    ['@']
+)
+
+class _Flush:
+    """Marcador para forzar la escritura de lo acumulado (o detener el escritor)."""
+
+    def __init__(self, stop=False):
+        self.stop = stop
+        self.done = threading.Event()
+
+class _LogWriter:
+    """Escritor en segundo plano que mantiene el archivo abierto y escribe por lotes."""
+
+    def __init__(self, path):
+        self.pid = os.getpid()
+        self.path = path
+        self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._stats = {'enqueued': 0, 'written': 0, 'dropped': 0, 'batches': 0, 'write_errors': 0, 'rotations': 0}
+        self._fd = None
+        self._last_reopen_check = 0.0
+        self._thread = threading.Thread(target=self._run, name='security-log-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, line):
+        """Encola una línea; nunca espera por disco (salvo política 'block' con cola llena)."""
+        try:
+            if LOG_OVERFLOW_POLICY == 'block':
+                self.queue.put(line, timeout=LOG_BLOCK_TIMEOUT)
+            else:
+                self.queue.put_nowait(line)
+        except queue.Full:
+            with self._lock:
+                self._stats['dropped'] += 1
+            return False
+        with self._lock:
+            self._stats['enqueued'] += 1
+        return True
+
+    def flush(self, stop=False, timeout=5.0):
+        """Espera a que todo lo encolado hasta ahora quede escrito en disco."""
+        marker = _Flush(stop)
+        try:
+            self.queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.done.wait(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = 0.0
+        while True:
+            try:
+                if batch:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                else:
+                    item = self.queue.get()
+            except queue.Empty:
+                item = None  # venció el intervalo de flush
+
+            if isinstance(item, str):
+                if not batch:
+                    deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+                batch.append(item)
+                if len(batch) < LOG_BATCH_SIZE:
+                    continue
+
+            if batch:
+                self._write(batch)
+                batch = []
+            if isinstance(item, _Flush):
+                if item.stop:
+                    self._close()
+                item.done.set()
+                if item.stop:
+                    return
+
+    def _open(self):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._last_reopen_check = time.monotonic()
+        elif time.monotonic() - self._last_reopen_check >= LOG_REOPEN_CHECK_INTERVAL:
+            self._last_reopen_check = time.monotonic()
+            try:
+                same_file = os.path.samestat(os.stat(self.path), os.fstat(self._fd))
+            except FileNotFoundError:
+                same_file = False
+            if same_file:
+                # Rotación a segmentos comprimidos e indexados (app/log_archive.py)
+                from .log_archive import maybe_rotate
+                try:
+                    if maybe_rotate(self.path, self._fd):
+                        with self._lock:
+                            self._stats['rotations'] += 1
+                        same_file = False
+                except OSError as e:
+                    print(f"CRITICAL: Failed to rotate log file: {e}")
+            if not same_file:
+                self._close()
+                self._open()
+        return self._fd
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _write(self, lines):
+        try:
+            fd = self._open()
+            chunk = []
+            chunk_bytes = 0
+            for line in lines:
+                data = line.encode('utf-8')
+                if chunk and chunk_bytes + len(data) > LOG_MAX_WRITE_BYTES:
+                    self._write_all(fd, b''.join(chunk))
+                    chunk, chunk_bytes = [], 0
+                chunk.append(data)
+                chunk_bytes += len(data)
+            if chunk:
+                self._write_all(fd, b''.join(chunk))
+            with self._lock:
+                self._stats['written'] += len(lines)
+                self._stats['batches'] += 1
+        except OSError as e:
+            with self._lock:
+                self._stats['write_errors'] += 1
+            self._close()
+            print(f"CRITICAL: Failed to write to log file: {e}")
+
+    @staticmethod
+    def _write_all(fd, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['pid'] = self.pid
+        stats['queued'] = self.queue.qsize()
+        stats['policy'] = LOG_OVERFLOW_POLICY
+        return stats
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def _after_fork_in_child():
+    global _writer_lock
+    _writer_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def _get_writer():
+    """Devuelve el escritor del proceso actual; tras un fork() se crea uno nuevo con su propio hilo."""
+    global _writer
+    writer = _writer
+    if writer is not None and writer.pid == os.getpid():
+        return writer
+    with _writer_lock:
+        if _writer is None or _writer.pid != os.getpid():
+            _writer = _LogWriter(LOG_FILE)
+        return _writer
+
+def flush_logs(timeout=5.0):
+    """Fuerza la escritura de las entradas pendientes del proceso actual."""
+    writer = _writer
+    if writer is not None and writer.pid == os.getpid():
+        return writer.flush(timeout=timeout)
+    return True
+
+@atexit.register
+def _shutdown_writer():
+    writer = _writer
+    if writer is not None and writer.pid == os.getpid():
+        writer.flush(stop=True)
+
+def log_stats():
+    """Contadores del escritor de logs del worker actual (encoladas, escritas, descartadas)."""
+    return _get_writer().stats()
+
+def log_event(level, message, status_code='-', user_id='anonymous', ip_address=None):
     """
-    Escribe una entrada de log estandarizada en el archivo de seguridad.
+    Encola una entrada de log estandarizada para el archivo de seguridad.
     Formato: AAAA-MM-DD HH:MM:SS.ssss | LEVEL | IP | USUARIO_ID | MENSAJE | HTTP STATUS
+    Fuera de un request de Flask (modo ASGI) la IP se pasa en `ip_address`.
     """
     try:
         timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-        ip_address = request.remote_addr if request else 'N/A'
+        if ip_address is None:
+            ip_address = request.remote_addr if request else 'N/A'
         safe_message = _mask_sensitive_data(str(message)).replace('\n', ' ').replace('\r', '').replace('\t', ' ')
         log_entry = f"{timestamp} | {level.upper():<7} | {ip_address:<15} | {user_id:<15} | {safe_message} | HTTP {status_code}\n"
         
-        with open(LOG_FILE, 'a', encoding='utf-8') as f:
-            f.write(log_entry)
+        _get_writer().submit(log_entry)
     except Exception as e:
         print(f"CRITICAL: Failed to write to log file: {e}")
 
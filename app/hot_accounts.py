@@ -0,0 +1,226 @@
+# app/hot_accounts.py
+"""
+Cuentas calientes: cuentas que reciben muchos créditos simultáneos (comercios, la cuenta del
+cajero) y que con un solo saldo serializarían todos los depósitos y transferencias en el lock
+de su fila.
+
+Una cuenta caliente (bank.accounts.balance_slots = N > 0) tiene N sub-saldos en
+bank.account_slots. Cada crédito de un depósito o una transferencia suma a un sub-saldo al
+azar sin bloquear la fila de la cuenta; los débitos bloquean la cuenta y verifican fondos
+contra el saldo principal más los sub-saldos (ver app/queries.py). Las lecturas de saldo
+suman ambos en la misma instantánea, de modo que el saldo lógico es siempre consistente.
+
+Cada worker pliega los sub-saldos en el saldo principal en un hilo propio, a lo sumo una vez
+cada HOT_ACCOUNT_FOLD_INTERVAL segundos, y solo mientras recibe depósitos o transferencias.
+
+Uso:
+    python -m app.hot_accounts enable (--account ID | --username USUARIO) [--slots 16]
+    python -m app.hot_accounts disable (--account ID | --username USUARIO)
+    python -m app.hot_accounts fold          # pliega ya todos los sub-saldos
+    python -m app.hot_accounts list
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+from .custom_logger import log_event
+from .db import get_connection
+from .queries import HOT_ACCOUNT_CONFIGURE_SQL, HOT_ACCOUNT_FOLD_SQL, HOT_ACCOUNTS_SQL
+
+# Sub-saldos por defecto al activar una cuenta caliente (uno por crédito concurrente esperado)
+HOT_ACCOUNT_SLOTS = int(os.environ.get('HOT_ACCOUNT_SLOTS', '16'))
+# Segundos mínimos entre plegados de cada worker (0 los desactiva) y cuentas por sentencia
+HOT_ACCOUNT_FOLD_INTERVAL = float(os.environ.get('HOT_ACCOUNT_FOLD_INTERVAL', '5'))
+HOT_ACCOUNT_FOLD_BATCH = int(os.environ.get('HOT_ACCOUNT_FOLD_BATCH', '100'))
+# Límite de balance_slots (SMALLINT); más sub-saldos solo encarecen los débitos
+HOT_ACCOUNT_MAX_SLOTS = 256
+
+class _Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {'folds': 0, 'accounts_folded': 0, 'amount_folded': 0.0, 'errors': 0}
+
+    def record(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+_stats = _Stats()
+
+def configure(conn, account_id, slots):
+    """Fija los sub-saldos de una cuenta (0 la vuelve normal) y confirma. False si la cuenta no existe."""
+    if not 0 <= slots <= HOT_ACCOUNT_MAX_SLOTS:
+        raise ValueError(f"Los sub-saldos deben estar entre 0 y {HOT_ACCOUNT_MAX_SLOTS}")
+    cur = conn.cursor()
+    try:
+        cur.execute(HOT_ACCOUNT_CONFIGURE_SQL, {'account_id': account_id, 'slots': slots})
+        found = cur.fetchone() is not None
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return found
+
+def fold(conn):
+    """Pliega los sub-saldos pendientes por tandas de HOT_ACCOUNT_FOLD_BATCH cuentas. Devuelve (cuentas, monto)."""
+    accounts, amount = 0, 0
+    cur = conn.cursor()
+    try:
+        while True:
+            cur.execute(HOT_ACCOUNT_FOLD_SQL, {'limit': HOT_ACCOUNT_FOLD_BATCH})
+            folded, total = cur.fetchone()
+            conn.commit()
+            accounts += folded
+            amount += total
+            if folded < HOT_ACCOUNT_FOLD_BATCH:
+                break
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return accounts, amount
+
+def hot_accounts(conn):
+    """[(id_cuenta, username, sub-saldos, saldo principal, suma de sub-saldos)]."""
+    cur = conn.cursor()
+    try:
+        cur.execute(HOT_ACCOUNTS_SQL)
+        return cur.fetchall()
+    finally:
+        conn.rollback()
+        cur.close()
+
+# ---------------- Plegado periódico ----------------
+
+_fold_executor = None
+_fold_pid = None
+_fold_next = 0.0
+_fold_lock = threading.Lock()
+
+def _after_fork_in_child():
+    global _fold_lock
+    _fold_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def schedule_fold():
+    """Encola un plegado en el hilo del worker si pasó HOT_ACCOUNT_FOLD_INTERVAL desde el último."""
+    global _fold_executor, _fold_pid, _fold_next
+    if HOT_ACCOUNT_FOLD_INTERVAL <= 0:
+        return
+    now = time.monotonic()
+    if now < _fold_next and _fold_pid == os.getpid():
+        return
+    with _fold_lock:
+        if _fold_pid != os.getpid():
+            # Los hilos no sobreviven a un fork()
+            _fold_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='hot-account-fold')
+            _fold_pid = os.getpid()
+        elif now < _fold_next:
+            return
+        _fold_next = now + HOT_ACCOUNT_FOLD_INTERVAL
+        _fold_executor.submit(fold_pending)
+
+def fold_pending():
+    """Plegado del hilo del worker: registra el resultado en hot_account_stats() y nunca lanza."""
+    try:
+        conn = get_connection()
+    except psycopg2.Error as e:
+        log_event('ERROR', f"Plegado de cuentas calientes sin conexión: {e}", status_code=503)
+        _stats.record('errors')
+        return 0, 0
+    try:
+        accounts, amount = fold(conn)
+    except psycopg2.Error as e:
+        log_event('ERROR', f"Error plegando sub-saldos de cuentas calientes: {e}", status_code=500)
+        _stats.record('errors')
+        return 0, 0
+    finally:
+        conn.close()
+    _stats.record('folds')
+    _stats.record('accounts_folded', accounts)
+    _stats.record('amount_folded', float(amount))
+    return accounts, amount
+
+def hot_account_stats():
+    """Plegados hechos por el worker actual, cuentas y monto plegados."""
+    stats = _stats.snapshot()
+    stats['fold_interval'] = HOT_ACCOUNT_FOLD_INTERVAL
+    return stats
+
+# ---------------- Línea de comandos ----------------
+
+def _account_id(conn, args):
+    if args.account is not None:
+        return args.account
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT a.id FROM bank.accounts a JOIN bank.users u ON u.id = a.user_id
+            WHERE u.username = %s ORDER BY a.id LIMIT 1
+        """, (args.username,))
+        row = cur.fetchone()
+    finally:
+        conn.rollback()
+        cur.close()
+    return row[0] if row else None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('enable', 'Activa el modo de cuenta caliente'), ('disable', 'Vuelve la cuenta a un solo saldo')):
+        command = commands.add_parser(name, help=help_text)
+        target = command.add_mutually_exclusive_group(required=True)
+        target.add_argument('--account', type=int, help='Número de cuenta')
+        target.add_argument('--username', help='Usuario titular de la cuenta')
+        if name == 'enable':
+            command.add_argument('--slots', type=int, default=HOT_ACCOUNT_SLOTS, help='Cantidad de sub-saldos')
+    commands.add_parser('fold', help='Pliega todos los sub-saldos en el saldo principal')
+    commands.add_parser('list', help='Lista las cuentas calientes y sus sub-saldos sin plegar')
+    args = parser.parse_args(argv)
+
+    conn = get_connection()
+    try:
+        if args.command == 'list':
+            for account_id, username, slots, balance, pending in hot_accounts(conn):
+                print(f"{account_id:>8}  {username or '-':<24} sub-saldos={slots:<4} "
+                      f"principal={balance} sin plegar={pending} saldo={balance + pending}")
+            return 0
+        if args.command == 'fold':
+            accounts, amount = fold(conn)
+            print(f"✅ {accounts} cuentas plegadas ({amount} movidos al saldo principal)")
+            return 0
+
+        account_id = _account_id(conn, args)
+        slots = args.slots if args.command == 'enable' else 0
+        try:
+            found = account_id is not None and configure(conn, account_id, slots)
+        except ValueError as e:
+            print(f"❌ {e}", file=sys.stderr)
+            return 1
+        if not found:
+            print("❌ Cuenta no encontrada", file=sys.stderr)
+            return 1
+        if slots:
+            print(f"✅ Cuenta {account_id} caliente con {slots} sub-saldos")
+        else:
+            accounts, _ = fold(conn)
+            print(f"✅ Cuenta {account_id} con un solo saldo ({accounts} cuentas plegadas)")
+        log_event('INFO', f"Cuenta {account_id}: sub-saldos={slots}", user_id='hot_accounts')
+        return 0
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
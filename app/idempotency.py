@@ -0,0 +1,336 @@
+# app/idempotency.py
+"""
+Claves de idempotencia (cabecera Idempotency-Key) para los POST de /bank.
+
+El resultado de la operación se guarda en bank.idempotency_keys dentro de la misma
+transacción que mueve el dinero: o quedan ambos o ninguno. Un reintento con la misma clave
+devuelve el resultado guardado sin volver a ejecutar la sentencia ni bloquear cuentas, con la
+cabecera `Idempotent-Replayed: true`.
+
+- La clave es por usuario; la solicitud se identifica con una huella SHA-256 del método, la
+  ruta y el cuerpo. Reusar la clave con otra solicitud responde 422.
+- Dos solicitudes simultáneas con la misma clave: la segunda espera en el INSERT de la clave a
+  que la primera confirme, revierte lo que hizo y devuelve el resultado de la primera.
+- Cada worker guarda en memoria (LRU acotada) los resultados ya leídos de la base, hasta que
+  vence su TTL. Solo se llenan desde la base: una entrada nunca describe una operación
+  revertida.
+- Las claves vencidas se borran por tandas en un hilo del worker, a lo sumo una vez cada
+  IDEMPOTENCY_PURGE_INTERVAL segundos.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from functools import wraps
+
+import psycopg2
+from flask import after_this_request, g, request
+
+from .custom_logger import log_event
+from .db import StalePreparedStatement, get_connection
+from .queries import IDEMPOTENCY_LOOKUP_SQL, IDEMPOTENCY_STORE_SQL, IDEMPOTENCY_PURGE_SQL
+
+# Horas durante las que una clave devuelve el resultado guardado
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24'))
+# Resultados por worker en la caché en memoria (0 la desactiva)
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '10000'))
+# Segundos mínimos entre purgas de claves vencidas, y filas borradas por sentencia
+IDEMPOTENCY_PURGE_INTERVAL = float(os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', '300'))
+IDEMPOTENCY_PURGE_BATCH = int(os.environ.get('IDEMPOTENCY_PURGE_BATCH', '5000'))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+class IdempotencyError(ValueError):
+    """Clave inválida (400) o reutilizada con otra solicitud (422); el mensaje es la respuesta."""
+
+    def __init__(self, message, code=400):
+        super().__init__(message)
+        self.code = code
+
+class IdempotencyConflict(Exception):
+    """Otra transacción guardó la misma clave mientras esta ejecutaba la operación."""
+
+class IdempotencyContext:
+    """Clave y huella de la solicitud en curso; `replayed` indica que se devolvió un resultado guardado."""
+
+    def __init__(self, user_id, key, fingerprint):
+        self.user_id = user_id
+        self.key = key
+        self.fingerprint = fingerprint
+        self.replayed = False
+
+    def params(self, result=None):
+        return {
+            'user_id': self.user_id, 'key': self.key, 'fingerprint': self.fingerprint,
+            'result': dumps(result), 'ttl': IDEMPOTENCY_TTL_HOURS,
+        }
+
+# ---------------- Serialización de resultados ----------------
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return {'$decimal': str(value)}
+    raise TypeError(f"Resultado no serializable: {type(value).__name__}")
+
+def _object_hook(obj):
+    if len(obj) == 1 and '$decimal' in obj:
+        return Decimal(obj['$decimal'])
+    return obj
+
+def dumps(result):
+    """JSON del resultado; los Decimal se conservan exactos. Las tuplas vuelven como listas."""
+    return json.dumps(result, default=_default, separators=(',', ':'))
+
+def loads(text):
+    return json.loads(text, object_hook=_object_hook)
+
+# ---------------- Claves y huellas ----------------
+
+def fingerprint(method, path, body=b'', query=b'', content_type='', content_length=None):
+    """
+    Huella de la solicitud. Con `content_length` (cuerpos en streaming, que no se leen antes de
+    operar) usa la consulta, el tipo y la longitud del cuerpo en lugar de su contenido.
+    """
+    h = hashlib.sha256()
+    h.update(f"{method} {path}\n".encode())
+    if content_length is not None:
+        h.update(query + f"\n{content_type}\n{content_length}".encode())
+    else:
+        h.update(body)
+    return h.digest()
+
+def check_key(key):
+    """Valida la cabecera Idempotency-Key: texto ASCII visible de 1 a 255 caracteres."""
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH or not all('!' <= c <= '~' for c in key):
+        raise IdempotencyError(
+            f"La cabecera {IDEMPOTENCY_HEADER} debe tener de 1 a {IDEMPOTENCY_KEY_MAX_LENGTH} caracteres ASCII visibles"
+        )
+    return key
+
+def check_replay(ctx, stored_fingerprint):
+    if bytes(stored_fingerprint) != ctx.fingerprint:
+        _stats.record('mismatches')
+        raise IdempotencyError(f"La {IDEMPOTENCY_HEADER} ya se usó con una solicitud distinta", 422)
+    ctx.replayed = True
+
+# ---------------- Caché en memoria ----------------
+
+class ResultCache:
+    """LRU de resultados (JSON) por (user_id, clave), cada uno con el vencimiento de su fila en la base."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # (user_id, clave) -> (huella, JSON del resultado, vence)
+        self._lock = threading.Lock()
+
+    def get(self, user_id, key):
+        with self._lock:
+            entry = self._entries.get((user_id, key))
+            if entry is None:
+                return None
+            if entry[2] <= time.monotonic():
+                del self._entries[(user_id, key)]
+                return None
+            self._entries.move_to_end((user_id, key))
+            return entry
+
+    def put(self, user_id, key, stored_fingerprint, text, remaining):
+        if self.maxsize <= 0 or remaining <= 0:
+            return
+        with self._lock:
+            self._entries[(user_id, key)] = (bytes(stored_fingerprint), text, time.monotonic() + remaining)
+            self._entries.move_to_end((user_id, key))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+class _Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {'cache_hits': 0, 'db_hits': 0, 'stored': 0, 'conflicts': 0, 'mismatches': 0, 'purged': 0}
+
+    def record(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+result_cache = ResultCache(IDEMPOTENCY_CACHE_SIZE)
+_stats = _Stats()
+
+def record(name, n=1):
+    """Suma a un contador de idempotency_stats() (stored, conflicts, ...)."""
+    _stats.record(name, n)
+
+def cached(ctx):
+    """Resultado guardado en la caché del worker; si lo hay marca ctx.replayed."""
+    entry = result_cache.get(ctx.user_id, ctx.key)
+    if entry is None:
+        return None
+    check_replay(ctx, entry[0])
+    _stats.record('cache_hits')
+    # Cada repetición decodifica su propia copia: los handlers completan el resultado
+    return loads(entry[1])
+
+def replay(ctx, row):
+    """Resultado de una fila de IDEMPOTENCY_LOOKUP_SQL (huella, resultado, segundos restantes)."""
+    stored_fingerprint, text, remaining = row
+    check_replay(ctx, stored_fingerprint)
+    result_cache.put(ctx.user_id, ctx.key, stored_fingerprint, text, float(remaining))
+    _stats.record('db_hits')
+    return loads(text)
+
+# ---------------- Ejecución ----------------
+
+def once(conn, ctx, compute):
+    """
+    Ejecuta `compute()` (que opera en `conn`) y guarda su resultado con la clave `ctx`, sin
+    confirmar: el commit del llamador confirma la operación y la clave juntas. Si la clave ya
+    tiene resultado, lo devuelve sin ejecutar `compute`. Sin clave solo ejecuta `compute()`.
+    """
+    if ctx is None:
+        return compute()
+    schedule_purge()
+    result = cached(ctx)
+    if ctx.replayed:
+        return result
+    cur = conn.cursor()
+    try:
+        while True:
+            cur.execute(IDEMPOTENCY_LOOKUP_SQL, ctx.params())
+            row = cur.fetchone()
+            if row is not None:
+                conn.rollback()
+                return replay(ctx, row)
+            result = compute()
+            cur.execute(IDEMPOTENCY_STORE_SQL, ctx.params(result))
+            if cur.fetchone() is not None:
+                _stats.record('stored')
+                return result
+            # Otra solicitud con la misma clave confirmó primero: se deshace lo hecho y la
+            # búsqueda siguiente devuelve su resultado. Si esa clave vence o se purga entre tanto,
+            # la búsqueda no la encuentra y la operación se ejecuta de nuevo.
+            conn.rollback()
+            _stats.record('conflicts')
+    finally:
+        cur.close()
+
+def request_context(user_id, key, **fingerprint_args):
+    """Contexto de la solicitud, o None si no trae clave. IdempotencyError si la clave es inválida."""
+    if key is None:
+        return None
+    return IdempotencyContext(user_id, check_key(key), fingerprint(**fingerprint_args))
+
+def idempotent(body=True):
+    """
+    Decorador (después de token_required) que acepta la cabecera Idempotency-Key y deja el
+    contexto en g.idempotency para once(). body=False para cuerpos leídos en streaming, que no
+    se pueden repetir tras StalePreparedStatement (responden 503).
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            from flask_restx import abort
+
+            if body:
+                fingerprint_args = {'body': request.get_data(cache=True)}
+            else:
+                fingerprint_args = {
+                    'query': request.query_string, 'content_type': request.content_type or '',
+                    'content_length': request.content_length or 0,
+                }
+            try:
+                g.idempotency = request_context(
+                    g.user['id'], request.headers.get(IDEMPOTENCY_HEADER),
+                    method=request.method, path=request.path, **fingerprint_args
+                )
+                if g.idempotency is not None:
+                    @after_this_request
+                    def mark_replayed(response):
+                        # También en las respuestas de error que repite el resultado guardado
+                        if g.idempotency.replayed:
+                            response.headers[REPLAYED_HEADER] = 'true'
+                        return response
+                try:
+                    return f(*args, **kwargs)
+                except StalePreparedStatement:
+                    if not body:
+                        raise
+                    # Un cambio de esquema abortó la transacción: con el cuerpo en memoria se repite
+                    # una vez la solicitud entera, ya con las sentencias preparadas de nuevo
+                    return f(*args, **kwargs)
+            except IdempotencyError as e:
+                abort(e.code, str(e))
+        return wrapper
+    return decorator
+
+# ---------------- Purga ----------------
+
+_purge_executor = None
+_purge_pid = None
+_purge_next = 0.0
+_purge_lock = threading.Lock()
+
+def _after_fork_in_child():
+    global _purge_lock
+    _purge_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def schedule_purge():
+    """Encola una purga en el hilo del worker si pasó IDEMPOTENCY_PURGE_INTERVAL desde la última."""
+    global _purge_executor, _purge_pid, _purge_next
+    now = time.monotonic()
+    if now < _purge_next and _purge_pid == os.getpid():
+        return
+    with _purge_lock:
+        if _purge_pid != os.getpid():
+            # Los hilos no sobreviven a un fork()
+            _purge_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='idempotency-purge')
+            _purge_pid = os.getpid()
+        elif now < _purge_next:
+            return
+        _purge_next = now + IDEMPOTENCY_PURGE_INTERVAL
+        _purge_executor.submit(purge_expired)
+
+def purge_expired():
+    """Borra las claves vencidas por tandas de IDEMPOTENCY_PURGE_BATCH. Devuelve cuántas borró."""
+    try:
+        conn = get_connection()
+    except psycopg2.Error as e:
+        log_event('ERROR', f"Purga de claves de idempotencia sin conexión: {e}", status_code=503)
+        return 0
+    purged = 0
+    try:
+        cur = conn.cursor()
+        while True:
+            cur.execute(IDEMPOTENCY_PURGE_SQL, {'ttl': IDEMPOTENCY_TTL_HOURS, 'limit': IDEMPOTENCY_PURGE_BATCH})
+            deleted = cur.rowcount
+            conn.commit()
+            purged += deleted
+            if deleted < IDEMPOTENCY_PURGE_BATCH:
+                break
+    except psycopg2.Error as e:
+        log_event('ERROR', f"Error purgando claves de idempotencia: {e}", status_code=500)
+    finally:
+        conn.close()
+    _stats.record('purged', purged)
+    return purged
+
+def idempotency_stats():
+    """Repeticiones servidas desde la caché o la base, claves guardadas y purgadas por el worker actual."""
+    stats = _stats.snapshot()
+    stats['cache_size'] = len(result_cache)
+    stats['cache_maxsize'] = result_cache.maxsize
+    stats['ttl_hours'] = IDEMPOTENCY_TTL_HOURS
+    return stats
@@ -0,0 +1,206 @@
+# app/import_clients.py
+"""
+Importación masiva de clientes desde un archivo CSV o JSON lines.
+
+Aplica las mismas reglas que /auth/register (app/validators.py), detecta duplicados
+dentro del archivo y contra la base, hashea las contraseñas en paralelo con todos los
+núcleos e inserta users/clients/accounts/credit_cards con INSERT multi-fila, una
+transacción por bloque. Las filas rechazadas se reportan por número de línea.
+
+Uso:
+    python -m app.import_clients clientes.csv [--report rechazados.csv] [--chunk-size 1000]
+
+Columnas: nombres, apellidos, direccion, cedula, celular, username, password, email
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+from itertools import islice
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from .bulk import iter_csv_records, iter_jsonl_records
+from .custom_logger import log_event
+from .db import get_connection
+from .security import hash_passwords
+from .validators import validar_cedula, validar_celular, validar_username, validar_password
+
+# Clientes por transacción
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', '1000'))
+
+CLIENT_FIELDS = ('nombres', 'apellidos', 'direccion', 'cedula', 'celular', 'username', 'password', 'email')
+REQUIRED_FIELDS = ('nombres', 'apellidos', 'cedula', 'celular', 'username', 'password', 'email')
+
+def _validate(row):
+    """Aplica las validaciones de registro; devuelve el mensaje de error o None."""
+    missing = [field for field in REQUIRED_FIELDS if not isinstance(row.get(field), str) or not row[field].strip()]
+    if missing:
+        return f"Campos obligatorios faltantes: {', '.join(missing)}"
+    if not validar_cedula(row['cedula']):
+        return "El número de cédula proporcionado no es válido."
+    if not validar_celular(row['celular']):
+        return "El número de celular debe tener 10 dígitos y empezar con 09."
+    if not validar_username(row['username'], row['nombres'], row['apellidos']):
+        return "El nombre de usuario es inválido o contiene información personal."
+    info_personal = {'nombres': row['nombres'], 'apellidos': row['apellidos'], 'cedula': row['cedula']}
+    if not validar_password(row['password'], info_personal):
+        return "La contraseña no cumple con los requisitos de seguridad."
+    return None
+
+class ClientImporter:
+    """Procesa bloques de clientes: validación, duplicados, hash en paralelo e inserción multi-fila."""
+
+    def __init__(self, conn, report, hash_workers=None):
+        self.conn = conn
+        self.report = report
+        self.hash_workers = hash_workers
+        self.seen = {'username': set(), 'email': set(), 'cedula': set()}
+        self.stats = {'rows': 0, 'imported': 0, 'invalid': 0, 'duplicates': 0}
+
+    def reject(self, line_no, row, reason, duplicate=False):
+        self.stats['duplicates' if duplicate else 'invalid'] += 1
+        self.report.writerow([line_no, (row or {}).get('username', ''), reason])
+
+    def _existing(self, cur, rows):
+        """Usernames, emails y cédulas del bloque que ya existen en la base (dos consultas por bloque)."""
+        cur.execute(
+            "SELECT username, email FROM bank.users WHERE username = ANY(%s) OR email = ANY(%s)",
+            ([r['username'] for r in rows], [r['email'] for r in rows])
+        )
+        usernames, emails = set(), set()
+        for username, email in cur.fetchall():
+            usernames.add(username)
+            emails.add(email)
+        cur.execute("SELECT cedula FROM bank.clients WHERE cedula = ANY(%s)", ([r['cedula'] for r in rows],))
+        return {'username': usernames, 'email': emails, 'cedula': {row[0] for row in cur.fetchall()}}
+
+    def _insert(self, cur, rows, hashes):
+        """Inserta el bloque con INSERT multi-fila; devuelve la cantidad de clientes creados."""
+        user_ids = execute_values(
+            cur,
+            "INSERT INTO bank.users (username, password, role, full_name, email) VALUES %s RETURNING username, id",
+            [(r['username'], h, 'cliente', f"{r['nombres']} {r['apellidos']}", r['email']) for r, h in zip(rows, hashes)],
+            page_size=len(rows), fetch=True
+        )
+        user_ids = dict(user_ids)
+        user_ids = [user_ids[r['username']] for r in rows]
+        execute_values(
+            cur,
+            "INSERT INTO bank.clients (user_id, nombres, apellidos, direccion, cedula, celular, ip_registro) VALUES %s",
+            [(uid, r['nombres'], r['apellidos'], r.get('direccion'), r['cedula'], r['celular'], None)
+             for uid, r in zip(user_ids, rows)],
+            page_size=len(rows)
+        )
+        execute_values(cur, "INSERT INTO bank.accounts (balance, user_id) VALUES %s",
+                       [(0, uid) for uid in user_ids], page_size=len(rows))
+        execute_values(cur, "INSERT INTO bank.credit_cards (limit_credit, balance, user_id) VALUES %s",
+                       [(1000, 0, uid) for uid in user_ids], page_size=len(rows))
+        return len(user_ids)
+
+    def process(self, chunk):
+        """Valida e inserta un bloque de (línea, fila) en una transacción."""
+        candidates = []
+        for line_no, row in chunk:
+            self.stats['rows'] += 1
+            if row is None:
+                self.reject(line_no, row, "Formato inválido")
+                continue
+            # La contraseña va tal cual, como en /auth/register: los espacios son parte de ella
+            row = {key: value.strip() if isinstance(value, str) and key != 'password' else value
+                   for key, value in row.items()}
+            error = _validate(row)
+            if error:
+                self.reject(line_no, row, error)
+                continue
+            duplicated = next((f for f in ('username', 'email', 'cedula') if row[f] in self.seen[f]), None)
+            if duplicated:
+                self.reject(line_no, row, f"{duplicated} duplicado en el archivo", duplicate=True)
+                continue
+            for field in self.seen:
+                self.seen[field].add(row[field])
+            candidates.append((line_no, row))
+        if not candidates:
+            return
+
+        cur = self.conn.cursor()
+        try:
+            existing = self._existing(cur, [row for _, row in candidates])
+            self.conn.rollback()
+            rows = []
+            for line_no, row in candidates:
+                duplicated = next((f for f in ('username', 'email', 'cedula') if row[f] in existing[f]), None)
+                if duplicated:
+                    self.reject(line_no, row, f"{duplicated} ya registrado", duplicate=True)
+                else:
+                    rows.append((line_no, row))
+            if not rows:
+                return
+
+            # Hash fuera de la transacción: es la parte costosa del bloque
+            hashes = hash_passwords([row['password'] for _, row in rows], self.hash_workers)
+            try:
+                self.stats['imported'] += self._insert(cur, [row for _, row in rows], hashes)
+                self.conn.commit()
+            except psycopg2.IntegrityError:
+                # Otro proceso registró alguno de estos datos entre la verificación y el INSERT:
+                # se reintenta fila por fila para identificar las líneas en conflicto
+                self.conn.rollback()
+                for (line_no, row), password_hash in zip(rows, hashes):
+                    try:
+                        self.stats['imported'] += self._insert(cur, [row], [password_hash])
+                        self.conn.commit()
+                    except psycopg2.IntegrityError:
+                        self.conn.rollback()
+                        self.reject(line_no, row, "Ya existe un registro con esos datos.", duplicate=True)
+        finally:
+            cur.close()
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file', help='Archivo CSV (con encabezado) o JSON lines (.jsonl)')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='Por defecto se deduce de la extensión')
+    parser.add_argument('--report', help='CSV de filas rechazadas (línea, username, motivo); por defecto stderr')
+    parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+    parser.add_argument('--hash-workers', type=int, help='Hilos de bcrypt (por defecto, uno por núcleo)')
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ('jsonl' if args.file.endswith(('.jsonl', '.ndjson')) else 'csv')
+    report_file = open(args.report, 'w', newline='', encoding='utf-8') if args.report else sys.stderr
+    report = csv.writer(report_file)
+    report.writerow(['line', 'username', 'reason'])
+
+    started = time.monotonic()
+    conn = get_connection()
+    try:
+        importer = ClientImporter(conn, report, args.hash_workers)
+        with open(args.file, 'rb') as source:
+            records = iter_csv_records(source, CLIENT_FIELDS) if fmt == 'csv' else iter_jsonl_records(source)
+            for chunk in _chunks(records, args.chunk_size):
+                importer.process(chunk)
+                print(f"{importer.stats['rows']} filas procesadas, {importer.stats['imported']} importadas", file=sys.stderr)
+    finally:
+        conn.close()
+        if args.report:
+            report_file.close()
+
+    stats = importer.stats
+    elapsed = time.monotonic() - started
+    log_event('INFO', f"Importación masiva de clientes: {stats['imported']} importados, "
+                      f"{stats['invalid']} inválidos, {stats['duplicates']} duplicados", user_id='import')
+    print(f"Filas: {stats['rows']} | importadas: {stats['imported']} | inválidas: {stats['invalid']} | "
+          f"duplicadas: {stats['duplicates']} | {elapsed:.1f}s")
+    return 0 if stats['imported'] or not stats['rows'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+# app/ledger.py
+"""
+Libro de movimientos bank.transactions (append-only).
+
+Cada sentencia de app/queries.py que modifica un saldo inserta sus movimientos en la misma
+transacción. La tabla está particionada por mes sobre created_at (más una partición DEFAULT
+que evita fallos si falta la del mes); las particiones se crean por adelantado en cada
+despliegue, con `python -m app.migrations --partitions` y desde cada worker, a lo sumo una vez
+cada LEDGER_PARTITIONS_INTERVAL segundos. El historial se pagina con un cursor opaco sobre
+(created_at, id), nunca con OFFSET.
+"""
+import base64
+import binascii
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import psycopg2
+
+from .custom_logger import log_event
+from .db import get_connection
+
+# Meses futuros con partición ya creada
+LEDGER_PARTITIONS_AHEAD = int(os.environ.get('LEDGER_PARTITIONS_AHEAD', '3'))
+# Segundos mínimos entre creaciones de particiones de cada worker (0 las desactiva)
+LEDGER_PARTITIONS_INTERVAL = float(os.environ.get('LEDGER_PARTITIONS_INTERVAL', '3600'))
+TRANSACTIONS_PAGE_SIZE = int(os.environ.get('TRANSACTIONS_PAGE_SIZE', '50'))
+TRANSACTIONS_PAGE_MAX = int(os.environ.get('TRANSACTIONS_PAGE_MAX', '200'))
+
+# Posición inicial del historial: antes de cualquier movimiento posible
+FIRST_PAGE = (datetime(9999, 12, 31, tzinfo=timezone.utc), 2**63 - 1)
+
+class PaginationError(ValueError):
+    """Cursor o tamaño de página inválido; el mensaje es la respuesta 400."""
+
+def ensure_partitions(conn, months_ahead=LEDGER_PARTITIONS_AHEAD):
+    """Crea las particiones mensuales del mes actual y los `months_ahead` siguientes. Devuelve cuántas creó."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT bank.ensure_transaction_partitions(%s)", (months_ahead,))
+        created = cur.fetchone()[0]
+        conn.commit()
+    finally:
+        cur.close()
+    return created
+
+def encode_cursor(created_at, transaction_id):
+    raw = f"{created_at.isoformat()}|{transaction_id}".encode('ascii')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Devuelve (created_at, id) del último movimiento de la página anterior; FIRST_PAGE si no hay cursor."""
+    if not cursor:
+        return FIRST_PAGE
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        created_at, transaction_id = raw.split('|')
+        created_at = datetime.fromisoformat(created_at)
+        transaction_id = int(transaction_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise PaginationError("Cursor inválido")
+    if created_at.tzinfo is None:
+        raise PaginationError("Cursor inválido")
+    return created_at, transaction_id
+
+def page_limit(value):
+    """Tamaño de página pedido en ?limit=, acotado a TRANSACTIONS_PAGE_MAX."""
+    if value in (None, ''):
+        return TRANSACTIONS_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        raise PaginationError("El parámetro limit debe ser un entero")
+    if limit <= 0:
+        raise PaginationError("El parámetro limit debe ser mayor que cero")
+    return min(limit, TRANSACTIONS_PAGE_MAX)
+
+def transactions_page(rows, limit):
+    """Respuesta de GET /bank/transactions a partir de las filas de TRANSACTIONS_PAGE_SQL."""
+    transactions = [{
+        "id": transaction_id,
+        "created_at": created_at.isoformat(),
+        "instrument": instrument,
+        "kind": kind,
+        "amount": float(amount),
+        "balance_after": float(balance_after),
+        "counterparty": counterparty,
+    } for transaction_id, created_at, instrument, kind, amount, balance_after, counterparty in rows]
+    next_cursor = encode_cursor(rows[-1][1], rows[-1][0]) if len(rows) == limit else None
+    return {"transactions": transactions, "next_cursor": next_cursor}
+
+def batch_movements(results, targets, target_user_ids, sender_id, sender_account_id):
+    """
+    Movimientos de un lote para BATCH_TRANSFER_APPLY_SQL, en el orden de los ítems aplicados:
+    débito del remitente y crédito del destino por cada uno. Devuelve los tres arreglos paralelos.
+    """
+    account_ids, amounts, counterparties = [], [], []
+    for result in results:
+        if result["status"] != "applied":
+            continue
+        username = result["target_username"]
+        amount = Decimal(str(result["amount"]))
+        account_ids += [sender_account_id, targets[username]]
+        amounts += [-amount, amount]
+        counterparties += [target_user_ids[username], sender_id]
+    return {
+        'movement_account_ids': account_ids,
+        'movement_amounts': amounts,
+        'movement_counterparties': counterparties,
+    }
+
+# ---------------- Particiones periódicas ----------------
+
+_partitions_executor = None
+_partitions_pid = None
+_partitions_next = 0.0
+_partitions_lock = threading.Lock()
+
+def _after_fork_in_child():
+    global _partitions_lock
+    _partitions_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def schedule_partitions():
+    """Encola la creación de particiones en el hilo del worker si pasó LEDGER_PARTITIONS_INTERVAL desde la última."""
+    global _partitions_executor, _partitions_pid, _partitions_next
+    if LEDGER_PARTITIONS_INTERVAL <= 0:
+        return
+    now = time.monotonic()
+    if now < _partitions_next and _partitions_pid == os.getpid():
+        return
+    with _partitions_lock:
+        if _partitions_pid != os.getpid():
+            # Los hilos no sobreviven a un fork()
+            _partitions_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ledger-partitions')
+            _partitions_pid = os.getpid()
+        elif now < _partitions_next:
+            return
+        _partitions_next = now + LEDGER_PARTITIONS_INTERVAL
+        _partitions_executor.submit(create_partitions)
+
+def create_partitions():
+    """Creación de particiones del hilo del worker: registra el error en el log y nunca lanza."""
+    try:
+        conn = get_connection()
+    except psycopg2.Error as e:
+        log_event('ERROR', f"Particiones del libro de movimientos sin conexión: {e}", status_code=503)
+        return 0
+    try:
+        created = ensure_partitions(conn)
+    except psycopg2.Error as e:
+        conn.rollback()
+        log_event('ERROR', f"Error creando particiones del libro de movimientos: {e}", status_code=500)
+        return 0
+    finally:
+        conn.close()
+    if created:
+        log_event('INFO', f"Particiones del libro de movimientos creadas: {created}", status_code=200)
+    return created
@@ -0,0 +1,528 @@
+# app/log_archive.py
+"""
+Segmentos comprimidos e indexados de security_events.log.
+
+El escritor de logs de cada worker rota el archivo activo cuando supera LOG_SEGMENT_BYTES o
+cuando su primera entrada es de una ventana de LOG_SEGMENT_SECONDS anterior a la actual: bajo
+un flock no bloqueante lo renombra a LOG_ARCHIVE_DIR/pending-<inodo>.log y los demás workers
+abren el archivo nuevo en su verificación periódica. Pasados LOG_ARCHIVE_GRACE segundos sin
+escrituras, el segmento pendiente se comprime en:
+
+- <base>.log.gz: bloques de ~LOG_ARCHIVE_BLOCK_BYTES de líneas completas, cada uno un miembro
+  gzip independiente (el archivo sigue siendo legible con zcat/zgrep).
+- <base>.idx: JSON con el rango de tiempo del segmento, offset, longitud y rango de tiempo de
+  cada bloque, y por user_id y por IP la lista de bloques donde aparecen.
+
+<base> es security_events-<primera>-<última>-<inodo> (fechas AAAAmmddTHHMMSS). Una consulta
+descarta por nombre los segmentos fuera de rango, lee el índice de los demás y descomprime con
+mmap solo los bloques que pueden contener entradas del usuario o IP pedidos. Los segmentos aún
+pendientes y el archivo activo se recorren completos.
+
+Uso:
+    python -m app.log_archive query [--user-id 42] [--ip 10.0.0.1] [--from 2024-01-15]
+                                    [--to "2024-01-16 12:00"] [--level ERROR] [--limit 100] [--json]
+    python -m app.log_archive rotate           # rota el archivo activo ahora
+    python -m app.log_archive compact [--now]  # comprime los segmentos pendientes
+"""
+import argparse
+import datetime
+import fcntl
+import glob
+import json
+import mmap
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Rotación y compresión del log de seguridad ('0' deja crecer un único archivo)
+LOG_ARCHIVE_ENABLED = os.environ.get('LOG_ARCHIVE_ENABLED', '1') == '1'
+LOG_ARCHIVE_DIR = os.environ.get('LOG_ARCHIVE_DIR', 'security_logs')
+# Límites de cada segmento: tamaño en bytes y ventana de tiempo en segundos (0 desactiva cada uno)
+LOG_SEGMENT_BYTES = int(os.environ.get('LOG_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+LOG_SEGMENT_SECONDS = int(os.environ.get('LOG_SEGMENT_SECONDS', '3600'))
+# Bytes sin comprimir por bloque: unidad mínima que descomprime una consulta
+LOG_ARCHIVE_BLOCK_BYTES = int(os.environ.get('LOG_ARCHIVE_BLOCK_BYTES', str(64 * 1024)))
+# Segundos sin escrituras antes de comprimir un segmento pendiente: cubre a los workers que
+# todavía no notaron la rotación (verifican cada LOG_REOPEN_CHECK_INTERVAL segundos)
+LOG_ARCHIVE_GRACE = float(os.environ.get('LOG_ARCHIVE_GRACE', '30'))
+# Máximo de entradas que devuelve una consulta
+LOG_QUERY_MAX_RESULTS = int(os.environ.get('LOG_QUERY_MAX_RESULTS', '1000'))
+
+INDEX_VERSION = 1
+_SEPARATOR = b' | '
+_TS_LEN = 23  # 'AAAA-MM-DD HH:MM:SS.mmm'
+_NAME_TS = '%Y%m%dT%H%M%S'
+_SEGMENT_RE = re.compile(r'^security_events-(\d{8}T\d{6})-(\d{8}T\d{6})-(\d+)\.log\.gz$')
+
+class LogQueryError(ValueError):
+    """Filtros de consulta inválidos."""
+
+# ---------------- Formato de línea ----------------
+
+def _fields(line):
+    """(timestamp, nivel, ip, user_id, resto) en bytes, o None si la línea no tiene el formato."""
+    parts = line.split(_SEPARATOR, 4)
+    if len(parts) < 5 or len(parts[0]) != _TS_LEN:
+        return None
+    return parts[0], parts[1].rstrip(), parts[2].rstrip(), parts[3].rstrip(), parts[4]
+
+def parse_entry(line):
+    """Entrada de log como diccionario (timestamp, level, ip, user_id, message, status)."""
+    ts, level, ip, user_id, rest = _fields(line)
+    message, _, status = rest.rstrip(b'\r\n').rpartition(_SEPARATOR)
+    return {
+        'timestamp': ts.decode(),
+        'level': level.decode(),
+        'ip': ip.decode('utf-8', 'replace'),
+        'user_id': user_id.decode('utf-8', 'replace'),
+        'message': message.decode('utf-8', 'replace'),
+        'status': status[5:].decode() if status.startswith(b'HTTP ') else status.decode('utf-8', 'replace'),
+    }
+
+def _to_datetime(ts):
+    return datetime.datetime.strptime(ts.decode() if isinstance(ts, bytes) else ts, '%Y-%m-%d %H:%M:%S.%f')
+
+def normalize_bound(value):
+    """'2024-01-15', '2024-01-15 10:30' o ISO completo -> timestamp comparable con los del log."""
+    if value is None or value == '':
+        return None
+    try:
+        parsed = datetime.datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        raise LogQueryError(f"Fecha inválida: {value!r} (use AAAA-MM-DD[ HH:MM[:SS]])") from None
+    return parsed.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+def query_limit(value):
+    """Límite de entradas desde la URL: por defecto LOG_QUERY_MAX_RESULTS, que es también el máximo."""
+    if value is None or value == '':
+        return LOG_QUERY_MAX_RESULTS
+    try:
+        limit = int(value)
+    except ValueError:
+        raise LogQueryError("El límite debe ser un número entero") from None
+    if not 1 <= limit <= LOG_QUERY_MAX_RESULTS:
+        raise LogQueryError(f"El límite debe estar entre 1 y {LOG_QUERY_MAX_RESULTS}")
+    return limit
+
+# ---------------- Rotación ----------------
+
+@contextmanager
+def _archive_lock(name, blocking):
+    """flock sobre LOG_ARCHIVE_DIR/.<name>.lock entre procesos (y entre hilos: un fd por llamada)."""
+    os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+    fd = os.open(os.path.join(LOG_ARCHIVE_DIR, f'.{name}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
+def needs_rotation(path):
+    """True si el archivo activo superó LOG_SEGMENT_BYTES o empezó en una ventana de tiempo anterior."""
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            first = f.read(_TS_LEN)
+    except FileNotFoundError:
+        return False
+    if size == 0:
+        return False
+    if LOG_SEGMENT_BYTES and size >= LOG_SEGMENT_BYTES:
+        return True
+    if LOG_SEGMENT_SECONDS:
+        try:
+            started = _to_datetime(first).timestamp()
+        except ValueError:
+            return False
+        return int(started // LOG_SEGMENT_SECONDS) != int(time.time() // LOG_SEGMENT_SECONDS)
+    return False
+
+def rotate(path, fd=None):
+    """
+    Mueve el archivo activo a un segmento pendiente. Con `fd`, solo si ese descriptor sigue
+    apuntando al archivo activo (otro worker pudo haberlo rotado ya). Devuelve la ruta
+    pendiente, o None si no rotó.
+    """
+    with _archive_lock('rotate', blocking=False) as locked:
+        if not locked:
+            return None
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if st.st_size == 0 or (fd is not None and not os.path.samestat(st, os.fstat(fd))):
+            return None
+        pending = os.path.join(LOG_ARCHIVE_DIR, f'pending-{st.st_ino}.log')
+        os.rename(path, pending)
+        return pending
+
+def maybe_rotate(path, fd):
+    """Chequeo periódico del escritor de logs: rota si corresponde y agenda la compresión."""
+    if not LOG_ARCHIVE_ENABLED:
+        return None
+    pending = rotate(path, fd) if needs_rotation(path) else None
+    schedule_compaction()
+    return pending
+
+# ---------------- Compresión e índice ----------------
+
+def _segment_base(first, last, inode):
+    return 'security_events-{}-{}-{}'.format(
+        _to_datetime(first).strftime(_NAME_TS), _to_datetime(last).strftime(_NAME_TS), inode)
+
+def _write_atomic(path, data):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def compress_segment(pending):
+    """Comprime un segmento pendiente en .log.gz + .idx y lo elimina. Devuelve la ruta del .log.gz."""
+    st = os.stat(pending)
+    if st.st_size == 0:
+        os.unlink(pending)
+        return None
+    blocks, users, ips = [], {}, {}
+    out = []
+    offset = 0
+    first = last = None
+
+    def add_key(index, key, block_id):
+        ids = index.setdefault(key.decode('utf-8', 'replace'), [])
+        if not ids or ids[-1] != block_id:
+            ids.append(block_id)
+
+    def close_block(lines, lo, hi):
+        nonlocal offset
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: miembro gzip completo
+        data = compressor.compress(b''.join(lines)) + compressor.flush()
+        out.append(data)
+        blocks.append([offset, len(data), lo, hi, len(lines)])
+        offset += len(data)
+
+    with open(pending, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        lines, size, lo, hi = [], 0, None, None
+        for line in iter(mm.readline, b''):
+            fields = _fields(line)
+            if fields is not None:
+                ts = fields[0].decode()
+                lo = ts if lo is None or ts < lo else lo
+                hi = ts if hi is None or ts > hi else hi
+                add_key(users, fields[3], len(blocks))
+                add_key(ips, fields[2], len(blocks))
+            lines.append(line)
+            size += len(line)
+            if size >= LOG_ARCHIVE_BLOCK_BYTES:
+                close_block(lines, lo, hi)
+                first = lo if first is None or (lo and lo < first) else first
+                last = hi if last is None or (hi and hi > last) else last
+                lines, size, lo, hi = [], 0, None, None
+        if lines:
+            close_block(lines, lo, hi)
+            first = lo if first is None or (lo and lo < first) else first
+            last = hi if last is None or (hi and hi > last) else last
+
+    if first is None:
+        # Sin una sola línea con timestamp: se nombra por la fecha de la última escritura
+        first = last = datetime.datetime.fromtimestamp(st.st_mtime).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    base = os.path.join(LOG_ARCHIVE_DIR, _segment_base(first, last, st.st_ino))
+    index = {
+        'version': INDEX_VERSION, 'first': first, 'last': last,
+        'lines': sum(b[4] for b in blocks), 'bytes': st.st_size,
+        'blocks': blocks, 'users': users, 'ips': ips,
+    }
+    # El .idx se escribe al final: una consulta solo considera segmentos con índice
+    _write_atomic(f'{base}.log.gz', b''.join(out))
+    _write_atomic(f'{base}.idx', json.dumps(index, separators=(',', ':')).encode())
+    os.unlink(pending)
+    return f'{base}.log.gz'
+
+def pending_segments():
+    """Segmentos rotados sin comprimir, del más antiguo al más reciente."""
+    paths = glob.glob(os.path.join(LOG_ARCHIVE_DIR, 'pending-*.log'))
+    stats = []
+    for path in paths:
+        try:
+            stats.append((os.stat(path).st_mtime, path))
+        except FileNotFoundError:
+            pass
+    return [path for _, path in sorted(stats)]
+
+def compact(grace=None):
+    """Comprime los segmentos pendientes sin escrituras en `grace` segundos. Devuelve los creados."""
+    grace = LOG_ARCHIVE_GRACE if grace is None else grace
+    created = []
+    with _archive_lock('compact', blocking=False) as locked:
+        if not locked:
+            return created
+        for path in pending_segments():
+            try:
+                if time.time() - os.stat(path).st_mtime < grace:
+                    continue
+                segment = compress_segment(path)
+            except FileNotFoundError:
+                continue
+            if segment:
+                created.append(segment)
+    return created
+
+# ---------------- Compresión periódica ----------------
+
+_compact_executor = None
+_compact_pid = None
+_compact_busy = False
+_compact_lock = threading.Lock()
+
+def _after_fork_in_child():
+    global _compact_lock, _compact_busy
+    _compact_lock = threading.Lock()
+    _compact_busy = False
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def schedule_compaction():
+    """Encola una compresión en el hilo del worker si hay segmentos pendientes y no hay una en curso."""
+    global _compact_executor, _compact_pid, _compact_busy
+    if not glob.glob(os.path.join(LOG_ARCHIVE_DIR, 'pending-*.log')):
+        return
+    with _compact_lock:
+        if _compact_pid != os.getpid():
+            # Los hilos no sobreviven a un fork()
+            _compact_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='security-log-compact')
+            _compact_pid = os.getpid()
+            _compact_busy = False
+        if _compact_busy:
+            return
+        _compact_busy = True
+    _compact_executor.submit(_compact_pending)
+
+def _compact_pending():
+    global _compact_busy
+    try:
+        compact()
+    except OSError as e:
+        print(f"CRITICAL: Failed to compress security log segment: {e}")
+    finally:
+        _compact_busy = False
+
+# ---------------- Consultas ----------------
+
+_INDEX_CACHE_SIZE = 256
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+def _load_index(path):
+    """Índice de un segmento, cacheado por ruta y mtime (los segmentos no cambian una vez escritos)."""
+    mtime = os.stat(path).st_mtime_ns
+    with _index_cache_lock:
+        cached = _index_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            _index_cache.move_to_end(path)
+            return cached[1]
+    with open(path, 'rb') as f:
+        index = json.load(f)
+    if index.get('version') != INDEX_VERSION:
+        return None
+    with _index_cache_lock:
+        _index_cache[path] = (mtime, index)
+        while len(_index_cache) > _INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+def archived_segments():
+    """[(primera, última, ruta .log.gz)] de los segmentos comprimidos con índice, por fecha."""
+    segments = []
+    for path in glob.glob(os.path.join(LOG_ARCHIVE_DIR, 'security_events-*.log.gz')):
+        match = _SEGMENT_RE.match(os.path.basename(path))
+        if match and os.path.exists(path[:-len('.log.gz')] + '.idx'):
+            first = datetime.datetime.strptime(match.group(1), _NAME_TS)
+            last = datetime.datetime.strptime(match.group(2), _NAME_TS)
+            segments.append((first, last, path))
+    segments.sort()
+    return segments
+
+class _Query:
+    def __init__(self, user_id, ip, since, until, level, limit):
+        self.user_id = None if user_id is None else str(user_id)
+        self.ip = ip or None
+        self.since = normalize_bound(since)
+        self.until = normalize_bound(until)
+        self.level = level.upper() if level else None
+        self.limit = limit
+        self._user = None if self.user_id is None else self.user_id.encode()
+        self._ip = None if self.ip is None else self.ip.encode()
+        self._since = None if self.since is None else self.since.encode()
+        self._until = None if self.until is None else self.until.encode()
+        self._level = None if self.level is None else self.level.encode()
+        self.entries = []
+        self.stats = {'segments': 0, 'segments_skipped': 0, 'blocks': 0, 'blocks_read': 0,
+                      'bytes_read': 0, 'lines_scanned': 0}
+
+    @property
+    def full(self):
+        return len(self.entries) >= self.limit
+
+    def overlaps(self, first, last):
+        """¿El rango [first, last] (timestamps de texto) puede tener entradas del filtro?"""
+        if self.since and last is not None and last < self.since:
+            return False
+        if self.until and first is not None and first >= self.until:
+            return False
+        return True
+
+    def scan(self, data):
+        """Filtra las líneas de `data` (bytes o mmap) y acumula las que cumplen todo. Devuelve los bytes recorridos."""
+        pos, end = 0, len(data)
+        while pos < end and not self.full:
+            nl = data.find(b'\n', pos)
+            nl = end if nl < 0 else nl + 1
+            line = data[pos:nl]
+            pos = nl
+            self.stats['lines_scanned'] += 1
+            fields = _fields(line)
+            if fields is None:
+                continue
+            ts, level, ip, user_id, _ = fields
+            if ((self._since and ts < self._since) or (self._until and ts >= self._until)
+                    or (self._level and level != self._level) or (self._ip and ip != self._ip)
+                    or (self._user is not None and user_id != self._user)):
+                continue
+            self.entries.append(parse_entry(line))
+        return pos
+
+    def candidate_blocks(self, index):
+        candidates = None
+        if self.user_id is not None:
+            candidates = set(index['users'].get(self.user_id, ()))
+        if self.ip is not None:
+            ids = set(index['ips'].get(self.ip, ()))
+            candidates = ids if candidates is None else candidates & ids
+        if candidates is None:
+            candidates = range(len(index['blocks']))
+        return [i for i in sorted(candidates)
+                if self.overlaps(index['blocks'][i][2], index['blocks'][i][3])]
+
+    def scan_segment(self, path):
+        index = _load_index(path[:-len('.log.gz')] + '.idx')
+        if index is None:
+            return
+        self.stats['segments'] += 1
+        self.stats['blocks'] += len(index['blocks'])
+        blocks = self.candidate_blocks(index)
+        if not blocks:
+            return
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for i in blocks:
+                if self.full:
+                    break
+                offset, length = index['blocks'][i][:2]
+                self.stats['blocks_read'] += 1
+                self.stats['bytes_read'] += length
+                self.scan(zlib.decompress(mm[offset:offset + length], 31))
+
+    def scan_file(self, path):
+        """Segmento pendiente o archivo activo: sin índice, se recorre completo."""
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            self.stats['segments'] += 1
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                self.stats['bytes_read'] += self.scan(mm)
+
+def query(user_id=None, ip=None, since=None, until=None, level=None, limit=LOG_QUERY_MAX_RESULTS, live_path=None):
+    """
+    Entradas del log de seguridad que cumplen todos los filtros, de la más antigua a la más
+    reciente: {'entries', 'truncated', 'stats'}. `since` es inclusivo y `until` exclusivo.
+    """
+    if live_path is None:
+        from .custom_logger import LOG_FILE as live_path
+    limit = query_limit(limit)
+    q = _Query(user_id, ip, since, until, level, limit)
+    if q.since and q.until and q.since >= q.until:
+        raise LogQueryError("La fecha inicial debe ser anterior a la final")
+
+    for first, last, path in archived_segments():
+        if q.full:
+            break
+        # Los nombres tienen resolución de segundos: se extiende `last` al final de su segundo
+        if not q.overlaps(first.strftime('%Y-%m-%d %H:%M:%S.000'), last.strftime('%Y-%m-%d %H:%M:%S.999')):
+            q.stats['segments_skipped'] += 1
+            continue
+        try:
+            q.scan_segment(path)
+        except FileNotFoundError:
+            continue
+    for path in pending_segments() + [live_path]:
+        if q.full:
+            break
+        q.scan_file(path)
+    return {'entries': q.entries, 'truncated': q.full, 'stats': q.stats}
+
+# ---------------- Línea de comandos ----------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('query', help='Busca entradas usando los índices de los segmentos')
+    command.add_argument('--user-id', help='USUARIO_ID exacto (p. ej. 42 o anonymous)')
+    command.add_argument('--ip', help='IP exacta')
+    command.add_argument('--from', dest='since', help='Desde (inclusivo): AAAA-MM-DD[ HH:MM[:SS]]')
+    command.add_argument('--to', dest='until', help='Hasta (exclusivo): AAAA-MM-DD[ HH:MM[:SS]]')
+    command.add_argument('--level', help='INFO, WARNING, ERROR...')
+    command.add_argument('--limit', type=int, default=LOG_QUERY_MAX_RESULTS, help='Máximo de entradas')
+    command.add_argument('--json', action='store_true', help='Una entrada JSON por línea')
+    command.add_argument('--stats', action='store_true', help='Muestra bloques y bytes leídos en stderr')
+    commands.add_parser('rotate', help='Rota el archivo activo a un segmento pendiente')
+    command = commands.add_parser('compact', help='Comprime los segmentos pendientes')
+    command.add_argument('--now', action='store_true',
+                         help=f'No espera LOG_ARCHIVE_GRACE ({LOG_ARCHIVE_GRACE:g} s); solo con los workers detenidos')
+    args = parser.parse_args(argv)
+
+    if args.command == 'rotate':
+        from .custom_logger import LOG_FILE
+        pending = rotate(LOG_FILE)
+        print(f"✅ {LOG_FILE} -> {pending}" if pending else "Nada que rotar (archivo vacío o rotación en curso)")
+        return 0
+    if args.command == 'compact':
+        for segment in compact(grace=0 if args.now else None):
+            print(f"✅ {segment}")
+        return 0
+
+    try:
+        result = query(args.user_id, args.ip, args.since, args.until, args.level, args.limit)
+    except LogQueryError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    for entry in result['entries']:
+        if args.json:
+            print(json.dumps(entry, ensure_ascii=False))
+        else:
+            print(f"{entry['timestamp']} | {entry['level']:<7} | {entry['ip']:<15} | {entry['user_id']:<15} | "
+                  f"{entry['message']} | HTTP {entry['status']}")
+    if args.stats:
+        stats = result['stats']
+        print(f"{len(result['entries'])} entradas{' (truncado)' if result['truncated'] else ''}; "
+              f"segmentos={stats['segments']} descartados por fecha={stats['segments_skipped']} "
+              f"bloques leídos={stats['blocks_read']}/{stats['blocks']} bytes leídos={stats['bytes_read']} "
+              f"líneas={stats['lines_scanned']}", file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
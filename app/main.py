@@ -1,24 +1,52 @@
 import secrets
 import os
-from flask import Flask, request, g
-from flask_restx import Api, Resource, fields # type: ignore
-from functools import wraps
-from .db import get_connection, init_db
+import re
+import time
+import jwt
+import psycopg2
+from flask import Flask, Response, request, g, current_app, jsonify, send_file
+from flask_restx import Api, Namespace, Resource, fields # type: ignore
+from functools import lru_cache, wraps
+from werkzeug.exceptions import HTTPException, TooManyRequests
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import ClosingIterator
+from .bulk import apply_bulk_deposits, evaluate_batch_transfers, iter_csv_records, iter_jsonl_records
+from .cache import balance_from_row, cached_balance, invalidate_balances, balance_cache_stats
+from .custom_logger import log_event, log_endpoint, log_stats
+from .hot_accounts import hot_account_stats, schedule_fold
+from .db import (
+    DB_REPLICA_DSNS, db_connection, get_pool, pin_to_primary, pool_stats, prepared_statement_stats, replica_stats,
+    run_read_only, PoolTimeout, StalePreparedStatement
+)
+from .idempotency import idempotent, idempotency_stats, once
+from .ledger import PaginationError, batch_movements, decode_cursor, page_limit, schedule_partitions, transactions_page
+from .log_archive import LogQueryError, query as query_security_log
+from .metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE, METRICS_ENABLED, register_collector, render as render_metrics,
+    request_done, request_finished, request_started
+)
+from .profiling import (
+    PROFILE_ENABLED, PROFILE_HEADER, PROFILE_ID_HEADER, discard as discard_profile, start as start_profile,
+    stop as stop_profile, wants_profile
+)
+from .ratelimit import TRUSTED_PROXY_HOPS, get_rate_limiter, rate_limit_stats
+from .queries import (
+    WITHDRAW_SQL, TRANSFER_SQL, CREDIT_PAYMENT_SQL, PAY_CREDIT_BALANCE_SQL,
+    BATCH_TRANSFER_LOCK_SQL, BATCH_TRANSFER_APPLY_SQL, BALANCE_SQL, DEPOSIT_SQL, TRANSACTIONS_PAGE_SQL, LOGIN_SQL
+)
+from .security import (
+    create_jwt, check_password, hash_password, token_required, requires_role,
+    resolve_secret_key, bcrypt_stats, token_cache_stats
+)
+from .statements import (
+    StatementEncoder, StatementError, create_job, export_stats, get_job, get_job_runner, iter_statement,
+    job_path, open_statement, statement_dates, statement_filename
+)
+from .validators import validar_cedula, validar_celular, validar_username, validar_password
 import logging
 
 # JWT-based authentication - no in-memory token store needed
 
-#log = logging.getLogger(__name__)
-logging.basicConfig(
-     filename="app.log",
-     level=logging.DEBUG,
-     encoding="utf-8",
-     filemode="a",
-     format="{asctime} - {levelname} - {message}",
-     style="{",
-     datefmt="%Y-%m-%d %H:%M",
-)
-
 # Configure Swagger security scheme for Bearer tokens
 authorizations = {
     'Bearer': {
@@ -29,39 +57,13 @@ authorizations = {
     }
 }
 
-app = Flask(__name__)
-
-# Configuración segura del secreto JWT
-secret_key = os.environ.get('JWT_SECRET_KEY')
-env_mode = os.environ.get('ENV', 'development').lower()
-
-if not secret_key:
-    if env_mode == 'production':
-        raise RuntimeError("JWT_SECRET_KEY es obligatorio en producción. "
-                          "Configure una clave segura de al menos 32 caracteres.")
-    else:
-        # Solo para desarrollo
-        import warnings
-        warnings.warn("⚠️  Usando secreto temporal para desarrollo. "
-                     "Configure JWT_SECRET_KEY para producción.", 
-                     UserWarning, stacklevel=2)
-        secret_key = 'dev-secret-temp-' + str(os.urandom(16).hex())
-
-app.config['SECRET_KEY'] = secret_key
-
-api = Api(
-    app,
-    version='1.0',
-    title='Core Bancario API',
-    description='API para operaciones bancarias, incluyendo autenticación y operaciones de cuenta.',
-    doc='/swagger',  # Swagger UI endpoint
-    authorizations=authorizations,
-    security='Bearer'
-)
+# Máximo de transferencias aceptadas en un lote de /bank/transfers/batch
+BATCH_TRANSFER_MAX_ITEMS = int(os.environ.get('BATCH_TRANSFER_MAX_ITEMS', '10000'))
 
 # Create namespaces for authentication and bank operations
-auth_ns = api.namespace('auth', description='Operaciones de autenticación')
-bank_ns = api.namespace('bank', description='Operaciones bancarias')
+auth_ns = Namespace('auth', description='Operaciones de autenticación')
+bank_ns = Namespace('bank', description='Operaciones bancarias')
+ops_ns = Namespace('ops', description='Estadísticas operativas del worker')
 
 # Define the expected payload models for Swagger
 login_model = auth_ns.model('Login', {
@@ -87,10 +89,27 @@ credit_payment_model = bank_ns.model('CreditPayment', {
     'amount': fields.Float(required=True, description='Monto de la compra a crédito', example=100)
 })
 
+batch_transfer_item_model = bank_ns.model('BatchTransferItem', {
+    'target_username': fields.String(required=True, description='Usuario destino', example='user2'),
+    'amount': fields.Float(required=True, description='Monto a transferir', example=100)
+})
+
+batch_transfer_model = bank_ns.model('BatchTransfer', {
+    'transfers': fields.List(fields.Nested(batch_transfer_item_model), required=True, description='Transferencias del lote'),
+    'mode': fields.String(description='all_or_nothing: se aplica todo o nada; best_effort: se aplican las válidas',
+                          enum=['all_or_nothing', 'best_effort'], default='all_or_nothing', example='all_or_nothing')
+})
+
 pay_credit_balance_model = bank_ns.model('PayCreditBalance', {
     'amount': fields.Float(required=True, description='Monto a abonar a la deuda de la tarjeta', example=50)
 })
 
+statement_job_model = bank_ns.model('StatementJob', {
+    'from': fields.String(required=True, description='Primer día del estado de cuenta (AAAA-MM-DD)', example='2024-01-01'),
+    'to': fields.String(description='Último día, inclusive (por defecto hoy)', example='2024-12-31'),
+    'username': fields.String(description='Cliente del estado de cuenta (solo cajero; por defecto el autenticado)')
+})
+
 register_model = auth_ns.model('Register', {
     'nombres': fields.String(required=True, description='Nombres del cliente', example='Juan Carlos'),
     'apellidos': fields.String(required=True, description='Apellidos del cliente', example='García López'),
@@ -110,18 +129,30 @@ class Login(Resource):
     @auth_ns.doc('login')
     def post(self):
         """Inicia sesión y devuelve un token JWT."""
-        from .security import create_jwt, check_password
-        
-        data = api.payload
+        data = auth_ns.payload
         username = data.get("username")
         password = data.get("password")
         
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT id, password, role FROM bank.users WHERE username = %s", (username,))
-        user_data = cur.fetchone()
-        cur.close()
-        conn.close()
+        # Antes de consultar la base o calcular bcrypt: límites por IP y por username
+        try:
+            get_rate_limiter().check('login', ip=request.remote_addr, username=username)
+        except TooManyRequests as e:
+            log_event('WARNING', f"Login limitado para usuario '{username}': {e.description}", status_code=429)
+            raise
+        
+        def find_user(conn):
+            cur = conn.cursor()
+            try:
+                cur.execute(LOGIN_SQL, {'username': username})
+                return cur.fetchone()
+            finally:
+                cur.close()
+
+        user_data = run_read_only(find_user)
+        if user_data is None and DB_REPLICA_DSNS:
+            # Un cliente recién registrado puede no haber llegado todavía a la réplica
+            with db_connection() as conn:
+                user_data = find_user(conn)
         
         if user_data and check_password(user_data[1].tobytes(), password):
             user_id = user_data[0]
@@ -129,44 +160,38 @@ class Login(Resource):
             token = create_jwt(user_id, role, username)
             
             if not token:
-                from .custom_logger import log_event
                 log_event('ERROR', f"Error generando token para usuario '{username}'", status_code=500, user_id=user_id)
-                api.abort(500, "Error interno generando token de autenticación")
+                auth_ns.abort(500, "Error interno generando token de autenticación")
             
-            from .custom_logger import log_event
             log_event('INFO', f"Login exitoso para usuario '{username}'", status_code=200, user_id=user_id)
             return {"message": "Login exitoso", "token": token}, 200
         else:
-            from .custom_logger import log_event
             log_event('WARNING', f"Intento de login fallido para usuario '{username}'", status_code=401)
-            api.abort(401, "Credenciales inválidas.")
+            auth_ns.abort(401, "Credenciales inválidas.")
 
 @auth_ns.route('/logout')
 class Logout(Resource):
     @auth_ns.doc('logout')
     def post(self):
         """Cierra la sesión del lado del cliente (debe descartar el token)."""
-        from .custom_logger import log_event
-        
         auth_header = request.headers.get("Authorization", "")
         if not auth_header.startswith("Bearer "):
             log_event('WARNING', "Logout sin header válido", status_code=401, user_id='anonymous')
-            api.abort(401, "Token de autorización ausente o en formato incorrecto")
+            auth_ns.abort(401, "Token de autorización ausente o en formato incorrecto")
         
         token = auth_header.split(" ")[1]
         try:
-            import jwt
-            secret_key = app.config.get('SECRET_KEY')
+            secret_key = current_app.config.get('SECRET_KEY')
             payload = jwt.decode(token, secret_key, algorithms=['HS256'])
             user_id = payload.get('sub', 'unknown')
             log_event('INFO', "Logout exitoso", status_code=200, user_id=user_id)
             return {"message": "Logout exitoso. Por favor, descarte el token."}, 200
         except jwt.ExpiredSignatureError:
             log_event('WARNING', "Logout con token expirado", status_code=401, user_id='unknown')
-            api.abort(401, "El token ha expirado.")
+            auth_ns.abort(401, "El token ha expirado.")
         except jwt.InvalidTokenError:
             log_event('WARNING', "Logout con token inválido", status_code=401, user_id='unknown')
-            api.abort(401, "Token inválido.")
+            auth_ns.abort(401, "Token inválido.")
 
 @auth_ns.route('/register')
 class Register(Resource):
@@ -174,25 +199,27 @@ class Register(Resource):
     @auth_ns.doc('register')
     def post(self):
         """Registra un nuevo cliente con validaciones estrictas."""
-        from .validators import validar_cedula, validar_celular, validar_username, validar_password
-        from .security import hash_password
-        from .custom_logger import log_event
-        
-        data = api.payload
+        data = auth_ns.payload
         ip_registro = request.remote_addr
         
+        try:
+            get_rate_limiter().check('register', ip=ip_registro)
+        except TooManyRequests as e:
+            log_event('WARNING', f"Registro limitado: {e.description}", status_code=429, user_id='anonymous')
+            raise
+        
         # Fase de Validación
         if not validar_cedula(data['cedula']):
             log_event('WARNING', f"Registro fallido: cédula inválida {data['cedula']}", status_code=400, user_id='anonymous')
-            api.abort(400, "El número de cédula proporcionado no es válido.")
+            auth_ns.abort(400, "El número de cédula proporcionado no es válido.")
         
         if not validar_celular(data['celular']):
             log_event('WARNING', f"Registro fallido: celular inválido {data['celular']}", status_code=400, user_id='anonymous')
-            api.abort(400, "El número de celular debe tener 10 dígitos y empezar con 09.")
+            auth_ns.abort(400, "El número de celular debe tener 10 dígitos y empezar con 09.")
         
         if not validar_username(data['username'], data['nombres'], data['apellidos']):
             log_event('WARNING', f"Registro fallido: username inválido '{data['username']}'", status_code=400, user_id='anonymous')
-            api.abort(400, "El nombre de usuario es inválido o contiene información personal.")
+            auth_ns.abort(400, "El nombre de usuario es inválido o contiene información personal.")
         
         info_personal_para_pass = {
             'nombres': data['nombres'], 
@@ -201,87 +228,93 @@ class Register(Resource):
         }
         if not validar_password(data['password'], info_personal_para_pass):
             log_event('WARNING', f"Registro fallido: contraseña débil para usuario '{data['username']}'", status_code=400, user_id='anonymous')
-            api.abort(400, "La contraseña no cumple con los requisitos de seguridad.")
+            auth_ns.abort(400, "La contraseña no cumple con los requisitos de seguridad.")
         
-        # Verificar que username y email no existan previamente
-        conn_check = get_connection()
-        cur_check = conn_check.cursor()
-        try:
-            # Verificar username duplicado
-            cur_check.execute("SELECT id FROM bank.users WHERE username = %s", (data['username'],))
-            if cur_check.fetchone():
-                log_event('WARNING', f"Registro fallido: username duplicado '{data['username']}'", status_code=409, user_id='anonymous')
-                api.abort(409, "El nombre de usuario ya está en uso.")
-            
-            # Verificar email duplicado
-            cur_check.execute("SELECT id FROM bank.users WHERE email = %s", (data['email'],))
-            if cur_check.fetchone():
-                log_event('WARNING', f"Registro fallido: email duplicado '{data['email']}'", status_code=409, user_id='anonymous')
-                api.abort(409, "El correo electrónico ya está registrado.")
-        finally:
-            cur_check.close()
-            conn_check.close()
+        # Las verificaciones pueden leer de una réplica: si no vio un registro muy reciente,
+        # la restricción única del INSERT responde igual con 409
+        def check_duplicates(conn):
+            cur = conn.cursor()
+            try:
+                # Verificar que username y email no existan previamente
+                cur.execute("SELECT id FROM bank.users WHERE username = %s", (data['username'],))
+                if cur.fetchone():
+                    log_event('WARNING', f"Registro fallido: username duplicado '{data['username']}'", status_code=409, user_id='anonymous')
+                    auth_ns.abort(409, "El nombre de usuario ya está en uso.")
+                
+                cur.execute("SELECT id FROM bank.users WHERE email = %s", (data['email'],))
+                if cur.fetchone():
+                    log_event('WARNING', f"Registro fallido: email duplicado '{data['email']}'", status_code=409, user_id='anonymous')
+                    auth_ns.abort(409, "El correo electrónico ya está registrado.")
+                # Cerrar la transacción de lectura antes del hash (operación costosa)
+                conn.rollback()
+            finally:
+                cur.close()
+
+        run_read_only(check_duplicates)
+        
+        # 1. Hashear contraseña (fuera del try: un 503 del pool de bcrypt se propaga tal cual)
+        password_hash = hash_password(data['password'])
         
         # Fase de Persistencia (Transaccional)
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            # 1. Hashear contraseña
-            password_hash = hash_password(data['password'])
-            
-            # 2. Construir full_name y validar email
-            full_name = f"{data['nombres']} {data['apellidos']}"
-            email = data['email']
-            
-            # 3. Insertar en users
-            cur.execute(
-                "INSERT INTO bank.users (username, password, role, full_name, email) VALUES (%s, %s, 'cliente', %s, %s) RETURNING id",
-                (data['username'], password_hash, full_name, email)
-            )
-            user_id = cur.fetchone()[0]
-            
-            # 4. Insertar en clients
-            cur.execute(
-                """INSERT INTO bank.clients (user_id, nombres, apellidos, direccion, cedula, celular, ip_registro)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s)""",
-                (user_id, data['nombres'], data['apellidos'], data.get('direccion'), 
-                 data['cedula'], data['celular'], ip_registro)
-            )
-            
-            # 5. Crear cuenta y tarjeta por defecto
-            cur.execute("INSERT INTO bank.accounts (balance, user_id) VALUES (0, %s)", (user_id,))
-            cur.execute("INSERT INTO bank.credit_cards (limit_credit, balance, user_id) VALUES (1000, 0, %s)", (user_id,))
-            
-            conn.commit()
-            log_event('INFO', f"Nuevo cliente registrado exitosamente: {data['username']}", status_code=201, user_id=user_id)
-            return {"message": "Cliente registrado exitosamente."}, 201
-            
-        except Exception as e:
-            conn.rollback()
-            log_event('ERROR', f"Error en registro para {data['username']}: {e}", status_code=500)
-            
-            error_msg = str(e).lower()
-            if 'duplicate key value' in error_msg:
-                if 'username' in error_msg:
-                    api.abort(409, "El nombre de usuario ya está en uso.")
-                elif 'email' in error_msg:
-                    api.abort(409, "El correo electrónico ya está registrado.")
-                elif 'cedula' in error_msg:
-                    api.abort(409, "La cédula ya está registrada.")
-                else:
-                    api.abort(409, "Ya existe un registro con esos datos.")
-            api.abort(500, "Ocurrió un error interno durante el registro.")
-        finally:
-            cur.close()
-            conn.close()
-
-# ---------------- Token-Required Decorator ----------------
-# Import the new JWT-based token_required decorator and role validator
-from .security import token_required, requires_role
-from .custom_logger import log_event, log_endpoint
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                # 2. Construir full_name y validar email
+                full_name = f"{data['nombres']} {data['apellidos']}"
+                email = data['email']
+                
+                # 3. Insertar en users
+                cur.execute(
+                    "INSERT INTO bank.users (username, password, role, full_name, email) VALUES (%s, %s, 'cliente', %s, %s) RETURNING id",
+                    (data['username'], password_hash, full_name, email)
+                )
+                user_id = cur.fetchone()[0]
+                
+                # 4. Insertar en clients
+                cur.execute(
+                    """INSERT INTO bank.clients (user_id, nombres, apellidos, direccion, cedula, celular, ip_registro)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                    (user_id, data['nombres'], data['apellidos'], data.get('direccion'), 
+                     data['cedula'], data['celular'], ip_registro)
+                )
+                
+                # 5. Crear cuenta y tarjeta por defecto
+                cur.execute("INSERT INTO bank.accounts (balance, user_id) VALUES (0, %s)", (user_id,))
+                cur.execute("INSERT INTO bank.credit_cards (limit_credit, balance, user_id) VALUES (1000, 0, %s)", (user_id,))
+                
+                conn.commit()
+                # Sus primeras lecturas (saldo) no deben ir a una réplica que aún no tiene la cuenta
+                pin_to_primary(user_id)
+                log_event('INFO', f"Nuevo cliente registrado exitosamente: {data['username']}", status_code=201, user_id=user_id)
+                return {"message": "Cliente registrado exitosamente."}, 201
+                
+            except Exception as e:
+                conn.rollback()
+                log_event('ERROR', f"Error en registro para {data['username']}: {e}", status_code=500)
+                
+                error_msg = str(e).lower()
+                if 'duplicate key value' in error_msg:
+                    if 'username' in error_msg:
+                        auth_ns.abort(409, "El nombre de usuario ya está en uso.")
+                    elif 'email' in error_msg:
+                        auth_ns.abort(409, "El correo electrónico ya está registrado.")
+                    elif 'cedula' in error_msg:
+                        auth_ns.abort(409, "La cédula ya está registrada.")
+                    else:
+                        auth_ns.abort(409, "Ya existe un registro con esos datos.")
+                auth_ns.abort(500, "Ocurrió un error interno durante el registro.")
+            finally:
+                cur.close()
 
 # ---------------- Banking Operation Endpoints ----------------
 
+def _once_fetchone(conn, cur, sql, params):
+    """Ejecuta `sql` y devuelve su fila; con Idempotency-Key repetida, la fila guardada sin ejecutarla."""
+    def execute():
+        cur.execute(sql, params)
+        return cur.fetchone()
+    return once(conn, g.idempotency, execute)
+
 @bank_ns.route('/deposit')
 class Deposit(Resource):
     logging.debug("Entering....")
@@ -289,139 +322,474 @@ class Deposit(Resource):
     @bank_ns.doc('deposit')
     @token_required
     @requires_role('cajero')
+    @idempotent()
     @log_endpoint("Depósito")
     def post(self):
         """
         Realiza un depósito en la cuenta especificada.
         Se requiere el número de cuenta y el monto a depositar.
         """
-        data = api.payload
+        data = bank_ns.payload
         account_number = data.get("account_number")
         amount = data.get("amount", 0)
         user_id = g.user['id']
         
         if amount <= 0:
             log_event('WARNING', f"Intento de depósito inválido: amount={amount}", status_code=400, user_id=user_id)
-            api.abort(400, "El monto debe ser mayor que cero")
+            bank_ns.abort(400, "El monto debe ser mayor que cero")
         
-        conn = get_connection()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                # Acredita la cuenta (clave primaria) y registra el movimiento en el libro
+                result = _once_fetchone(conn, cur, DEPOSIT_SQL, {'account_id': account_number, 'amount': amount, 'cajero_id': user_id})
+                if not result:
+                    conn.rollback()
+                    log_event('ERROR', f"Cuenta no encontrada: {account_number}", status_code=404, user_id=user_id)
+                    bank_ns.abort(404, "Cuenta no encontrada")
+                new_balance = float(result[0])
+                conn.commit()
+                invalidate_balances(result[1])
+                schedule_fold()
+                return {"message": "Depósito exitoso", "new_balance": new_balance}, 200
+            finally:
+                cur.close()
+
+def _load_balance(user_id):
+    """Saldos de la cuenta y la tarjeta del usuario leídos de la base (None si no tiene cuenta)."""
+    def load(conn):
         cur = conn.cursor()
         try:
-            # Update the specified account using its account number (primary key)
-            cur.execute(
-                "UPDATE bank.accounts SET balance = balance + %s WHERE id = %s RETURNING balance",
-                (amount, account_number)
-            )
-            result = cur.fetchone()
-            if not result:
+            cur.execute(BALANCE_SQL, {'user_id': user_id})
+            row = cur.fetchone()
+            conn.rollback()
+        finally:
+            cur.close()
+        return row
+    return balance_from_row(run_read_only(load, user_id))
+
+@bank_ns.route('/balance')
+class Balance(Resource):
+    @bank_ns.doc('balance')
+    @token_required
+    def get(self):
+        """
+        Consulta el saldo de la cuenta, la deuda de la tarjeta y el crédito disponible del usuario autenticado.
+        Se sirve desde la caché de saldos del worker, invalidada por cada operación que los modifica.
+        """
+        user_id = g.user['id']
+        balance = cached_balance(user_id, lambda: _load_balance(user_id))
+        if balance is None:
+            log_event('ERROR', "Cuenta no encontrada para consulta de saldo", status_code=404, user_id=user_id)
+            bank_ns.abort(404, "Cuenta no encontrada")
+        return dict(balance), 200
+
+@bank_ns.route('/transactions')
+class Transactions(Resource):
+    @bank_ns.doc('transactions', params={
+        'limit': 'Movimientos por página (por defecto 50, máximo 200)',
+        'cursor': 'Valor next_cursor de la página anterior'
+    })
+    @token_required
+    def get(self):
+        """
+        Historial de movimientos del usuario autenticado, del más reciente al más antiguo.
+        Paginado por cursor: cada página cuesta lo mismo sin importar su profundidad.
+        """
+        user_id = g.user['id']
+        try:
+            limit = page_limit(request.args.get('limit'))
+            before_created_at, before_id = decode_cursor(request.args.get('cursor'))
+        except PaginationError as e:
+            log_event('WARNING', f"Paginación inválida en historial: {e}", status_code=400, user_id=user_id)
+            bank_ns.abort(400, str(e))
+        
+        def load(conn):
+            cur = conn.cursor()
+            try:
+                cur.execute(TRANSACTIONS_PAGE_SQL, {
+                    'user_id': user_id, 'before_created_at': before_created_at, 'before_id': before_id, 'limit': limit
+                })
+                rows = cur.fetchall()
                 conn.rollback()
-                log_event('ERROR', f"Cuenta no encontrada: {account_number}", status_code=404, user_id=user_id)
-                api.abort(404, "Cuenta no encontrada")
-            new_balance = float(result[0])
-            conn.commit()
-            return {"message": "Depósito exitoso", "new_balance": new_balance}, 200
+            finally:
+                cur.close()
+            return rows
+        return transactions_page(run_read_only(load, user_id), limit), 200
+
+def _statement_owner(username):
+    """user_id del estado de cuenta: el del usuario autenticado, u otro cliente si quien pide es cajero."""
+    user_id = g.user['id']
+    if not username or username == g.user['username']:
+        return user_id
+    if g.user['role'] != 'cajero':
+        log_event('WARNING', f"Estado de cuenta de otro usuario sin rol cajero: {username}", status_code=403, user_id=user_id)
+        bank_ns.abort(403, "Solo un cajero puede exportar el estado de cuenta de otro usuario")
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT id FROM bank.users WHERE username = %s", (username,))
+            row = cur.fetchone()
+            conn.rollback()
         finally:
             cur.close()
-            conn.close()
+    if row is None:
+        log_event('WARNING', f"Estado de cuenta de usuario inexistente: {username}", status_code=404, user_id=user_id)
+        bank_ns.abort(404, "Usuario no encontrado")
+    return row[0]
+
+def _statement_dates(date_from, date_to):
+    try:
+        return statement_dates(date_from, date_to)
+    except StatementError as e:
+        log_event('WARNING', f"Estado de cuenta inválido: {e}", status_code=400, user_id=g.user['id'])
+        bank_ns.abort(400, str(e))
+
+@bank_ns.route('/statement')
+class Statement(Resource):
+    @bank_ns.doc('statement', params={
+        'from': 'Primer día (AAAA-MM-DD)',
+        'to': 'Último día, inclusive (por defecto hoy)',
+        'username': 'Cliente del estado de cuenta (solo cajero)'
+    })
+    @token_required
+    @log_endpoint("Estado de cuenta")
+    def get(self):
+        """
+        Estado de cuenta en CSV, del movimiento más antiguo al más reciente, para un rango de días.
+        - Se lee con un cursor del lado del servidor y se envía en streaming (memoria constante).
+        - Se comprime con gzip si el cliente envía Accept-Encoding: gzip.
+        - Los rangos con demasiados movimientos se piden en POST /bank/statements/jobs.
+        """
+        user_id = g.user['id']
+        date_from, date_to = _statement_dates(request.args.get('from'), request.args.get('to'))
+        owner_id = _statement_owner(request.args.get('username'))
+        
+        # La conexión queda prestada hasta que termina el envío, no solo durante el handler
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            open_statement(conn, owner_id, date_from, date_to)
+        except StatementError as e:
+            pool.putconn(conn)
+            log_event('WARNING', f"Estado de cuenta demasiado grande para descarga en línea: {e}", status_code=400, user_id=user_id)
+            bank_ns.abort(400, str(e))
+        except BaseException:
+            pool.putconn(conn)
+            raise
+        
+        compress = request.accept_encodings['gzip'] > 0
+        encoder = StatementEncoder(compress)
+        ip_address = request.remote_addr
+        
+        def finished():
+            # Se llama al terminar el envío o si el cliente corta; revierte y libera el turno
+            pool.putconn(conn)
+            if encoder.finished:
+                log_event('INFO', f"Estado de cuenta enviado: {encoder.rows} movimientos", status_code=200, user_id=user_id, ip_address=ip_address)
+            else:
+                log_event('WARNING', f"Estado de cuenta interrumpido tras {encoder.rows} movimientos", status_code=200, user_id=user_id, ip_address=ip_address)
+        
+        headers = {
+            'Content-Disposition': f'attachment; filename="{statement_filename(date_from, date_to)}"',
+            'Vary': 'Accept-Encoding',
+        }
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+        body = ClosingIterator(iter_statement(conn, owner_id, date_from, date_to, encoder), [finished])
+        return Response(body, mimetype='text/csv', headers=headers)
+
+@bank_ns.route('/statements/jobs')
+class StatementJobs(Resource):
+    @bank_ns.expect(statement_job_model, validate=True)
+    @bank_ns.doc('statement_job')
+    @token_required
+    @idempotent()
+    @log_endpoint("Exportación de estado de cuenta")
+    def post(self):
+        """
+        Encola la exportación de un estado de cuenta de cualquier tamaño.
+        Un hilo de exportación escribe el archivo .csv.gz; su estado se consulta en status_url.
+        """
+        data = bank_ns.payload
+        date_from, date_to = _statement_dates(data.get('from'), data.get('to'))
+        owner_id = _statement_owner(data.get('username'))
+        with db_connection() as conn:
+            job = create_job(conn, g.user['id'], owner_id, date_from, date_to, g.idempotency)
+        job["message"] = "Exportación encolada"
+        return job, 202
+
+def _statement_job(job_id):
+    with db_connection() as conn:
+        job = get_job(conn, job_id, g.user['id'])
+    if job is None:
+        log_event('WARNING', f"Trabajo de exportación no encontrado: {job_id}", status_code=404, user_id=g.user['id'])
+        bank_ns.abort(404, "Trabajo de exportación no encontrado")
+    return job
+
+@bank_ns.route('/statements/jobs/<string:job_id>')
+class StatementJob(Resource):
+    @bank_ns.doc('statement_job_status')
+    @token_required
+    def get(self, job_id):
+        """Estado de un trabajo de exportación (queued, running, done o failed)."""
+        return _statement_job(job_id), 200
+
+@bank_ns.route('/statements/jobs/<string:job_id>/download')
+class StatementJobDownload(Resource):
+    @bank_ns.doc('statement_job_download')
+    @token_required
+    def get(self, job_id):
+        """Descarga el archivo .csv.gz de un trabajo de exportación terminado."""
+        job = _statement_job(job_id)
+        if job['status'] != 'done':
+            bank_ns.abort(409, f"La exportación no está lista (estado: {job['status']})")
+        try:
+            return send_file(
+                job_path(job['job_id']), mimetype='application/gzip', as_attachment=True,
+                download_name=statement_filename(job['from'], job['to'], compressed=True)
+            )
+        except FileNotFoundError:
+            log_event('ERROR', f"Archivo de exportación ausente: {job_id}", status_code=410, user_id=g.user['id'])
+            bank_ns.abort(410, "El archivo de la exportación ya no está disponible")
 
 @bank_ns.route('/withdraw')
 class Withdraw(Resource):
     @bank_ns.expect(withdraw_model, validate=True)
     @bank_ns.doc('withdraw')
     @token_required
+    @idempotent()
     @log_endpoint("Retiro")
     def post(self):
         """Realiza un retiro de la cuenta del usuario autenticado."""
-        data = api.payload
+        data = bank_ns.payload
         amount = data.get("amount", 0)
         user_id = g.user['id']
         
         if amount <= 0:
             log_event('WARNING', f"Intento de retiro inválido: amount={amount}", status_code=400, user_id=user_id)
-            api.abort(400, "El monto debe ser mayor que cero")
+            bank_ns.abort(400, "El monto debe ser mayor que cero")
         
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (user_id,))
-            row = cur.fetchone()
-            if not row:
-                log_event('ERROR', "Cuenta del usuario no encontrada para retiro", status_code=404, user_id=user_id)
-                api.abort(404, "Cuenta no encontrada")
-            current_balance = float(row[0])
-            if current_balance < amount:
-                log_event('WARNING', f"Fondos insuficientes: balance={current_balance}, requested={amount}", status_code=400, user_id=user_id)
-                api.abort(400, "Fondos insuficientes")
-            cur.execute("UPDATE bank.accounts SET balance = balance - %s WHERE user_id = %s RETURNING balance", (amount, user_id))
-            new_balance = float(cur.fetchone()[0])
-            conn.commit()
-            return {"message": "Retiro exitoso", "new_balance": new_balance}, 200
-        finally:
-            cur.close()
-            conn.close()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                # Verificación de fondos y débito en una sola sentencia (sin carrera check-then-act)
+                current_balance, new_balance = _once_fetchone(conn, cur, WITHDRAW_SQL, {'user_id': user_id, 'amount': amount})
+                conn.commit()
+                invalidate_balances(user_id)
+            finally:
+                cur.close()
+        
+        if current_balance is None:
+            log_event('ERROR', "Cuenta del usuario no encontrada para retiro", status_code=404, user_id=user_id)
+            bank_ns.abort(404, "Cuenta no encontrada")
+        if new_balance is None:
+            log_event('WARNING', f"Fondos insuficientes: balance={float(current_balance)}, requested={amount}", status_code=400, user_id=user_id)
+            bank_ns.abort(400, "Fondos insuficientes")
+        return {"message": "Retiro exitoso", "new_balance": float(new_balance)}, 200
 
 @bank_ns.route('/transfer')
 class Transfer(Resource):
     @bank_ns.expect(transfer_model, validate=True)
     @bank_ns.doc('transfer')
     @token_required
+    @idempotent()
     @log_endpoint("Transferencia")
     def post(self):
         """Transfiere fondos desde la cuenta del usuario autenticado a otra cuenta."""
-        data = api.payload
+        data = bank_ns.payload
         target_username = data.get("target_username")
         amount = data.get("amount", 0)
         user_id = g.user['id']
         
         if not target_username or amount <= 0:
             log_event('WARNING', f"Datos inválidos para transferencia: target={target_username}, amount={amount}", status_code=400, user_id=user_id)
-            api.abort(400, "Datos inválidos")
+            bank_ns.abort(400, "Datos inválidos")
         if target_username == g.user['username']:
             log_event('WARNING', f"Intento de transferencia a la misma cuenta", status_code=400, user_id=user_id)
-            api.abort(400, "No se puede transferir a la misma cuenta")
+            bank_ns.abort(400, "No se puede transferir a la misma cuenta")
         
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            # Check sender's balance
-            cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (g.user['id'],))
-            row = cur.fetchone()
-            if not row:
-                log_event('ERROR', "Cuenta del remitente no encontrada", status_code=404, user_id=user_id)
-                api.abort(404, "Cuenta del remitente no encontrada")
-            sender_balance = float(row[0])
-            if sender_balance < amount:
-                log_event('WARNING', f"Fondos insuficientes para transferencia: balance={sender_balance}, requested={amount}", status_code=400, user_id=user_id)
-                api.abort(400, "Fondos insuficientes")
-            
-            # Find target user
-            cur.execute("SELECT id FROM bank.users WHERE username = %s", (target_username,))
-            target_user = cur.fetchone()
-            if not target_user:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                # Búsqueda del destino, bloqueo ordenado, verificación de fondos y movimiento en un round trip
+                sender_balance, target_user_id, target_account_id, new_balance, _ = _once_fetchone(
+                    conn, cur, TRANSFER_SQL, {'sender_id': user_id, 'target_username': target_username, 'amount': amount}
+                )
+                conn.commit()
+                invalidate_balances(user_id, target_user_id)
+                schedule_fold()
+            except psycopg2.Error as e:
+                conn.rollback()
+                log_event('ERROR', f"Error durante transferencia: {str(e)}", status_code=500, user_id=user_id)
+                bank_ns.abort(500, "Ocurrió un error interno durante la transferencia")
+            finally:
+                cur.close()
+        
+        if sender_balance is None:
+            log_event('ERROR', "Cuenta del remitente no encontrada", status_code=404, user_id=user_id)
+            bank_ns.abort(404, "Cuenta del remitente no encontrada")
+        if new_balance is None:
+            if float(sender_balance) < amount:
+                log_event('WARNING', f"Fondos insuficientes para transferencia: balance={float(sender_balance)}, requested={amount}", status_code=400, user_id=user_id)
+                bank_ns.abort(400, "Fondos insuficientes")
+            if target_user_id is None:
                 log_event('ERROR', f"Usuario destino no encontrado: {target_username}", status_code=404, user_id=user_id)
-                api.abort(404, "Usuario destino no encontrado")
-            target_user_id = target_user[0]
+                bank_ns.abort(404, "Usuario destino no encontrado")
+            log_event('ERROR', f"Cuenta destino no encontrada para usuario: {target_username}", status_code=404, user_id=user_id)
+            bank_ns.abort(404, "Cuenta destino no encontrada")
+        return {"message": "Transferencia exitosa", "new_balance": float(new_balance)}, 200
+
+@bank_ns.route('/transfers/batch')
+class BatchTransfer(Resource):
+    @bank_ns.expect(batch_transfer_model, validate=True)
+    @bank_ns.doc('batch_transfer')
+    @token_required
+    @idempotent()
+    @log_endpoint("Transferencia por lotes")
+    def post(self):
+        """
+        Ejecuta un lote de transferencias desde la cuenta del usuario autenticado en una sola transacción.
+        - Resuelve todos los destinos en una consulta y bloquea las cuentas en orden de id.
+        - Aplica débitos y créditos agregados por cuenta en una sola sentencia.
+        - mode=all_or_nothing rechaza el lote completo si algún ítem falla; best_effort aplica los válidos.
+        """
+        data = bank_ns.payload
+        items = data.get("transfers") or []
+        mode = data.get("mode") or 'all_or_nothing'
+        user_id = g.user['id']
+        
+        if not items:
+            log_event('WARNING', "Lote de transferencias vacío", status_code=400, user_id=user_id)
+            bank_ns.abort(400, "El lote no contiene transferencias")
+        if len(items) > BATCH_TRANSFER_MAX_ITEMS:
+            log_event('WARNING', f"Lote de transferencias demasiado grande: {len(items)}", status_code=400, user_id=user_id)
+            bank_ns.abort(400, f"El lote admite como máximo {BATCH_TRANSFER_MAX_ITEMS} transferencias")
+        
+        usernames = sorted({item['target_username'] for item in items})
+        with db_connection() as conn:
+            cur = conn.cursor()
+            touched_user_ids = []
             
-            # Execute transfer
-            cur.execute("UPDATE bank.accounts SET balance = balance - %s WHERE user_id = %s", (amount, g.user['id']))
-            cur.execute("UPDATE bank.accounts SET balance = balance + %s WHERE user_id = %s", (amount, target_user_id))
-            cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (g.user['id'],))
-            new_balance = float(cur.fetchone()[0])
-            conn.commit()
-            return {"message": "Transferencia exitosa", "new_balance": new_balance}, 200
-        except Exception as e:
-            conn.rollback()
-            log_event('ERROR', f"Error durante transferencia: {str(e)}", status_code=500, user_id=user_id)
-            api.abort(500, "Ocurrió un error interno durante la transferencia")
-        finally:
-            cur.close()
-            conn.close()
+            def apply_batch():
+                cur.execute(BATCH_TRANSFER_LOCK_SQL, {'sender_id': user_id, 'usernames': usernames})
+                targets = {}
+                target_user_ids = {}
+                sender_account_id = sender_balance = None
+                for username, target_user_id, account_id, balance in cur.fetchall():
+                    if username is None:
+                        sender_account_id, sender_balance = account_id, balance
+                    else:
+                        targets[username] = account_id
+                        target_user_ids[username] = target_user_id
+                
+                if sender_account_id is None:
+                    conn.rollback()
+                    log_event('ERROR', "Cuenta del remitente no encontrada", status_code=404, user_id=user_id)
+                    bank_ns.abort(404, "Cuenta del remitente no encontrada")
+                
+                results, deltas, remaining = evaluate_batch_transfers(items, targets, sender_balance, g.user['username'])
+                failed = sum(1 for r in results if r["status"] == "rejected")
+                if failed and mode == 'all_or_nothing':
+                    # Se libera la cuenta antes de responder; el rechazo no queda guardado con la clave
+                    conn.rollback()
+                    for r in results:
+                        if r["status"] == "applied":
+                            r["status"] = "not_applied"
+                    log_event('WARNING', f"Lote rechazado: {failed} de {len(items)} transferencias inválidas", status_code=400, user_id=user_id)
+                    return {
+                        "message": "Lote rechazado: ninguna transferencia fue aplicada",
+                        "mode": mode,
+                        "applied": 0,
+                        "rejected": failed,
+                        "results": results
+                    }, 400
+                
+                if deltas:
+                    deltas[sender_account_id] -= sender_balance - remaining
+                    account_ids = list(deltas)
+                    cur.execute(BATCH_TRANSFER_APPLY_SQL, {
+                        'account_ids': account_ids,
+                        'deltas': [deltas[account_id] for account_id in account_ids],
+                        **batch_movements(results, targets, target_user_ids, user_id, sender_account_id)
+                    })
+                    new_balance = dict(cur.fetchall())[sender_account_id]
+                else:
+                    new_balance = sender_balance
+                touched_user_ids.extend(target_user_ids.values())
+                return {
+                    "message": "Lote procesado" if failed else "Lote aplicado exitosamente",
+                    "mode": mode,
+                    "applied": len(items) - failed,
+                    "rejected": failed,
+                    "total_amount": float(sender_balance - remaining),
+                    "new_balance": float(new_balance),
+                    "results": results
+                }, 200
+            
+            try:
+                body, status = once(conn, g.idempotency, apply_batch)
+                if status != 200:
+                    conn.rollback()
+                    return body, status
+                conn.commit()
+                invalidate_balances(user_id, *touched_user_ids)
+            except psycopg2.Error as e:
+                conn.rollback()
+                log_event('ERROR', f"Error durante transferencia por lotes: {str(e)}", status_code=500, user_id=user_id)
+                bank_ns.abort(500, "Ocurrió un error interno durante la transferencia por lotes")
+            finally:
+                cur.close()
+        return body, status
+
+@bank_ns.route('/deposits/bulk')
+class BulkDeposit(Resource):
+    @bank_ns.doc('bulk_deposit', params={'format': 'csv o jsonl (por defecto se deduce del Content-Type)'})
+    @token_required
+    @requires_role('cajero')
+    @idempotent(body=False)
+    @log_endpoint("Depósito masivo")
+    def post(self):
+        """
+        Aplica depósitos masivos enviados en el cuerpo como CSV (account_number,amount) o JSON lines.
+        - El cuerpo se lee en streaming y se carga con COPY a una tabla temporal (memoria constante).
+        - Las cuentas se bloquean en orden de id y se acreditan con un único UPDATE agregado por cuenta.
+        - Las filas inválidas o con cuentas inexistentes se informan como rechazadas; el resto se aplica.
+        """
+        user_id = g.user['id']
+        fmt = (request.args.get('format') or '').lower()
+        if not fmt:
+            fmt = 'jsonl' if 'json' in (request.mimetype or '') else 'csv'
+        if fmt == 'csv':
+            records = iter_csv_records(request.stream, ('account_number', 'amount'))
+        elif fmt == 'jsonl':
+            records = iter_jsonl_records(request.stream)
+        else:
+            log_event('WARNING', f"Formato de depósito masivo no soportado: {fmt}", status_code=400, user_id=user_id)
+            bank_ns.abort(400, "Formato no soportado: use csv o jsonl")
+        
+        with db_connection() as conn:
+            try:
+                # Con Idempotency-Key repetida se devuelve el resumen guardado sin leer el cuerpo
+                summary = once(conn, g.idempotency, lambda: apply_bulk_deposits(conn, records, user_id))
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                log_event('ERROR', f"Error durante depósito masivo: {str(e)}", status_code=500, user_id=user_id)
+                bank_ns.abort(500, "Ocurrió un error interno durante el depósito masivo")
+        # Sin la lista de cuentas acreditadas (pueden ser miles) se invalidan todos los saldos
+        invalidate_balances('*')
+        
+        log_event('INFO', f"Depósito masivo: {summary['rows_applied']} filas aplicadas, {summary['rows_rejected']} rechazadas", status_code=200, user_id=user_id)
+        summary["message"] = "Depósitos masivos procesados" if summary["rows_rejected"] else "Depósitos masivos aplicados"
+        return summary, 200
 
 @bank_ns.route('/credit-payment')
 class CreditPayment(Resource):
     @bank_ns.expect(credit_payment_model, validate=True)
     @bank_ns.doc('credit_payment')
     @token_required
+    @idempotent()
     @log_endpoint("Pago a crédito")
     def post(self):
         """
@@ -430,57 +798,53 @@ class CreditPayment(Resource):
         - Aumenta la deuda de la tarjeta de crédito.
         - NO descuenta de la cuenta de ahorros (esa sería doble cobro).
         """
-        data = api.payload
+        data = bank_ns.payload
         amount = data.get("amount", 0)
         user_id = g.user['id']
         
         if amount <= 0:
             log_event('WARNING', f"Monto inválido para compra a crédito: {amount}", status_code=400, user_id=user_id)
-            api.abort(400, "El monto debe ser mayor que cero")
+            bank_ns.abort(400, "El monto debe ser mayor que cero")
         
-        conn = get_connection()
-        cur = conn.cursor()
-        try:
-            # Verificar que la tarjeta de crédito exista y obtener límite y deuda actual
-            cur.execute("SELECT limit_credit, balance FROM bank.credit_cards WHERE user_id = %s", (user_id,))
-            row = cur.fetchone()
-            if not row:
-                log_event('ERROR', "Tarjeta de crédito no encontrada", status_code=404, user_id=user_id)
-                api.abort(404, "Tarjeta de crédito no encontrada")
-            
-            limit_credit = float(row[0])
-            current_debt = float(row[1])
-            available_credit = limit_credit - current_debt
-            
-            if amount > available_credit:
-                log_event('WARNING', f"Límite de crédito excedido: available={available_credit}, requested={amount}", status_code=400, user_id=user_id)
-                api.abort(400, f"Límite de crédito insuficiente. Disponible: {available_credit}")
-            
-            # Solo aumentar la deuda de la tarjeta (NO tocar la cuenta de ahorros)
-            cur.execute("UPDATE bank.credit_cards SET balance = balance + %s WHERE user_id = %s RETURNING balance", (amount, user_id))
-            new_credit_balance = float(cur.fetchone()[0])
-            new_available_credit = limit_credit - new_credit_balance
-            
-            conn.commit()
-            return {
-                "message": "Compra a crédito exitosa",
-                "amount_charged": amount,
-                "credit_card_debt": new_credit_balance,
-                "available_credit": new_available_credit
-            }, 200
-        except Exception as e:
-            conn.rollback()
-            log_event('ERROR', f"Error procesando pago a crédito: {str(e)}", status_code=500, user_id=user_id)
-            api.abort(500, "Ocurrió un error interno procesando la compra a crédito")
-        finally:
-            cur.close()
-            conn.close()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                # Verificación del límite y aumento de la deuda en una sola sentencia
+                limit_credit, current_debt, new_credit_balance = _once_fetchone(
+                    conn, cur, CREDIT_PAYMENT_SQL, {'user_id': user_id, 'amount': amount}
+                )
+                conn.commit()
+                invalidate_balances(user_id)
+            except psycopg2.Error as e:
+                conn.rollback()
+                log_event('ERROR', f"Error procesando pago a crédito: {str(e)}", status_code=500, user_id=user_id)
+                bank_ns.abort(500, "Ocurrió un error interno procesando la compra a crédito")
+            finally:
+                cur.close()
+        
+        if limit_credit is None:
+            log_event('ERROR', "Tarjeta de crédito no encontrada", status_code=404, user_id=user_id)
+            bank_ns.abort(404, "Tarjeta de crédito no encontrada")
+        limit_credit = float(limit_credit)
+        if new_credit_balance is None:
+            available_credit = limit_credit - float(current_debt)
+            log_event('WARNING', f"Límite de crédito excedido: available={available_credit}, requested={amount}", status_code=400, user_id=user_id)
+            bank_ns.abort(400, f"Límite de crédito insuficiente. Disponible: {available_credit}")
+        
+        new_credit_balance = float(new_credit_balance)
+        return {
+            "message": "Compra a crédito exitosa",
+            "amount_charged": amount,
+            "credit_card_debt": new_credit_balance,
+            "available_credit": limit_credit - new_credit_balance
+        }, 200
 
 @bank_ns.route('/pay-credit-balance')
 class PayCreditBalance(Resource):
     @bank_ns.expect(pay_credit_balance_model, validate=True)
     @bank_ns.doc('pay_credit_balance')
     @token_required
+    @idempotent()
     @log_endpoint("Abono tarjeta")
     def post(self):
         """
@@ -488,66 +852,172 @@ class PayCreditBalance(Resource):
         - Descuenta el monto (o el máximo posible) de la cuenta.
         - Reduce la deuda de la tarjeta de crédito.
         """
-        data = api.payload
+        data = bank_ns.payload
         amount = data.get("amount", 0)
         user_id = g.user['id']
         
         if amount <= 0:
             log_event('WARNING', f"Monto inválido para abono a tarjeta: {amount}", status_code=400, user_id=user_id)
-            api.abort(400, "El monto debe ser mayor que cero")
+            bank_ns.abort(400, "El monto debe ser mayor que cero")
         
-        conn = get_connection()
-        cur = conn.cursor()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                # Verificación de fondos, débito de la cuenta y abono a la tarjeta en un round trip
+                account_balance, card_id, new_account_balance, new_credit_debt = _once_fetchone(
+                    conn, cur, PAY_CREDIT_BALANCE_SQL, {'user_id': user_id, 'amount': amount}
+                )
+                conn.commit()
+                invalidate_balances(user_id)
+            except psycopg2.Error as e:
+                conn.rollback()
+                log_event('ERROR', f"Error procesando abono a tarjeta: {str(e)}", status_code=500, user_id=user_id)
+                bank_ns.abort(500, "Ocurrió un error interno procesando el pago de deuda")
+            finally:
+                cur.close()
+        
+        if account_balance is None:
+            log_event('ERROR', "Cuenta no encontrada para abono a tarjeta", status_code=404, user_id=user_id)
+            bank_ns.abort(404, "Cuenta no encontrada")
+        if float(account_balance) < amount:
+            log_event('WARNING', f"Fondos insuficientes para abono: balance={float(account_balance)}, requested={amount}", status_code=400, user_id=user_id)
+            bank_ns.abort(400, "Fondos insuficientes en la cuenta")
+        if card_id is None:
+            log_event('ERROR', "Tarjeta de crédito no encontrada", status_code=404, user_id=user_id)
+            bank_ns.abort(404, "Tarjeta de crédito no encontrada")
+        return {
+            "message": "Pago de deuda de tarjeta exitoso",
+            "account_balance": float(new_account_balance),
+            "credit_card_debt": float(new_credit_debt)
+        }, 200
+
+# ---------------- Operational Endpoints ----------------
+
+@ops_ns.route('/stats')
+class Stats(Resource):
+    @ops_ns.doc('stats')
+    @token_required
+    @requires_role('cajero')
+    def get(self):
+        """Devuelve estadísticas del worker actual (pool de conexiones, sentencias preparadas, escritor de logs, bcrypt, tokens, saldos, exportaciones, idempotencia, límites de intentos, cuentas calientes)."""
+        return worker_stats(), 200
+
+@ops_ns.route('/security-log')
+class SecurityLog(Resource):
+    @ops_ns.doc('security_log', params={
+        'user_id': 'USUARIO_ID exacto (p. ej. 42 o anonymous)',
+        'ip': 'IP exacta',
+        'from': 'Desde, inclusivo (AAAA-MM-DD[ HH:MM[:SS]])',
+        'to': 'Hasta, exclusivo (AAAA-MM-DD[ HH:MM[:SS]])',
+        'level': 'INFO, WARNING, ERROR...',
+        'limit': 'Máximo de entradas (por defecto y como máximo LOG_QUERY_MAX_RESULTS)'
+    })
+    @token_required
+    @requires_role('cajero')
+    def get(self):
+        """
+        Busca entradas de security_events.log, de la más antigua a la más reciente.
+        Usa los índices de los segmentos comprimidos para descomprimir solo los bloques candidatos.
+        """
+        user_id = g.user['id']
+        args = request.args
         try:
-            # Check account funds
-            cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (user_id,))
-            row = cur.fetchone()
-            if not row:
-                log_event('ERROR', "Cuenta no encontrada para abono a tarjeta", status_code=404, user_id=user_id)
-                api.abort(404, "Cuenta no encontrada")
-            account_balance = float(row[0])
-            if account_balance < amount:
-                log_event('WARNING', f"Fondos insuficientes para abono: balance={account_balance}, requested={amount}", status_code=400, user_id=user_id)
-                api.abort(400, "Fondos insuficientes en la cuenta")
-            
-            # Get current credit card debt
-            cur.execute("SELECT balance FROM bank.credit_cards WHERE user_id = %s", (user_id,))
-            row = cur.fetchone()
-            if not row:
-                log_event('ERROR', "Tarjeta de crédito no encontrada", status_code=404, user_id=user_id)
-                api.abort(404, "Tarjeta de crédito no encontrada")
-            credit_debt = float(row[0])
-            payment = min(amount, credit_debt)
-            
-            cur.execute("UPDATE bank.accounts SET balance = balance - %s WHERE user_id = %s", (payment, user_id))
-            cur.execute("UPDATE bank.credit_cards SET balance = balance - %s WHERE user_id = %s", (payment, user_id))
-            cur.execute("SELECT balance FROM bank.accounts WHERE user_id = %s", (user_id,))
-            new_account_balance = float(cur.fetchone()[0])
-            cur.execute("SELECT balance FROM bank.credit_cards WHERE user_id = %s", (user_id,))
-            new_credit_debt = float(cur.fetchone()[0])
-            conn.commit()
-            return {
-                "message": "Pago de deuda de tarjeta exitoso",
-                "account_balance": new_account_balance,
-                "credit_card_debt": new_credit_debt
-            }, 200
-        except Exception as e:
-            conn.rollback()
-            log_event('ERROR', f"Error procesando abono a tarjeta: {str(e)}", status_code=500, user_id=user_id)
-            api.abort(500, "Ocurrió un error interno procesando el pago de deuda")
-        finally:
-            cur.close()
-            conn.close()
+            result = query_security_log(
+                user_id=args.get('user_id'), ip=args.get('ip'), since=args.get('from'),
+                until=args.get('to'), level=args.get('level'), limit=args.get('limit')
+            )
+        except LogQueryError as e:
+            log_event('WARNING', f"Consulta de log de seguridad inválida: {e}", status_code=400, user_id=user_id)
+            ops_ns.abort(400, str(e))
+        log_event('INFO', f"Consulta de log de seguridad: {dict(args)} -> {len(result['entries'])} entradas", status_code=200, user_id=user_id)
+        return result, 200
+
+def worker_stats():
+    return {
+        "db_pool": pool_stats(),
+        "replicas": replica_stats(),
+        "prepared_statements": prepared_statement_stats(),
+        "security_log": log_stats(),
+        "bcrypt": bcrypt_stats(),
+        "token_cache": token_cache_stats(),
+        "balance_cache": balance_cache_stats(),
+        "statement_exports": export_stats(),
+        "idempotency": idempotency_stats(),
+        "rate_limit": rate_limit_stats(),
+        "hot_accounts": hot_account_stats()
+    }
+
+register_collector(worker_stats)
+
+# ---------------- Métricas ----------------
+
+_RULE_ARGUMENT_RE = re.compile(r'<(?:[^<>:]+:)?([^<>]+)>')
+
+@lru_cache(maxsize=None)
+def _endpoint_label(rule):
+    """Plantilla de la ruta como etiqueta: /bank/statements/jobs/<string:job_id> -> .../{job_id}."""
+    return _RULE_ARGUMENT_RE.sub(r'{\1}', rule)
+
+def _metrics_before_request():
+    g.metrics_started = time.perf_counter()
+    request_started()
+
+def _metrics_after_request(response):
+    started = g.get('metrics_started')
+    if started is not None:
+        rule = request.url_rule
+        endpoint = _endpoint_label(rule.rule) if rule is not None else 'unmatched'
+        request_finished(endpoint, request.method, response.status_code, time.perf_counter() - started)
+    return response
+
+def _metrics_teardown_request(exc):
+    if g.get('metrics_started') is not None:
+        request_done()
+
+def metrics():
+    """Métricas de todos los workers en formato de texto de Prometheus."""
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+# ---------------- Perfilado ----------------
+
+def _profile_before_request():
+    reason = wants_profile(request.headers.get(PROFILE_HEADER), request.headers.get("Authorization"),
+                           current_app.config.get('SECRET_KEY'))
+    if reason:
+        g.profile = start_profile(request.method, request.path, requested=reason == 'requested')
+
+def _profile_after_request(response):
+    session = g.get('profile')
+    if session is not None:
+        rule = request.url_rule
+        endpoint = _endpoint_label(rule.rule) if rule is not None else 'unmatched'
+        profile_id = stop_profile(session, endpoint, response.status_code)
+        # Las solicitudes de la muestra al azar no revelan el id a su cliente
+        if session.requested:
+            response.headers[PROFILE_ID_HEADER] = profile_id
+    return response
+
+def _profile_teardown_request(exc):
+    session = g.get('profile')
+    if session is not None:
+        discard_profile(session)
 
 # ---------------- Global Exception Handler ----------------
 
-@app.errorhandler(Exception)
+def handle_pool_timeout(e):
+    """El pool de conexiones está saturado: se responde 503 para que el cliente reintente."""
+    user_id = getattr(g, 'user', {}).get('id', 'anonymous') if hasattr(g, 'user') else 'anonymous'
+    log_event('ERROR', f"Pool de conexiones agotado: {e}", status_code=503, user_id=user_id)
+    return {"message": "Servicio temporalmente saturado. Intente nuevamente."}, 503, {'Retry-After': '1'}
+
+def handle_stale_prepared_statement(e):
+    """Un cambio de esquema abortó una transacción que no se pudo repetir: 503 para que el cliente reintente."""
+    user_id = getattr(g, 'user', {}).get('id', 'anonymous') if hasattr(g, 'user') else 'anonymous'
+    log_event('ERROR', f"Sentencia preparada obsoleta: {e}", status_code=503, user_id=user_id)
+    return {"message": "Servicio temporalmente no disponible. Intente nuevamente."}, 503, {'Retry-After': '1'}
+
 def handle_uncaught_exception(e):
     """Manejador global para excepciones no capturadas."""
-    from flask import jsonify
-    from werkzeug.exceptions import HTTPException
-    from .custom_logger import log_event
-    
     user_id = getattr(g, 'user', {}).get('id', 'anonymous') if hasattr(g, 'user') else 'anonymous'
     
     if isinstance(e, HTTPException):
@@ -559,10 +1029,80 @@ def handle_uncaught_exception(e):
     log_event('ERROR', f"Excepción no manejada: {str(e)}", status_code=500, user_id=user_id)
     return jsonify({"message": "Error interno del servidor"}), 500
 
-@app.before_first_request
-def initialize_db():
-    init_db()
+# ---------------- Application Factory ----------------
+
+def _configure_logging():
+    logging.basicConfig(
+         filename="app.log",
+         level=logging.DEBUG,
+         encoding="utf-8",
+         filemode="a",
+         format="{asctime} - {levelname} - {message}",
+         style="{",
+         datefmt="%Y-%m-%d %H:%M",
+    )
+
+def create_app(config=None):
+    """
+    Construye la aplicación: configuración, API con sus namespaces y manejadores de error.
+    No abre conexiones ni hilos, de modo que es seguro llamarla en el master de gunicorn
+    con preload_app; cada worker se prepara después del fork con `warm_worker`.
+    """
+    _configure_logging()
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = resolve_secret_key()
+    if config:
+        app.config.update(config)
+    
+    api = Api(
+        app,
+        version='1.0',
+        title='Core Bancario API',
+        description='API para operaciones bancarias, incluyendo autenticación y operaciones de cuenta.',
+        doc='/swagger',  # Swagger UI endpoint
+        authorizations=authorizations,
+        security='Bearer'
+    )
+    api.add_namespace(auth_ns)
+    api.add_namespace(bank_ns)
+    api.add_namespace(ops_ns)
+    
+    api.errorhandler(PoolTimeout)(handle_pool_timeout)
+    api.errorhandler(StalePreparedStatement)(handle_stale_prepared_statement)
+    app.register_error_handler(Exception, handle_uncaught_exception)
+    # Particiones próximas del libro de movimientos aunque no haya despliegues (app/ledger.py)
+    app.before_request(schedule_partitions)
+    if METRICS_ENABLED:
+        app.before_request(_metrics_before_request)
+        app.after_request(_metrics_after_request)
+        app.teardown_request(_metrics_teardown_request)
+        app.add_url_rule('/metrics', 'metrics', metrics)
+    if PROFILE_ENABLED:
+        app.before_request(_profile_before_request)
+        app.after_request(_profile_after_request)
+        app.teardown_request(_profile_teardown_request)
+    if TRUSTED_PROXY_HOPS > 0:
+        # remote_addr (límite de intentos, logs, ip_registro) pasa a ser la IP del cliente
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+    return app
+
+def warm_worker(app):
+    """
+    Prepara un worker recién creado antes de que acepte tráfico: abre las conexiones mínimas
+    del pool, arranca el escritor de logs y el pool de bcrypt, retoma los trabajos de
+    exportación pendientes y resuelve una petición interna para que el primer cliente no pague
+    la inicialización perezosa de Flask. Devuelve los segundos empleados.
+    """
+    started = time.monotonic()
+    get_pool().warm()
+    log_stats()
+    bcrypt_stats()
+    get_job_runner().wake()
+    with app.test_client() as client:
+        client.get('/swagger.json')
+    return time.monotonic() - started
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=True)
-
@@ -0,0 +1,370 @@
+# app/metrics.py
+"""
+Métricas en formato de texto de Prometheus para GET /metrics, agregadas entre los workers.
+
+Cada proceso escribe sus series en un archivo propio mapeado en memoria
+(METRICS_DIR/metrics-<pid>.db, en /dev/shm por defecto): una lista de entradas
+[largo de la clave][clave JSON][valor float64] que solo crece. Registrar una observación
+es buscar el offset de la serie en un dict y escribir 8 bytes bajo un lock del proceso;
+no hay locks entre procesos. Al responder /metrics el worker lee los archivos de todos y
+suma: contadores e histogramas de todos los procesos (también los que ya terminaron),
+gauges solo de los procesos vivos.
+
+Series:
+- corebank_http_requests_total / corebank_http_request_duration_seconds: por endpoint
+  (plantilla de la ruta), método y código de estado.
+- corebank_http_requests_in_flight: solicitudes en curso.
+- corebank_component_duration_seconds: tiempo en PostgreSQL, bcrypt y JWT por llamada.
+- corebank_worker_*{pid}: lo que /ops/stats informa de cada worker (pool de conexiones,
+  cachés, bcrypt, log, idempotencia, límites), publicado cada METRICS_PUBLISH_INTERVAL s.
+
+El directorio se vacía al arrancar gunicorn (on_starting en gunicorn.conf.py).
+"""
+import bisect
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from functools import wraps
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'corebank-metrics'
+)
+# Segundos entre publicaciones de las estadísticas del worker (corebank_worker_*)
+METRICS_PUBLISH_INTERVAL = float(os.environ.get('METRICS_PUBLISH_INTERVAL', '1'))
+
+def _buckets(value):
+    return tuple(sorted(float(bound) for bound in value.split(',')))
+
+# Límites superiores (segundos) de los histogramas
+HTTP_BUCKETS = _buckets(os.environ.get(
+    'METRICS_HTTP_BUCKETS', '0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10'
+))
+COMPONENT_BUCKETS = _buckets(os.environ.get(
+    'METRICS_COMPONENT_BUCKETS', '0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5'
+))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Familias: tipo, ayuda, buckets (histogramas)
+FAMILIES = {
+    'corebank_http_requests_total': (
+        'counter', 'Solicitudes HTTP atendidas por endpoint, método y código de estado.', None),
+    'corebank_http_request_duration_seconds': (
+        'histogram', 'Duración de las solicitudes HTTP hasta armar la respuesta.', HTTP_BUCKETS),
+    'corebank_http_requests_in_flight': (
+        'gauge', 'Solicitudes HTTP en curso.', None),
+    'corebank_component_duration_seconds': (
+        'histogram', 'Tiempo por llamada en PostgreSQL, bcrypt y JWT.', COMPONENT_BUCKETS),
+}
+WORKER_PREFIX = 'corebank_worker_'
+_WORKER_HELP = 'Estadística del worker indicado por pid (ver /ops/stats).'
+
+_HEADER = struct.Struct('=Q')   # bytes usados del archivo
+_LENGTH = struct.Struct('=I')
+_VALUE = struct.Struct('=d')
+_INITIAL_SIZE = 64 * 1024
+
+def _is_live(name):
+    """Gauges: se suman solo los de procesos vivos."""
+    return name.startswith(WORKER_PREFIX) or FAMILIES.get(name, ('counter',))[0] == 'gauge'
+
+def _key(raw):
+    """Clave JSON de un archivo -> (nombre, etiquetas[, bucket]), la forma que usan los escritores."""
+    name, labels, *bucket = json.loads(raw)
+    return (name, tuple(tuple(pair) for pair in labels), *bucket)
+
+def _entries(data):
+    """Recorre (clave, offset del valor, valor) de un archivo de métricas."""
+    used = _HEADER.unpack_from(data, 0)[0] if len(data) >= _HEADER.size else 0
+    pos = _HEADER.size
+    while pos < min(used, len(data)):
+        length = _LENGTH.unpack_from(data, pos)[0]
+        key = bytes(data[pos + _LENGTH.size:pos + _LENGTH.size + length])
+        pos += _LENGTH.size + length
+        pos += -pos % 8
+        yield key, pos, _VALUE.unpack_from(data, pos)[0]
+        pos += _VALUE.size
+
+class _ProcessFile:
+    """Series del proceso actual en METRICS_DIR/metrics-<pid>.db; un solo escritor por proceso."""
+
+    def __init__(self, directory):
+        self.pid = os.getpid()
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"metrics-{self.pid}.db")
+        self._lock = threading.Lock()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = max(os.fstat(self._fd).st_size, _INITIAL_SIZE)
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._positions = {}
+        self._used = _HEADER.size
+        for raw, offset, _ in _entries(self._map):
+            # El pid se reutilizó: se conservan los contadores del proceso anterior, no sus gauges
+            key = _key(raw)
+            self._positions[key] = offset
+            self._used = offset + _VALUE.size
+            if _is_live(key[0]):
+                _VALUE.pack_into(self._map, offset, 0.0)
+        _HEADER.pack_into(self._map, 0, self._used)
+
+    def _offset(self, key):
+        """Offset del valor de `key`, agregando la entrada si es nueva. Se llama con el lock tomado."""
+        offset = self._positions.get(key)
+        if offset is not None:
+            return offset
+        encoded = json.dumps(key, separators=(',', ':')).encode()
+        start = self._used
+        offset = start + _LENGTH.size + len(encoded)
+        offset += -offset % 8
+        end = offset + _VALUE.size
+        if end > len(self._map):
+            size = len(self._map)
+            while size < end:
+                size *= 2
+            os.ftruncate(self._fd, size)
+            self._map.close()
+            self._map = mmap.mmap(self._fd, size)
+        _LENGTH.pack_into(self._map, start, len(encoded))
+        self._map[start + _LENGTH.size:start + _LENGTH.size + len(encoded)] = encoded
+        _VALUE.pack_into(self._map, offset, 0.0)
+        # La entrada queda completa antes de que los lectores la vean
+        self._used = end
+        _HEADER.pack_into(self._map, 0, end)
+        self._positions[key] = offset
+        return offset
+
+    def add(self, key, amount):
+        with self._lock:
+            offset = self._offset(key)
+            _VALUE.pack_into(self._map, offset, _VALUE.unpack_from(self._map, offset)[0] + amount)
+
+    def set(self, key, value):
+        with self._lock:
+            _VALUE.pack_into(self._map, self._offset(key), value)
+
+    def observe(self, name, labels, buckets, value):
+        """Histograma: incrementa su bucket (no acumulado; se acumula al leer) y la suma."""
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            for key, amount in (((name + '_bucket', labels, index), 1), ((name + '_sum', labels), value)):
+                offset = self._offset(key)
+                _VALUE.pack_into(self._map, offset, _VALUE.unpack_from(self._map, offset)[0] + amount)
+
+_file = None
+_file_lock = threading.Lock()
+_collectors = []
+_publisher = None
+
+def _after_fork_in_child():
+    global _file_lock, _publisher
+    _file_lock = threading.Lock()
+    _publisher = None
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def _process_file():
+    """Archivo del proceso actual; después de un fork() el hijo abre el suyo."""
+    global _file
+    current = _file
+    if current is not None and current.pid == os.getpid():
+        return current
+    with _file_lock:
+        if _file is None or _file.pid != os.getpid():
+            _file = _ProcessFile(METRICS_DIR)
+            _start_publisher()
+        return _file
+
+def _labels(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def inc(name, amount=1, **labels):
+    if METRICS_ENABLED:
+        _process_file().add((name, _labels(labels)), amount)
+
+def set_gauge(name, value, **labels):
+    if METRICS_ENABLED:
+        _process_file().set((name, _labels(labels)), value)
+
+def observe(name, value, **labels):
+    if METRICS_ENABLED:
+        _process_file().observe(name, _labels(labels), FAMILIES[name][2], value)
+
+def observe_component(component, seconds):
+    """Suma una llamada a PostgreSQL, bcrypt o JWT al histograma de componentes."""
+    observe('corebank_component_duration_seconds', seconds, component=component)
+
+def timed_call(component):
+    """Decorador: registra la duración de cada llamada como `component`."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                observe_component(component, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+def request_started():
+    inc('corebank_http_requests_in_flight')
+
+def request_finished(endpoint, method, status, seconds):
+    """Cuenta la solicitud con su duración; `endpoint` es la plantilla de la ruta ('unmatched' si no hubo)."""
+    if not METRICS_ENABLED:
+        return
+    store = _process_file()
+    labels = _labels({'endpoint': endpoint, 'method': method, 'status': status})
+    store.add(('corebank_http_requests_total', labels), 1)
+    store.observe('corebank_http_request_duration_seconds', labels, HTTP_BUCKETS, seconds)
+
+def request_done():
+    """Fin de una solicitud contada por request_started (haya terminado bien o no)."""
+    inc('corebank_http_requests_in_flight', -1)
+
+# ---------------- Estadísticas del worker ----------------
+
+def register_collector(collector):
+    """`collector()` devuelve {sección: {campo: valor}} como /ops/stats; se publica como corebank_worker_*."""
+    _collectors.append(collector)
+    if _file is not None and _file.pid == os.getpid():
+        with _file_lock:
+            _start_publisher()
+
+def unregister_collector(collector):
+    if collector in _collectors:
+        _collectors.remove(collector)
+
+def _flatten(prefix, stats):
+    for field, value in stats.items():
+        if field == 'pid':
+            continue
+        if isinstance(value, dict):
+            yield from _flatten(f"{prefix}{field}_", value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + field, value
+        elif isinstance(value, bool):
+            yield prefix + field, int(value)
+
+def publish():
+    """Escribe las estadísticas actuales del worker en su archivo."""
+    if not METRICS_ENABLED:
+        return
+    store = _process_file()
+    labels = (('pid', str(store.pid)),)
+    for collector in list(_collectors):
+        for name, value in _flatten(WORKER_PREFIX, collector()):
+            store.set((name, labels), float(value))
+
+def _publish_loop():
+    while True:
+        time.sleep(METRICS_PUBLISH_INTERVAL)
+        try:
+            publish()
+        except Exception:
+            # Una estadística que falla no detiene la publicación de las siguientes vueltas
+            pass
+
+def _start_publisher():
+    global _publisher
+    if _publisher is None and _collectors:
+        _publisher = threading.Thread(target=_publish_loop, name='metrics-publisher', daemon=True)
+        _publisher.start()
+
+# ---------------- Lectura ----------------
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def collect(directory=None):
+    """Suma las series de todos los archivos: {(nombre, etiquetas[, bucket]): valor}."""
+    directory = directory or METRICS_DIR
+    totals = {}
+    for path in glob.glob(os.path.join(directory, 'metrics-*.db')):
+        try:
+            pid = int(os.path.basename(path)[len('metrics-'):-len('.db')])
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (ValueError, OSError):
+            continue
+        alive = pid == os.getpid() or _alive(pid)
+        for raw, _, value in _entries(data):
+            key = _key(raw)
+            if not alive and _is_live(key[0]):
+                continue
+            totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(int(value)) if value == int(value) and abs(value) < 1e15 else repr(value)
+
+def _format_bound(bound):
+    return '+Inf' if math.isinf(bound) else repr(bound)
+
+def render(directory=None):
+    """Texto de exposición de Prometheus (version 0.0.4) con las series de todos los workers."""
+    if METRICS_ENABLED:
+        publish()
+    totals = collect(directory)
+    series = {}
+    for key, value in totals.items():
+        series.setdefault(key[0], []).append((key, value))
+
+    lines = []
+    for family, (kind, help_text, buckets) in FAMILIES.items():
+        lines += [f"# HELP {family} {help_text}", f"# TYPE {family} {kind}"]
+        if kind != 'histogram':
+            for (_, labels), value in sorted(series.get(family, [])):
+                lines.append(f"{family}{_format_labels(labels)} {_format_value(value)}")
+            continue
+        counts = {}
+        for (_, labels, index), value in series.get(family + '_bucket', []):
+            counts.setdefault(labels, [0.0] * (len(buckets) + 1))[index] += value
+        sums = dict((key[1], value) for key, value in series.get(family + '_sum', []))
+        for labels in sorted(counts):
+            cumulative = 0.0
+            for bound, count in zip(buckets + (math.inf,), counts[labels]):
+                cumulative += count
+                le = (('le', _format_bound(bound)),)
+                lines.append(f"{family}_bucket{_format_labels(labels, le)} {_format_value(cumulative)}")
+            lines.append(f"{family}_sum{_format_labels(labels)} {_format_value(sums.get(labels, 0.0))}")
+            lines.append(f"{family}_count{_format_labels(labels)} {_format_value(cumulative)}")
+
+    for name in sorted(name for name in series if name.startswith(WORKER_PREFIX)):
+        lines += [f"# HELP {name} {_WORKER_HELP}", f"# TYPE {name} gauge"]
+        for (_, labels), value in sorted(series[name]):
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+def reset(directory=None):
+    """Borra los archivos de métricas (al arrancar el servidor, antes de crear los workers)."""
+    for path in glob.glob(os.path.join(directory or METRICS_DIR, 'metrics-*.db')):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,414 @@
+# app/migrations.py
+"""
+Migraciones versionadas del esquema `bank`.
+
+Cada migración se aplica una sola vez, en orden y en su propia transacción; las
+aplicadas quedan registradas en bank.schema_migrations. El runner toma un advisory
+lock de PostgreSQL, de modo que si varios procesos arrancan a la vez solo uno migra
+y el resto espera y encuentra el esquema al día.
+
+Uso (una vez por despliegue, antes de levantar gunicorn):
+    python -m app.migrations                 # aplica las pendientes y crea el cajero por defecto
+    python -m app.migrations --status        # lista migraciones aplicadas y pendientes
+    python -m app.migrations --check-plans   # falla si una consulta crítica recorre una tabla completa
+    python -m app.migrations --partitions    # crea las particiones próximas de bank.transactions (cron mensual)
+"""
+import argparse
+import json
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import psycopg2
+
+from .db import get_connection, invalidate_prepared_statements
+
+# Clave del advisory lock de migraciones ('bank' en ASCII)
+MIGRATIONS_LOCK_KEY = 0x62616E6B
+
+# (versión, nombre, SQL). Nunca modificar una migración ya publicada: agregar una nueva.
+MIGRATIONS = [
+    (1, 'esquema base', """
+    CREATE TABLE IF NOT EXISTS bank.users (
+        id SERIAL PRIMARY KEY,
+        username TEXT UNIQUE NOT NULL,
+        password BYTEA NOT NULL,
+        role TEXT NOT NULL,
+        full_name TEXT,
+        email TEXT UNIQUE
+    );
+
+    CREATE TABLE IF NOT EXISTS bank.accounts (
+        id SERIAL PRIMARY KEY,
+        balance NUMERIC NOT NULL DEFAULT 0,
+        user_id INTEGER REFERENCES bank.users(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS bank.credit_cards (
+        id SERIAL PRIMARY KEY,
+        limit_credit NUMERIC NOT NULL DEFAULT 1,
+        balance NUMERIC NOT NULL DEFAULT 0,
+        user_id INTEGER REFERENCES bank.users(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS bank.clients (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER UNIQUE NOT NULL REFERENCES bank.users(id) ON DELETE CASCADE,
+        nombres TEXT NOT NULL,
+        apellidos TEXT NOT NULL,
+        direccion TEXT,
+        cedula TEXT UNIQUE NOT NULL,
+        celular TEXT,
+        ip_registro VARCHAR(45)
+    );
+    """),
+    # Cada usuario tiene una cuenta y una tarjeta: los índices únicos lo garantizan y
+    # cubren el filtro por user_id de retiros, transferencias y operaciones de crédito.
+    (2, 'indices unicos por usuario en cuentas y tarjetas', """
+    CREATE UNIQUE INDEX IF NOT EXISTS accounts_user_id_key ON bank.accounts (user_id);
+    CREATE UNIQUE INDEX IF NOT EXISTS credit_cards_user_id_key ON bank.credit_cards (user_id);
+    """),
+    # Libro de movimientos (app/ledger.py), particionado por mes. Sin claves foráneas: cada
+    # inserción en la ruta crítica solo mantiene su partición y dos índices.
+    # ensure_transaction_partitions crea las particiones (límites en UTC) del mes actual y
+    # los `months_ahead` siguientes; despliegues y workers (app/ledger.py) la llaman a la vez,
+    # serializados por un advisory lock. Si una partición faltó, sus movimientos quedaron en
+    # DEFAULT y PARTITION OF fallaría: con las inserciones en DEFAULT bloqueadas, se mueven a
+    # una tabla nueva que luego se adjunta.
+    (3, 'libro de movimientos particionado', """
+    CREATE TABLE IF NOT EXISTS bank.transactions (
+        id BIGSERIAL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        user_id INTEGER NOT NULL,
+        instrument TEXT NOT NULL CHECK (instrument IN ('account', 'credit_card')),
+        kind TEXT NOT NULL,
+        amount NUMERIC NOT NULL,
+        balance_after NUMERIC NOT NULL,
+        counterparty_user_id INTEGER,
+        PRIMARY KEY (created_at, id)
+    ) PARTITION BY RANGE (created_at);
+
+    CREATE TABLE IF NOT EXISTS bank.transactions_default PARTITION OF bank.transactions DEFAULT;
+    CREATE INDEX IF NOT EXISTS transactions_user_created_idx ON bank.transactions (user_id, created_at DESC, id DESC);
+
+    CREATE OR REPLACE FUNCTION bank.ensure_transaction_partitions(months_ahead INTEGER) RETURNS INTEGER AS $$
+    DECLARE
+        month_start TIMESTAMP := date_trunc('month', now() AT TIME ZONE 'UTC');
+        range_start TIMESTAMPTZ;
+        range_end TIMESTAMPTZ;
+        partition_name TEXT;
+        created INTEGER := 0;
+    BEGIN
+        PERFORM pg_advisory_xact_lock(hashtext('bank.ensure_transaction_partitions'));
+        FOR i IN 0..months_ahead LOOP
+            partition_name := 'transactions_' || to_char(month_start, 'YYYY_MM');
+            range_start := month_start AT TIME ZONE 'UTC';
+            range_end := (month_start + interval '1 month') AT TIME ZONE 'UTC';
+            IF to_regclass('bank.' || partition_name) IS NULL THEN
+                LOCK TABLE bank.transactions_default IN SHARE ROW EXCLUSIVE MODE;
+                IF EXISTS (SELECT 1 FROM bank.transactions_default WHERE created_at >= range_start AND created_at < range_end) THEN
+                    EXECUTE format('CREATE TABLE bank.%I (LIKE bank.transactions INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+                    EXECUTE format(
+                        'WITH moved AS (DELETE FROM bank.transactions_default WHERE created_at >= %L AND created_at < %L RETURNING *) '
+                        || 'INSERT INTO bank.%I SELECT * FROM moved',
+                        range_start, range_end, partition_name
+                    );
+                    EXECUTE format(
+                        'ALTER TABLE bank.transactions ATTACH PARTITION bank.%I FOR VALUES FROM (%L) TO (%L)',
+                        partition_name, range_start, range_end
+                    );
+                ELSE
+                    EXECUTE format(
+                        'CREATE TABLE bank.%I PARTITION OF bank.transactions FOR VALUES FROM (%L) TO (%L)',
+                        partition_name, range_start, range_end
+                    );
+                END IF;
+                created := created + 1;
+            END IF;
+            month_start := month_start + interval '1 month';
+        END LOOP;
+        RETURN created;
+    END
+    $$ LANGUAGE plpgsql;
+
+    SELECT bank.ensure_transaction_partitions(3);
+    """),
+    # Trabajos de exportación de estados de cuenta (app/statements.py). La tabla es la cola:
+    # cualquier worker toma los pendientes con SKIP LOCKED y el archivo queda en EXPORT_DIR.
+    (4, 'trabajos de exportacion de estados de cuenta', """
+    CREATE TABLE IF NOT EXISTS bank.statement_jobs (
+        id TEXT PRIMARY KEY,
+        requested_by INTEGER NOT NULL REFERENCES bank.users(id),
+        user_id INTEGER NOT NULL REFERENCES bank.users(id),
+        date_from DATE NOT NULL,
+        date_to DATE NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+        attempts INTEGER NOT NULL DEFAULT 0,
+        rows_exported BIGINT,
+        file_bytes BIGINT,
+        error TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        started_at TIMESTAMPTZ,
+        finished_at TIMESTAMPTZ
+    );
+    CREATE INDEX IF NOT EXISTS statement_jobs_pending_idx ON bank.statement_jobs (created_at)
+        WHERE status IN ('queued', 'running');
+    """),
+    # Resultados de operaciones con Idempotency-Key (app/idempotency.py): una fila por
+    # (usuario, clave) con la huella SHA-256 de la solicitud; se purgan al vencer su TTL.
+    # result es JSON (no JSONB) para repetir la respuesta con el mismo orden de campos.
+    (5, 'claves de idempotencia', """
+    CREATE TABLE IF NOT EXISTS bank.idempotency_keys (
+        user_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        fingerprint BYTEA NOT NULL,
+        result JSON,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (user_id, key)
+    );
+    CREATE INDEX IF NOT EXISTS idempotency_keys_created_idx ON bank.idempotency_keys (created_at);
+    """),
+    # Cuentas calientes (app/hot_accounts.py): balance_slots = N > 0 reparte los créditos de la
+    # cuenta entre N sub-saldos de bank.account_slots; el saldo lógico es balance + sus
+    # sub-saldos.
+    (6, 'sub-saldos de cuentas calientes', """
+    ALTER TABLE bank.accounts ADD COLUMN IF NOT EXISTS balance_slots SMALLINT NOT NULL DEFAULT 0;
+    CREATE INDEX IF NOT EXISTS accounts_hot_idx ON bank.accounts (id) WHERE balance_slots > 0;
+
+    CREATE TABLE IF NOT EXISTS bank.account_slots (
+        account_id INTEGER NOT NULL REFERENCES bank.accounts(id),
+        slot SMALLINT NOT NULL,
+        balance NUMERIC NOT NULL DEFAULT 0,
+        PRIMARY KEY (account_id, slot)
+    );
+    """),
+]
+
+# Consultas de las rutas críticas con parámetros de ejemplo, para --check-plans
+def _hot_path_queries():
+    from .queries import (
+        WITHDRAW_SQL, TRANSFER_SQL, CREDIT_PAYMENT_SQL, PAY_CREDIT_BALANCE_SQL, BATCH_TRANSFER_LOCK_SQL, BALANCE_SQL,
+        DEPOSIT_SQL, TRANSACTIONS_PAGE_SQL, STATEMENT_SQL, STATEMENT_COUNT_SQL, IDEMPOTENCY_LOOKUP_SQL, LOGIN_SQL
+    )
+    from .ledger import FIRST_PAGE
+    return [
+        ('login', LOGIN_SQL, {'username': 'x'}),
+        ('registro: email duplicado', "SELECT id FROM bank.users WHERE email = %(email)s", {'email': 'x@x'}),
+        ('retiro', WITHDRAW_SQL, {'user_id': 1, 'amount': 1}),
+        ('transferencia', TRANSFER_SQL, {'sender_id': 1, 'target_username': 'x', 'amount': 1}),
+        ('transferencia por lotes', BATCH_TRANSFER_LOCK_SQL, {'sender_id': 1, 'usernames': ['x', 'y']}),
+        ('compra a crédito', CREDIT_PAYMENT_SQL, {'user_id': 1, 'amount': 1}),
+        ('abono a tarjeta', PAY_CREDIT_BALANCE_SQL, {'user_id': 1, 'amount': 1}),
+        ('saldo', BALANCE_SQL, {'user_id': 1}),
+        ('depósito', DEPOSIT_SQL, {'account_id': 1, 'amount': 1, 'cajero_id': 1}),
+        ('historial de movimientos', TRANSACTIONS_PAGE_SQL,
+         {'user_id': 1, 'before_created_at': FIRST_PAGE[0], 'before_id': FIRST_PAGE[1], 'limit': 50}),
+        ('estado de cuenta', STATEMENT_SQL,
+         {'user_id': 1, 'start': datetime(2024, 1, 1, tzinfo=timezone.utc), 'end': datetime(2024, 2, 1, tzinfo=timezone.utc)}),
+        ('estado de cuenta: conteo', STATEMENT_COUNT_SQL,
+         {'user_id': 1, 'start': datetime(2024, 1, 1, tzinfo=timezone.utc), 'end': datetime(2024, 2, 1, tzinfo=timezone.utc), 'limit': 1000}),
+        ('idempotencia', IDEMPOTENCY_LOOKUP_SQL, {'user_id': 1, 'key': 'x', 'ttl': 24}),
+    ]
+
+class MigrationError(Exception):
+    """Una migración falló; la transacción de esa migración se revirtió."""
+
+def _bootstrap(cur):
+    cur.execute("""
+    CREATE SCHEMA IF NOT EXISTS bank AUTHORIZATION postgres;
+    CREATE TABLE IF NOT EXISTS bank.schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """)
+
+def _applied_versions(cur):
+    cur.execute("SELECT version FROM bank.schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+def _check_unique_user_ids(cur):
+    """Antes de la migración 2: informa qué usuarios tienen más de una cuenta o tarjeta."""
+    for table in ('accounts', 'credit_cards'):
+        cur.execute(f"""
+            SELECT user_id, count(*) FROM bank.{table}
+            WHERE user_id IS NOT NULL
+            GROUP BY user_id HAVING count(*) > 1
+            ORDER BY user_id LIMIT 10
+        """)
+        duplicated = cur.fetchall()
+        if duplicated:
+            raise MigrationError(
+                f"bank.{table} tiene usuarios con más de un registro (user_id, cantidad): {duplicated}. "
+                "Consolidar los duplicados antes de aplicar la migración 2."
+            )
+
+_PRECHECKS = {2: _check_unique_user_ids}
+
+@contextmanager
+def migration_lock(conn):
+    """
+    Advisory lock de sesión que serializa migraciones e inicialización entre procesos.
+    Es reentrante dentro de la misma conexión (PostgreSQL cuenta las adquisiciones).
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+        conn.commit()
+        try:
+            yield
+        finally:
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+            conn.commit()
+    finally:
+        cur.close()
+
+def migrate(conn=None, verbose=True):
+    """Aplica las migraciones pendientes bajo el advisory lock. Devuelve las versiones aplicadas."""
+    own_conn = conn is None
+    conn = conn or get_connection()
+    applied_now = []
+    try:
+        with migration_lock(conn):
+            cur = conn.cursor()
+            try:
+                _bootstrap(cur)
+                conn.commit()
+                applied = _applied_versions(cur)
+                for version, name, sql in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    try:
+                        if version in _PRECHECKS:
+                            _PRECHECKS[version](cur)
+                        cur.execute(sql)
+                        cur.execute("INSERT INTO bank.schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                        conn.commit()
+                    except Exception as e:
+                        conn.rollback()
+                        raise MigrationError(f"Migración {version} ({name}) falló: {e}") from e
+                    applied_now.append(version)
+                    invalidate_prepared_statements()
+                    if verbose:
+                        print(f"✅ Migración {version} aplicada: {name}")
+            finally:
+                cur.close()
+    finally:
+        if own_conn:
+            conn.close()
+    return applied_now
+
+def status(conn):
+    cur = conn.cursor()
+    try:
+        _bootstrap(cur)
+        conn.commit()
+        cur.execute("SELECT version, applied_at FROM bank.schema_migrations")
+        applied = dict(cur.fetchall())
+    finally:
+        cur.close()
+    return [(version, name, applied.get(version)) for version, name, _ in MIGRATIONS]
+
+def _full_scans(plan, found=None):
+    """
+    Recorre un plan EXPLAIN (FORMAT JSON, VERBOSE) y devuelve las tablas recorridas completas:
+    Seq Scan, o Index Scan sin condición de índice (el planificador recorre el índice entero
+    para respetar un ORDER BY y filtra fila por fila).
+    """
+    found = [] if found is None else found
+    node = plan.get('Node Type')
+    if node == 'Seq Scan':
+        found.append(f"{plan.get('Schema')}.{plan.get('Relation Name')} (Seq Scan)")
+    elif node in ('Index Scan', 'Index Only Scan') and 'Index Cond' not in plan:
+        found.append(f"{plan.get('Schema')}.{plan.get('Relation Name')} ({node} completo de {plan.get('Index Name')})")
+    for child in plan.get('Plans', []):
+        _full_scans(child, found)
+    return found
+
+def check_plans(conn):
+    """
+    Ejecuta EXPLAIN de cada consulta crítica con enable_seqscan desactivado: si aun así el
+    plan recorre completa una tabla de `bank`, falta un índice. Devuelve [(consulta, tablas)].
+    """
+    failures = []
+    cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL enable_seqscan = off")
+        for name, sql, params in _hot_path_queries():
+            cur.execute("EXPLAIN (FORMAT JSON, VERBOSE) " + sql, params)
+            plan = cur.fetchone()[0]
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            scans = [t for t in _full_scans(plan[0]['Plan']) if t.startswith('bank.')]
+            if scans:
+                failures.append((name, scans))
+    finally:
+        conn.rollback()
+        cur.close()
+    return failures
+
+def wait_for_database(timeout):
+    """Espera hasta `timeout` segundos a que la base acepte conexiones (arranque con docker-compose)."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            get_connection().close()
+            return
+        except psycopg2.OperationalError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--status', action='store_true', help='Lista migraciones aplicadas y pendientes')
+    parser.add_argument('--check-plans', action='store_true', help='Verifica con EXPLAIN que las consultas críticas usan índices')
+    parser.add_argument('--partitions', action='store_true', help='Crea las particiones mensuales próximas del libro de movimientos')
+    parser.add_argument('--wait', type=float, default=0, help='Segundos a esperar a que la base esté disponible')
+    args = parser.parse_args(argv)
+    if args.wait:
+        wait_for_database(args.wait)
+
+    if args.status:
+        conn = get_connection()
+        try:
+            for version, name, applied_at in status(conn):
+                print(f"{version:>4}  {'aplicada ' + applied_at.isoformat() if applied_at else 'pendiente':<40} {name}")
+        finally:
+            conn.close()
+        return 0
+
+    if args.check_plans:
+        conn = get_connection()
+        try:
+            failures = check_plans(conn)
+        finally:
+            conn.close()
+        for name, tables in failures:
+            print(f"❌ {name}: recorrido completo de {', '.join(tables)}")
+        if failures:
+            return 1
+        print("✅ Todas las consultas críticas usan índices")
+        return 0
+
+    if args.partitions:
+        from .ledger import ensure_partitions, LEDGER_PARTITIONS_AHEAD
+        conn = get_connection()
+        try:
+            created = ensure_partitions(conn)
+        finally:
+            conn.close()
+        print(f"✅ Particiones de bank.transactions al día ({created} nuevas, {LEDGER_PARTITIONS_AHEAD} meses por adelantado)")
+        return 0
+
+    from .db import init_db
+    try:
+        init_db()
+    except MigrationError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,278 @@
+# app/profiling.py
+"""
+Perfilado por muestreo de solicitudes individuales (PROFILE_ENABLED=1).
+
+Se perfila una fracción PROFILE_SAMPLE_RATE de las solicitudes, y además toda solicitud con
+la cabecera `X-Profile: 1` cuyo token sea de un cajero. Mientras dura una solicitud
+perfilada, un hilo del worker toma cada PROFILE_INTERVAL_MS la pila del hilo que la atiende
+(en modo ASGI, la de su tarea: la pila en ejecución o, si está esperando, la cadena de
+corrutinas suspendidas, terminada en "[await]"). Las sentencias SQL ejecutadas se registran
+con su duración, sin parámetros.
+
+Cada solicitud perfilada deja en PROFILE_DIR dos archivos con el mismo nombre; si la pidió
+un cajero con X-Profile, la respuesta los informa en la cabecera X-Profile-Id (las de la
+muestra al azar no la llevan):
+- <id>.folded: pilas colapsadas ("marco;marco;... muestras"), entrada de flamegraph.pl,
+  speedscope o inferno.
+- <id>.json: endpoint, método, estado, duración, intervalo y sentencias SQL.
+Se conservan los PROFILE_MAX_FILES perfiles más recientes. Con PROFILE_ENABLED=0 no se
+instala ningún hook.
+"""
+import asyncio
+import contextvars
+import datetime
+import glob
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+PROFILE_ENABLED = os.environ.get('PROFILE_ENABLED', '0') == '1'
+# Fracción de las solicitudes que se perfilan (0 = solo las pedidas con la cabecera)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0.01'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '200'))
+# Caracteres de cada sentencia SQL que se guardan
+PROFILE_SQL_MAX_LENGTH = int(os.environ.get('PROFILE_SQL_MAX_LENGTH', '500'))
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ID_HEADER = 'X-Profile-Id'
+
+_current = contextvars.ContextVar('profile_session', default=None)
+_SLUG_RE = re.compile(r'[^A-Za-z0-9]+')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def wants_profile(profile_header, auth_header, secret_key):
+    """
+    Si la solicitud se perfila: 'requested' si la pide un cajero con X-Profile, 'sampled' si
+    cae en la muestra, None si no se perfila.
+    """
+    if profile_header and profile_header != '0':
+        from .security import TokenError, verify_token
+        try:
+            if verify_token(auth_header or '', secret_key).get('role') == 'cajero':
+                return 'requested'
+        except TokenError:
+            pass
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return 'sampled'
+    return None
+
+_labels = {}
+
+def _label(code):
+    """Nombre del marco en las pilas colapsadas: función (archivo:línea), con la ruta acortada."""
+    label = _labels.get(code)
+    if label is None:
+        path = code.co_filename
+        for prefix in sorted(sys.path, key=len, reverse=True):
+            if prefix and path.startswith(prefix + os.sep):
+                path = path[len(prefix) + 1:]
+                break
+        label = _labels[code] = f"{code.co_name} ({path}:{code.co_firstlineno})".replace(';', ',')
+    return label
+
+def _thread_stack(frame):
+    stack = []
+    while frame is not None:
+        stack.append(_label(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def _task_stack(task):
+    """Cadena de corrutinas de una tarea suspendida, de la externa a la que espera."""
+    stack = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is not None:
+            stack.append(_label(frame.f_code))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    stack.append('[await]')
+    return stack
+
+class ProfileSession:
+    """Muestras y sentencias SQL de una solicitud."""
+
+    def __init__(self, method, path, requested=False):
+        self.method = method
+        self.path = path
+        # Pedida con X-Profile: solo entonces la respuesta informa el id
+        self.requested = requested
+        self.thread_id = threading.get_ident()
+        try:
+            self.loop = asyncio.get_running_loop()
+            self.task = asyncio.current_task(self.loop)
+        except RuntimeError:
+            self.loop = self.task = None
+        self.started = time.perf_counter()
+        self.wall_started = datetime.datetime.now()
+        self.stacks = Counter()
+        self.statements = []
+        self.id = None
+
+    def sample(self, frames):
+        if self.task is not None:
+            if asyncio.current_task(self.loop) is not self.task:
+                if not self.task.done():
+                    self.stacks[';'.join(_task_stack(self.task))] += 1
+                return
+        frame = frames.get(self.thread_id)
+        if frame is not None:
+            self.stacks[';'.join(_thread_stack(frame))] += 1
+
+    def statement(self, sql, seconds):
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8', 'replace')
+        elif not isinstance(sql, str):
+            sql = str(sql)
+        sql = _WHITESPACE_RE.sub(' ', sql).strip()[:PROFILE_SQL_MAX_LENGTH]
+        self.statements.append({
+            'offset_ms': round((time.perf_counter() - self.started - seconds) * 1000, 3),
+            'duration_ms': round(seconds * 1000, 3),
+            'sql': sql,
+        })
+
+    def finish(self, endpoint, status):
+        """Cierra la sesión y le asigna el id (nombre de los archivos) que se escribirán."""
+        self.duration = time.perf_counter() - self.started
+        self.endpoint = endpoint
+        self.status = status
+        slug = _SLUG_RE.sub('_', endpoint).strip('_') or 'root'
+        self.id = f"{self.wall_started:%Y%m%dT%H%M%S%f}-{os.getpid()}-{self.method}-{slug}"
+        return self.id
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, self.id)
+        with open(base + '.folded.tmp', 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        sql_total = sum(statement['duration_ms'] for statement in self.statements)
+        with open(base + '.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump({
+                'id': self.id,
+                'pid': os.getpid(),
+                'started_at': self.wall_started.isoformat(),
+                'method': self.method,
+                'path': self.path,
+                'endpoint': self.endpoint,
+                'status': self.status,
+                'requested': self.requested,
+                'duration_ms': round(self.duration * 1000, 3),
+                'interval_ms': PROFILE_INTERVAL_MS,
+                'samples': sum(self.stacks.values()),
+                'sql_count': len(self.statements),
+                'sql_total_ms': round(sql_total, 3),
+                'sql': self.statements,
+            }, f, ensure_ascii=False, indent=1)
+        os.replace(base + '.folded.tmp', base + '.folded')
+        os.replace(base + '.json.tmp', base + '.json')
+        _rotate(directory)
+
+def _rotate(directory):
+    """Borra los perfiles más antiguos por encima de PROFILE_MAX_FILES (el nombre empieza por la fecha)."""
+    profiles = sorted(glob.glob(os.path.join(directory, '*.folded')))
+    for path in profiles[:max(0, len(profiles) - PROFILE_MAX_FILES)]:
+        for stale in (path, path[:-len('.folded')] + '.json'):
+            try:
+                os.unlink(stale)
+            except FileNotFoundError:
+                pass
+
+class _Sampler:
+    """Hilo del worker que muestrea las sesiones activas; duerme mientras no hay ninguna."""
+
+    def __init__(self, interval):
+        self.pid = os.getpid()
+        self.interval = interval
+        self._sessions = set()
+        self._cond = threading.Condition()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='profile-writer')
+        threading.Thread(target=self._run, name='profile-sampler', daemon=True).start()
+
+    def add(self, session):
+        with self._cond:
+            self._sessions.add(session)
+            self._cond.notify()
+
+    def remove(self, session):
+        with self._cond:
+            self._sessions.discard(session)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._sessions:
+                    self._cond.wait()
+            time.sleep(self.interval)
+            with self._cond:
+                sessions = list(self._sessions)
+            frames = sys._current_frames()
+            for session in sessions:
+                try:
+                    session.sample(frames)
+                except Exception:
+                    # Una pila que cambió mientras se leía: se descarta la muestra
+                    pass
+            del frames
+
+    def write(self, session):
+        self._writer.submit(session.write, PROFILE_DIR)
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+def _after_fork_in_child():
+    global _sampler_lock
+    _sampler_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def _get_sampler():
+    """Muestreador del proceso actual (los hilos no sobreviven a un fork())."""
+    global _sampler
+    sampler = _sampler
+    if sampler is not None and sampler.pid == os.getpid():
+        return sampler
+    with _sampler_lock:
+        if _sampler is None or _sampler.pid != os.getpid():
+            _sampler = _Sampler(PROFILE_INTERVAL_MS / 1000)
+        return _sampler
+
+def start(method, path, requested=False):
+    """Empieza a perfilar la solicitud en curso (hilo o tarea actual)."""
+    session = ProfileSession(method, path, requested)
+    _current.set(session)
+    _get_sampler().add(session)
+    return session
+
+def stop(session, endpoint, status):
+    """Termina la sesión y encola la escritura de sus archivos; devuelve el id del perfil."""
+    _current.set(None)
+    sampler = _get_sampler()
+    sampler.remove(session)
+    if session.id is not None:
+        return session.id
+    profile_id = session.finish(endpoint, status)
+    sampler.write(session)
+    return profile_id
+
+def discard(session):
+    """Abandona una sesión sin escribirla (la solicitud terminó sin respuesta)."""
+    _current.set(None)
+    _get_sampler().remove(session)
+
+def record_statement(sql, seconds):
+    """Registra una sentencia SQL en la sesión de la solicitud actual, si se está perfilando."""
+    if PROFILE_ENABLED:
+        session = _current.get()
+        if session is not None:
+            session.statement(sql, seconds)
@@ -0,0 +1,510 @@
+# app/queries.py
+# Sentencias SQL de las operaciones bancarias. Cada operación se resuelve en un solo
+# round trip: bloquea las filas involucradas (FOR UPDATE, siempre en orden de id),
+# verifica fondos o límite, mueve el dinero y devuelve los saldos resultantes.
+# Los valores NULL en el resultado indican qué verificación falló. Cada movimiento de
+# saldo se registra en el libro bank.transactions dentro de la misma sentencia (CTE
+# `ledger`): `amount` es la variación con signo del saldo afectado (cuenta o deuda de
+# tarjeta) y `balance_after` el saldo resultante.
+#
+# Los UPDATE filtran por `id = (SELECT ... FROM <cte bloqueado>)` en lugar de unirse
+# (FROM) con el CTE: así la re-verificación de PostgreSQL ante filas modificadas
+# concurrentemente (EvalPlanQual) solo compara el id y no descarta la actualización.
+#
+# Cuentas calientes (app/hot_accounts.py): una cuenta con balance_slots = N > 0 reparte su
+# saldo entre la fila de bank.accounts (saldo principal) y N sub-saldos en bank.account_slots;
+# el saldo lógico es la suma de todos. Los créditos de depósitos y transferencias van a un
+# sub-saldo sin bloquear la fila de la cuenta, elegido por el id de la transacción: las
+# transacciones concurrentes tienen ids consecutivos y caen en sub-saldos distintos (random()
+# no sirve: se vuelve a evaluar al re-verificar una fila modificada y el UPDATE no la encuentra); los débitos bloquean la cuenta, leen
+# sus sub-saldos con FOR KEY SHARE (última versión confirmada, sin esperar a los créditos en
+# curso) y verifican fondos contra la suma, descontando del saldo principal, que puede quedar
+# negativo. Los lotes y depósitos masivos acreditan el saldo principal.
+
+# Depósito de un cajero en una cuenta: (saldo_nuevo, id_usuario_titular); sin filas -> cuenta inexistente.
+# En una cuenta caliente el saldo nuevo suma el sub-saldo acreditado a los demás según la
+# instantánea de la sentencia.
+DEPOSIT_SQL = """
+WITH acct AS (
+    SELECT id, user_id, balance, balance_slots FROM bank.accounts WHERE id = %(account_id)s
+), credit AS (
+    UPDATE bank.accounts SET balance = balance + %(amount)s
+    WHERE id = (SELECT id FROM acct WHERE balance_slots = 0)
+    RETURNING id, user_id, balance
+), slot_credit AS (
+    UPDATE bank.account_slots SET balance = balance + %(amount)s
+    WHERE account_id = (SELECT id FROM acct WHERE balance_slots > 0)
+      AND slot = (SELECT mod(pg_current_xact_id()::text::bigint, balance_slots)::smallint FROM acct WHERE balance_slots > 0)
+    RETURNING account_id, slot, balance
+), credited AS (
+    SELECT c.user_id, c.balance + (SELECT coalesce(sum(s.balance), 0) FROM bank.account_slots s WHERE s.account_id = c.id) AS balance
+    FROM credit c
+    UNION ALL
+    SELECT acct.user_id, acct.balance + sc.balance + (
+        SELECT coalesce(sum(s.balance), 0) FROM bank.account_slots s
+        WHERE s.account_id = sc.account_id AND s.slot <> sc.slot
+    )
+    FROM slot_credit sc, acct
+), ledger AS (
+    INSERT INTO bank.transactions (user_id, instrument, kind, amount, balance_after, counterparty_user_id)
+    SELECT user_id, 'account', 'deposit', %(amount)s, balance, %(cajero_id)s::integer FROM credited
+)
+SELECT balance, user_id FROM credited
+"""
+
+# Retiro: (saldo_actual, saldo_nuevo). saldo_actual NULL -> cuenta inexistente;
+# saldo_nuevo NULL -> fondos insuficientes.
+WITHDRAW_SQL = """
+WITH acct AS (
+    SELECT id, balance FROM bank.accounts
+    WHERE user_id = %(user_id)s
+    ORDER BY id LIMIT 1
+    FOR UPDATE
+), acct_slots AS (
+    SELECT balance FROM bank.account_slots
+    WHERE account_id = (SELECT id FROM acct)
+    FOR KEY SHARE
+), funds AS (
+    SELECT id, balance + (SELECT coalesce(sum(balance), 0) FROM acct_slots) AS balance FROM acct
+), debit AS (
+    UPDATE bank.accounts SET balance = balance - %(amount)s
+    WHERE id = (SELECT id FROM funds WHERE balance >= %(amount)s)
+    RETURNING id
+), debited AS (
+    SELECT balance - %(amount)s AS balance FROM funds WHERE id = (SELECT id FROM debit)
+), ledger AS (
+    INSERT INTO bank.transactions (user_id, instrument, kind, amount, balance_after)
+    SELECT %(user_id)s, 'account', 'withdrawal', -(%(amount)s), balance FROM debited
+)
+SELECT (SELECT balance FROM funds), (SELECT balance FROM debited)
+"""
+
+# Transferencia: (saldo_remitente, id_usuario_destino, id_cuenta_destino, saldo_nuevo_remitente).
+# Las dos cuentas se bloquean en orden de id para que transferencias cruzadas no se bloqueen
+# mutuamente: la subconsulta escalar de `sender_slots` lee todo `locked` y con ello bloquea ambas
+# filas. Una cuenta destino caliente no se bloquea: el crédito va a uno de sus sub-saldos.
+TRANSFER_SQL = """
+WITH target AS (
+    SELECT id FROM bank.users WHERE username = %(target_username)s
+), sender_acct AS (
+    SELECT id FROM bank.accounts WHERE user_id = %(sender_id)s ORDER BY id LIMIT 1
+), target_acct AS (
+    SELECT id, balance, balance_slots FROM bank.accounts WHERE user_id = (SELECT id FROM target) ORDER BY id LIMIT 1
+), locked AS (
+    SELECT id, balance FROM bank.accounts
+    WHERE id IN (SELECT id FROM sender_acct UNION ALL SELECT id FROM target_acct WHERE balance_slots = 0)
+    ORDER BY id
+    FOR UPDATE
+), sender_slots AS (
+    SELECT balance FROM bank.account_slots
+    WHERE account_id = (SELECT id FROM locked WHERE id = (SELECT id FROM sender_acct))
+    FOR KEY SHARE
+), funds AS (
+    SELECT id, balance + (SELECT coalesce(sum(balance), 0) FROM sender_slots) AS balance
+    FROM locked WHERE id = (SELECT id FROM sender_acct)
+), debit AS (
+    UPDATE bank.accounts SET balance = balance - %(amount)s
+    WHERE id = (SELECT id FROM funds WHERE balance >= %(amount)s)
+      AND EXISTS (SELECT 1 FROM target_acct)
+    RETURNING id
+), debited AS (
+    SELECT balance - %(amount)s AS balance FROM funds WHERE id = (SELECT id FROM debit)
+), credit AS (
+    UPDATE bank.accounts SET balance = balance + %(amount)s
+    WHERE id = (SELECT id FROM target_acct WHERE balance_slots = 0)
+      AND EXISTS (SELECT 1 FROM debit)
+    RETURNING id, balance
+), slot_credit AS (
+    UPDATE bank.account_slots SET balance = balance + %(amount)s
+    WHERE account_id = (SELECT id FROM target_acct WHERE balance_slots > 0)
+      AND slot = (SELECT mod(pg_current_xact_id()::text::bigint, balance_slots)::smallint FROM target_acct WHERE balance_slots > 0)
+      AND EXISTS (SELECT 1 FROM debit)
+    RETURNING account_id, slot, balance
+), credited AS (
+    SELECT c.balance + (SELECT coalesce(sum(s.balance), 0) FROM bank.account_slots s WHERE s.account_id = c.id) AS balance
+    FROM credit c
+    UNION ALL
+    SELECT t.balance + sc.balance + (
+        SELECT coalesce(sum(s.balance), 0) FROM bank.account_slots s
+        WHERE s.account_id = sc.account_id AND s.slot <> sc.slot
+    )
+    FROM slot_credit sc, target_acct t
+), ledger AS (
+    INSERT INTO bank.transactions (user_id, instrument, kind, amount, balance_after, counterparty_user_id)
+    SELECT %(sender_id)s, 'account', 'transfer_out', -(%(amount)s), balance, (SELECT id FROM target) FROM debited
+    UNION ALL
+    SELECT (SELECT id FROM target), 'account', 'transfer_in', %(amount)s, balance, %(sender_id)s FROM credited
+)
+SELECT
+    (SELECT balance FROM funds),
+    (SELECT id FROM target),
+    (SELECT id FROM target_acct),
+    (SELECT balance FROM debited),
+    (SELECT count(*) FROM credited)
+"""
+
+# Compra a crédito: (límite, deuda_actual, deuda_nueva). límite NULL -> tarjeta inexistente;
+# deuda_nueva NULL -> límite insuficiente.
+CREDIT_PAYMENT_SQL = """
+WITH card AS (
+    SELECT id, limit_credit, balance FROM bank.credit_cards
+    WHERE user_id = %(user_id)s
+    ORDER BY id LIMIT 1
+    FOR UPDATE
+), charge AS (
+    UPDATE bank.credit_cards SET balance = balance + %(amount)s
+    WHERE id = (SELECT id FROM card WHERE limit_credit - balance >= %(amount)s)
+    RETURNING balance
+), ledger AS (
+    INSERT INTO bank.transactions (user_id, instrument, kind, amount, balance_after)
+    SELECT %(user_id)s, 'credit_card', 'credit_purchase', %(amount)s, balance FROM charge
+)
+SELECT (SELECT limit_credit FROM card), (SELECT balance FROM card), (SELECT balance FROM charge)
+"""
+
+# Abono a tarjeta: (saldo_cuenta, id_tarjeta, saldo_nuevo_cuenta, deuda_nueva).
+# Se abona como máximo la deuda actual; los fondos se verifican contra el monto solicitado.
+PAY_CREDIT_BALANCE_SQL = """
+WITH locked_acct AS (
+    SELECT id, balance FROM bank.accounts
+    WHERE user_id = %(user_id)s
+    ORDER BY id LIMIT 1
+    FOR UPDATE
+), acct_slots AS (
+    SELECT balance FROM bank.account_slots
+    WHERE account_id = (SELECT id FROM locked_acct)
+    FOR KEY SHARE
+), acct AS (
+    SELECT id, balance + (SELECT coalesce(sum(balance), 0) FROM acct_slots) AS balance FROM locked_acct
+), card AS (
+    SELECT id, balance FROM bank.credit_cards
+    WHERE user_id = %(user_id)s
+    ORDER BY id LIMIT 1
+    FOR UPDATE
+), payment AS (
+    SELECT acct.id AS account_id, card.id AS card_id, LEAST(%(amount)s, card.balance) AS amount
+    FROM acct, card
+    WHERE acct.balance >= %(amount)s
+), debit AS (
+    UPDATE bank.accounts SET balance = balance - (SELECT amount FROM payment)
+    WHERE id = (SELECT account_id FROM payment)
+    RETURNING id
+), debited AS (
+    SELECT acct.balance - payment.amount AS balance
+    FROM acct, payment WHERE acct.id = (SELECT id FROM debit)
+), paid AS (
+    UPDATE bank.credit_cards SET balance = balance - (SELECT amount FROM payment)
+    WHERE id = (SELECT card_id FROM payment)
+    RETURNING balance
+), ledger AS (
+    INSERT INTO bank.transactions (user_id, instrument, kind, amount, balance_after)
+    SELECT %(user_id)s, 'account', 'card_payment', -amount, (SELECT balance FROM debited) FROM payment WHERE amount > 0
+    UNION ALL
+    SELECT %(user_id)s, 'credit_card', 'card_payment', -amount, (SELECT balance FROM paid) FROM payment WHERE amount > 0
+)
+SELECT (SELECT balance FROM acct), (SELECT id FROM card), (SELECT balance FROM debited), (SELECT balance FROM paid)
+"""
+
+# Consulta de saldo (lectura sin bloqueo): (saldo_cuenta, límite, deuda). Sin filas ->
+# cuenta inexistente; límite y deuda NULL -> el usuario no tiene tarjeta. El saldo de una cuenta
+# caliente suma sus sub-saldos en la misma instantánea.
+BALANCE_SQL = """
+SELECT a.balance + (SELECT coalesce(sum(s.balance), 0) FROM bank.account_slots s WHERE s.account_id = a.id), c.limit_credit, c.balance
+FROM bank.accounts a
+LEFT JOIN bank.credit_cards c ON c.user_id = a.user_id
+WHERE a.user_id = %(user_id)s
+ORDER BY a.id LIMIT 1
+"""
+
+# Login: (id, hash de la contraseña, rol); sin filas -> usuario inexistente
+LOGIN_SQL = "SELECT id, password, role FROM bank.users WHERE username = %(username)s"
+
+# Lote de transferencias, paso 1: resuelve todos los destinos en una consulta y bloquea
+# la cuenta del remitente y las de destino en orden de id (lotes concurrentes no se
+# bloquean mutuamente). Filas de destino: (username, user_id, account_id, NULL);
+# fila del remitente: (NULL, user_id, account_id, saldo), con sus sub-saldos si es caliente.
+BATCH_TRANSFER_LOCK_SQL = """
+WITH sender_acct AS (
+    SELECT id FROM bank.accounts WHERE user_id = %(sender_id)s ORDER BY id LIMIT 1
+), targets AS (
+    SELECT u.username, u.id AS user_id,
+           (SELECT a.id FROM bank.accounts a WHERE a.user_id = u.id ORDER BY a.id LIMIT 1) AS account_id
+    FROM bank.users u
+    WHERE u.username = ANY(%(usernames)s)
+), locked AS (
+    SELECT id, balance FROM bank.accounts
+    WHERE id IN (SELECT id FROM sender_acct UNION SELECT account_id FROM targets)
+    ORDER BY id
+    FOR UPDATE
+), sender_slots AS (
+    SELECT balance FROM bank.account_slots
+    WHERE account_id = (SELECT id FROM locked WHERE id = (SELECT id FROM sender_acct))
+    FOR KEY SHARE
+)
+SELECT t.username, t.user_id, t.account_id, NULL::numeric FROM targets t
+UNION ALL
+SELECT NULL, %(sender_id)s, l.id, l.balance + (SELECT coalesce(sum(balance), 0) FROM sender_slots)
+FROM locked l WHERE l.id = (SELECT id FROM sender_acct)
+"""
+
+# Lote de transferencias, paso 2: aplica débitos y créditos agregados por cuenta en una
+# sola sentencia (las filas ya están bloqueadas por el paso 1 en la misma transacción) y
+# registra un movimiento por ítem aplicado y cuenta; el saldo tras cada movimiento se
+# reconstruye desde el saldo final restando los movimientos posteriores de esa cuenta.
+BATCH_TRANSFER_APPLY_SQL = """
+WITH applied AS (
+    UPDATE bank.accounts a SET balance = a.balance + d.delta
+    FROM (
+        SELECT unnest(%(account_ids)s::integer[]) AS id, unnest(%(deltas)s::numeric[]) AS delta
+    ) d
+    WHERE a.id = d.id
+    RETURNING a.id, a.user_id, a.balance + (SELECT coalesce(sum(s.balance), 0) FROM bank.account_slots s WHERE s.account_id = a.id) AS balance
+), movements AS (
+    SELECT * FROM unnest(%(movement_account_ids)s::integer[], %(movement_amounts)s::numeric[],
+                         %(movement_counterparties)s::integer[])
+        WITH ORDINALITY AS m(account_id, amount, counterparty_user_id, seq)
+), ledger AS (
+    INSERT INTO bank.transactions (user_id, instrument, kind, amount, balance_after, counterparty_user_id)
+    SELECT a.user_id, 'account', CASE WHEN m.amount < 0 THEN 'transfer_out' ELSE 'transfer_in' END, m.amount,
+           a.balance - sum(m.amount) OVER (PARTITION BY m.account_id)
+                     + sum(m.amount) OVER (PARTITION BY m.account_id ORDER BY m.seq),
+           m.counterparty_user_id
+    FROM movements m JOIN applied a ON a.id = m.account_id
+    ORDER BY m.seq
+)
+SELECT id, balance FROM applied
+"""
+
+# Depósitos masivos: tabla temporal de staging cargada con COPY (se elimina al terminar la transacción)
+BULK_DEPOSIT_STAGING_SQL = """
+CREATE TEMP TABLE deposit_staging (
+    line_no BIGINT NOT NULL,
+    account_id INTEGER NOT NULL,
+    amount NUMERIC NOT NULL
+) ON COMMIT DROP
+"""
+
+BULK_DEPOSIT_COPY_SQL = "COPY deposit_staging (line_no, account_id, amount) FROM STDIN"
+
+# Bloquea en orden de id las cuentas destino antes de actualizarlas (evita deadlocks entre cargas)
+BULK_DEPOSIT_LOCK_SQL = """
+SELECT count(*) FROM (
+    SELECT id FROM bank.accounts
+    WHERE id IN (SELECT account_id FROM deposit_staging)
+    ORDER BY id
+    FOR UPDATE
+) locked
+"""
+
+# Un solo UPDATE con los montos agregados por cuenta y un movimiento por fila aplicada, en
+# orden de línea: (cuentas, filas aplicadas, monto total)
+BULK_DEPOSIT_APPLY_SQL = """
+WITH applied AS (
+    UPDATE bank.accounts a SET balance = a.balance + agg.total
+    FROM (
+        SELECT account_id, sum(amount) AS total, count(*) AS row_count
+        FROM deposit_staging
+        GROUP BY account_id
+    ) agg
+    WHERE a.id = agg.account_id
+    RETURNING a.id, a.user_id, a.balance + (SELECT coalesce(sum(s.balance), 0) FROM bank.account_slots s WHERE s.account_id = a.id) AS balance, agg.row_count, agg.total
+), ledger AS (
+    INSERT INTO bank.transactions (user_id, instrument, kind, amount, balance_after, counterparty_user_id)
+    SELECT a.user_id, 'account', 'deposit', s.amount,
+           a.balance - a.total + sum(s.amount) OVER (PARTITION BY s.account_id ORDER BY s.line_no),
+           %(cajero_id)s::integer
+    FROM deposit_staging s JOIN applied a ON a.id = s.account_id
+    ORDER BY s.line_no
+)
+SELECT count(*), coalesce(sum(row_count), 0), coalesce(sum(total), 0) FROM applied
+"""
+
+# Filas cuyo número de cuenta no existe: (línea, cuenta, total de filas rechazadas)
+BULK_DEPOSIT_UNKNOWN_SQL = """
+SELECT s.line_no, s.account_id, count(*) OVER ()
+FROM deposit_staging s
+WHERE NOT EXISTS (SELECT 1 FROM bank.accounts a WHERE a.id = s.account_id)
+ORDER BY s.line_no
+LIMIT %(limit)s
+"""
+
+# Historial de movimientos de un usuario, del más reciente al más antiguo, con paginación
+# por cursor (keyset) sobre (created_at, id): cada página es una búsqueda en el índice
+# (user_id, created_at DESC, id DESC) de cada partición, sin importar su profundidad.
+TRANSACTIONS_PAGE_SQL = """
+SELECT t.id, t.created_at, t.instrument, t.kind, t.amount, t.balance_after, cp.username
+FROM (
+    SELECT id, created_at, instrument, kind, amount, balance_after, counterparty_user_id
+    FROM bank.transactions
+    WHERE user_id = %(user_id)s
+      AND (created_at, id) < (%(before_created_at)s::timestamptz, %(before_id)s::bigint)
+    ORDER BY created_at DESC, id DESC
+    LIMIT %(limit)s
+) t
+LEFT JOIN bank.users cp ON cp.id = t.counterparty_user_id
+ORDER BY t.created_at DESC, t.id DESC
+"""
+
+# Movimientos de un usuario en [start, end), del más antiguo al más reciente, para el estado de
+# cuenta. Se lee con un cursor con nombre; el rango sobre created_at poda las particiones.
+# Las columnas salen ya como texto (fecha ISO 8601 en UTC): el driver no convierte a
+# datetime/Decimal valores que solo se van a volver a escribir en el CSV.
+STATEMENT_SQL = """
+SELECT t.id::text,
+       to_char(t.created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"'),
+       t.instrument, t.kind, t.amount::text, t.balance_after::text, cp.username
+FROM bank.transactions t
+LEFT JOIN bank.users cp ON cp.id = t.counterparty_user_id
+WHERE t.user_id = %(user_id)s
+  AND t.created_at >= %(start)s::timestamptz
+  AND t.created_at < %(end)s::timestamptz
+ORDER BY t.created_at, t.id
+"""
+
+# Movimientos del rango contados hasta `limit`: acota el costo de decidir si el estado de cuenta
+# se sirve en línea o como trabajo en segundo plano.
+STATEMENT_COUNT_SQL = """
+SELECT count(*) FROM (
+    SELECT 1 FROM bank.transactions
+    WHERE user_id = %(user_id)s
+      AND created_at >= %(start)s::timestamptz
+      AND created_at < %(end)s::timestamptz
+    LIMIT %(limit)s
+) t
+"""
+
+# Reserva uno de los `slots` turnos de exportación en línea de todo el despliegue con un advisory
+# lock de transacción; se libera al terminar la transacción de la descarga. Sin filas: no hay turno.
+STATEMENT_SLOT_SQL = """
+SELECT slot FROM generate_series(0, %(slots)s - 1) AS slot
+WHERE pg_try_advisory_xact_lock(%(lock_key)s, slot)
+LIMIT 1
+"""
+
+# Toma el trabajo de exportación pendiente más antiguo; los workers concurrentes se saltan
+# las filas ya tomadas.
+STATEMENT_JOB_CLAIM_SQL = """
+UPDATE bank.statement_jobs j
+SET status = 'running', started_at = now(), attempts = j.attempts + 1
+WHERE j.id = (
+    SELECT id FROM bank.statement_jobs
+    WHERE status = 'queued'
+    ORDER BY created_at
+    FOR UPDATE SKIP LOCKED
+    LIMIT 1
+)
+RETURNING j.id, j.user_id, j.date_from, j.date_to
+"""
+
+STATEMENT_JOB_INSERT_SQL = """
+INSERT INTO bank.statement_jobs (id, requested_by, user_id, date_from, date_to)
+VALUES (%(id)s, %(requested_by)s, %(user_id)s, %(date_from)s, %(date_to)s)
+RETURNING id, user_id, date_from, date_to, status, attempts, rows_exported, file_bytes, error,
+          created_at, started_at, finished_at
+"""
+
+# Un trabajo solo es visible para quien lo pidió
+STATEMENT_JOB_SQL = """
+SELECT id, user_id, date_from, date_to, status, attempts, rows_exported, file_bytes, error,
+       created_at, started_at, finished_at
+FROM bank.statement_jobs
+WHERE id = %(id)s AND requested_by = %(requested_by)s
+"""
+
+# Resultado guardado de una Idempotency-Key vigente, con los segundos de vigencia que le quedan
+IDEMPOTENCY_LOOKUP_SQL = """
+SELECT fingerprint, result::text,
+       extract(epoch FROM created_at + %(ttl)s::float8 * interval '1 hour' - now())
+FROM bank.idempotency_keys
+WHERE user_id = %(user_id)s AND key = %(key)s
+  AND created_at > now() - %(ttl)s::float8 * interval '1 hour'
+"""
+
+# Guarda el resultado en la transacción de la operación. Si la clave ya existe y sigue vigente
+# no devuelve filas (tras esperar a que confirme la transacción que la insertó); una clave
+# vencida que aún no se purgó se reemplaza.
+IDEMPOTENCY_STORE_SQL = """
+INSERT INTO bank.idempotency_keys (user_id, key, fingerprint, result)
+VALUES (%(user_id)s, %(key)s, %(fingerprint)s, %(result)s::json)
+ON CONFLICT (user_id, key) DO UPDATE
+SET fingerprint = EXCLUDED.fingerprint, result = EXCLUDED.result, created_at = now()
+WHERE bank.idempotency_keys.created_at <= now() - %(ttl)s::float8 * interval '1 hour'
+RETURNING 1
+"""
+
+# Borra por tandas las claves vencidas; workers concurrentes se saltan las filas ya tomadas
+IDEMPOTENCY_PURGE_SQL = """
+DELETE FROM bank.idempotency_keys
+WHERE (user_id, key) IN (
+    SELECT user_id, key FROM bank.idempotency_keys
+    WHERE created_at <= now() - %(ttl)s::float8 * interval '1 hour'
+    LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED
+)
+"""
+
+# Cuentas calientes (app/hot_accounts.py): pliega los sub-saldos en el saldo principal, incluidos
+# los que quedaron en cuentas que dejaron de ser calientes. Las cuentas bloqueadas por otra
+# operación se saltan hasta la próxima pasada; los sub-saldos se bloquean tras la cuenta (los
+# débitos esperan en la fila de la cuenta) y se descuenta lo plegado en lugar de poner 0.
+# (cuentas plegadas, monto plegado)
+HOT_ACCOUNT_FOLD_SQL = """
+WITH accts AS (
+    SELECT id FROM bank.accounts
+    WHERE id IN (SELECT account_id FROM bank.account_slots WHERE balance <> 0)
+    ORDER BY id
+    LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED
+), pending AS (
+    SELECT account_id, slot, balance FROM bank.account_slots
+    WHERE account_id IN (SELECT id FROM accts) AND balance <> 0
+    FOR NO KEY UPDATE
+), cleared AS (
+    UPDATE bank.account_slots s SET balance = s.balance - p.balance
+    FROM pending p
+    WHERE s.account_id = p.account_id AND s.slot = p.slot
+    RETURNING s.account_id
+), folded AS (
+    UPDATE bank.accounts a SET balance = a.balance + f.total
+    FROM (SELECT account_id, sum(balance) AS total FROM pending GROUP BY account_id) f
+    WHERE a.id = f.account_id
+    RETURNING f.total
+)
+SELECT count(*), coalesce(sum(total), 0) FROM folded
+"""
+
+# Activa (slots > 0) o desactiva (0) el modo de cuenta caliente: (id_cuenta, sub-saldos); sin
+# filas -> cuenta inexistente. Los sub-saldos nunca se borran: un crédito que eligió uno antes
+# del cambio sigue contando en el saldo y el plegado lo lleva al saldo principal.
+HOT_ACCOUNT_CONFIGURE_SQL = """
+WITH acct AS (
+    SELECT id FROM bank.accounts WHERE id = %(account_id)s FOR UPDATE
+), slots AS (
+    INSERT INTO bank.account_slots (account_id, slot)
+    SELECT id, generate_series(0, %(slots)s - 1) FROM acct
+    ON CONFLICT DO NOTHING
+)
+UPDATE bank.accounts SET balance_slots = %(slots)s
+WHERE id = (SELECT id FROM acct)
+RETURNING id, balance_slots
+"""
+
+# Cuentas calientes y cuentas con sub-saldos sin plegar:
+# (id_cuenta, username, sub-saldos, saldo principal, suma de sub-saldos)
+HOT_ACCOUNTS_SQL = """
+SELECT a.id, u.username, a.balance_slots, a.balance, coalesce(sum(s.balance), 0)
+FROM bank.accounts a
+LEFT JOIN bank.users u ON u.id = a.user_id
+LEFT JOIN bank.account_slots s ON s.account_id = a.id
+WHERE a.balance_slots > 0 OR a.id IN (SELECT account_id FROM bank.account_slots WHERE balance <> 0)
+GROUP BY a.id, u.username
+ORDER BY a.id
+"""
+
+# Sentencias de las rutas críticas que app/db.py prepara una vez por conexión del pool
+# (PREPARE/EXECUTE): PostgreSQL deja de analizarlas en cada ejecución y, tras las primeras,
+# reutiliza un plan genérico si no es más caro que uno calculado para los parámetros.
+PREPARED_SQL = frozenset({
+    LOGIN_SQL, BALANCE_SQL, DEPOSIT_SQL, WITHDRAW_SQL, TRANSFER_SQL, CREDIT_PAYMENT_SQL,
+    PAY_CREDIT_BALANCE_SQL, TRANSACTIONS_PAGE_SQL, IDEMPOTENCY_LOOKUP_SQL, IDEMPOTENCY_STORE_SQL,
+})
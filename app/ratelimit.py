@@ -0,0 +1,221 @@
+# app/ratelimit.py
+"""
+Límite de intentos en /auth/login y /auth/register, compartido por los workers del host.
+
+Cada límite es un token bucket ("N/S": hasta N solicitudes seguidas, que se recuperan a razón
+de N cada S segundos) por IP y, en el login, por username e IP: los intentos contra un username
+desde otras IPs no agotan el bucket de su titular. Los buckets viven en un archivo mapeado en
+memoria (RATE_LIMIT_PATH, en /dev/shm por defecto) que todos los procesos del host abren con
+mmap: una tabla asociativa por conjuntos de RATE_LIMIT_SLOTS entradas de 24 bytes. Cada
+conjunto se bloquea con un lock de rango de fcntl (entre procesos) y un threading.Lock (entre
+hilos del mismo proceso, que comparten los locks de fcntl). Con la tabla llena se reemplaza la
+entrada usada hace más tiempo del conjunto.
+
+La verificación se hace antes de leer la base o calcular bcrypt; el exceso recibe 429 con
+Retry-After. No hay bloqueo de cuentas por contraseñas incorrectas: cualquiera que conozca un
+username podría mantenerla bloqueada. Detrás de proxies, TRUSTED_PROXY_HOPS indica cuántos
+agregan X-Forwarded-For: sin él todas las solicitudes llegan con la IP del proxy y comparten
+un solo bucket.
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from werkzeug.exceptions import TooManyRequests
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_PATH = os.environ.get('RATE_LIMIT_PATH') or os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'corebank-ratelimit'
+)
+# Proxies de confianza delante de la API (nginx, balanceador): la IP del cliente es la que
+# agregó el más externo en X-Forwarded-For. 0: los clientes se conectan directamente
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '0'))
+# Entradas de la tabla compartida (24 bytes cada una)
+RATE_LIMIT_SLOTS = int(os.environ.get('RATE_LIMIT_SLOTS', '65536'))
+# Límites por endpoint y clave, "N/S"; el de username es por username e IP
+RATE_LIMITS = {
+    'login': {
+        'ip': os.environ.get('RATE_LIMIT_LOGIN_IP', '20/60'),
+        'username': os.environ.get('RATE_LIMIT_LOGIN_USERNAME', '10/60'),
+    },
+    'register': {
+        'ip': os.environ.get('RATE_LIMIT_REGISTER_IP', '10/3600'),
+    },
+}
+
+# Entrada: hash de la clave (0 = libre), tokens, última recarga (time.monotonic)
+_SLOT = struct.Struct('=Qdd')
+_WAYS = 8
+_SET_BYTES = _SLOT.size * _WAYS
+_THREAD_STRIPES = 256
+# Claves cuyo bucket es además por IP
+_PER_IP = {'username'}
+
+def client_ip(peer, forwarded_for):
+    """
+    IP del cliente a partir de la del par TCP y la cabecera X-Forwarded-For, como ProxyFix
+    (x_for=TRUSTED_PROXY_HOPS) en el modo WSGI: los valores que agregaron clientes por delante
+    de los proxies de confianza se ignoran.
+    """
+    if TRUSTED_PROXY_HOPS <= 0 or not forwarded_for:
+        return peer
+    hops = [value.strip() for value in forwarded_for.split(',')]
+    if len(hops) < TRUSTED_PROXY_HOPS:
+        return peer
+    return hops[-TRUSTED_PROXY_HOPS] or peer
+
+def parse_rule(rule):
+    """"N/S" -> (capacidad, tokens por segundo)."""
+    try:
+        count, seconds = rule.split('/')
+        capacity, per = int(count), float(seconds)
+    except ValueError:
+        raise ValueError(f"Límite inválido {rule!r}: se espera N/S, p. ej. 20/60")
+    if capacity <= 0 or per <= 0:
+        raise ValueError(f"Límite inválido {rule!r}: N y S deben ser positivos")
+    return capacity, capacity / per
+
+class SharedBuckets:
+    """Tabla de token buckets en un archivo mapeado en memoria, compartida entre procesos."""
+
+    def __init__(self, path, slots):
+        self.pid = os.getpid()
+        self.path = path
+        self.sets = max(1, slots // _WAYS)
+        size = self.sets * _SET_BYTES
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._locks = [threading.Lock() for _ in range(_THREAD_STRIPES)]
+
+    def _locate(self, key):
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        return digest, (digest % self.sets) * _SET_BYTES
+
+    def _lock(self, base):
+        lock = self._locks[(base // _SET_BYTES) % _THREAD_STRIPES]
+        lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, _SET_BYTES, base)
+        except BaseException:
+            lock.release()
+            raise
+        return lock
+
+    def _unlock(self, base, lock):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, _SET_BYTES, base)
+        finally:
+            lock.release()
+
+    def _find(self, digest, base, capacity, now):
+        """Offset y estado de la entrada de `digest`; si no existe, la crea con el bucket lleno."""
+        victim, oldest = base, math.inf
+        for offset in range(base, base + _SET_BYTES, _SLOT.size):
+            key, tokens, updated = _SLOT.unpack_from(self._map, offset)
+            if key == digest:
+                return offset, tokens, updated
+            if key == 0:
+                victim, oldest = offset, -math.inf
+            elif updated < oldest:
+                victim, oldest = offset, updated
+        return victim, float(capacity), now
+
+    def take(self, key, capacity, rate):
+        """Consume un token de `key`. Devuelve 0 si lo había, o los segundos hasta el próximo."""
+        digest, base = self._locate(key)
+        lock = self._lock(base)
+        try:
+            now = time.monotonic()
+            offset, tokens, updated = self._find(digest, base, capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            _SLOT.pack_into(self._map, offset, digest, tokens, now)
+            return wait
+        finally:
+            self._unlock(base, lock)
+
+class RateLimiter:
+    """Límites por endpoint sobre la tabla compartida, con contadores del worker actual."""
+
+    def __init__(self, buckets, limits):
+        self.buckets = buckets
+        self.limits = {endpoint: {name: parse_rule(rule) for name, rule in rules.items()}
+                       for endpoint, rules in limits.items()}
+        self._lock = threading.Lock()
+        self._stats = {'allowed': 0, 'rejected': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def check(self, endpoint, **keys):
+        """
+        Consume un intento de `endpoint` por cada clave (ip=..., username=...) con límite.
+        Si alguna no tiene tokens lanza TooManyRequests con Retry-After.
+        """
+        for name, rule in self.limits.get(endpoint, {}).items():
+            value = keys.get(name)
+            if value is None:
+                continue
+            if name in _PER_IP:
+                value = f"{value}@{keys.get('ip')}"
+            wait = self.buckets.take(f"{endpoint}:{name}:{value}", *rule)
+            if wait:
+                self._count('rejected')
+                raise TooManyRequests(
+                    "Demasiadas solicitudes. Intente nuevamente más tarde.", retry_after=math.ceil(wait)
+                )
+        self._count('allowed')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(pid=self.buckets.pid, path=self.buckets.path, slots=self.buckets.sets * _WAYS,
+                     limits={endpoint: dict(rules) for endpoint, rules in RATE_LIMITS.items()})
+        return stats
+
+class _Disabled:
+    """RATE_LIMIT_ENABLED=0: no limita nada."""
+
+    def check(self, endpoint, **keys):
+        pass
+
+    def stats(self):
+        return {'enabled': False}
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def _after_fork_in_child():
+    global _limiter_lock
+    _limiter_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def get_rate_limiter():
+    """Limitador del proceso actual; la tabla se comparte a través del archivo mapeado."""
+    global _limiter
+    limiter = _limiter
+    if limiter is not None and (not RATE_LIMIT_ENABLED or limiter.buckets.pid == os.getpid()):
+        return limiter
+    with _limiter_lock:
+        if not RATE_LIMIT_ENABLED:
+            _limiter = _Disabled()
+        elif _limiter is None or _limiter.buckets.pid != os.getpid():
+            # Los locks de fcntl son por proceso: cada worker abre su propio descriptor
+            _limiter = RateLimiter(SharedBuckets(RATE_LIMIT_PATH, RATE_LIMIT_SLOTS), RATE_LIMITS)
+        return _limiter
+
+def rate_limit_stats():
+    """Intentos admitidos y rechazados del worker actual, y límites configurados."""
+    return get_rate_limiter().stats()
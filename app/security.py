@@ -1,20 +1,255 @@
 # app/security.py
+import asyncio
 import jwt
 import datetime
 import bcrypt
+import hashlib
+import os
+import threading
+import warnings
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import wraps
 from flask import request, g, current_app
+from werkzeug.exceptions import ServiceUnavailable
+from .metrics import observe_component, timed_call
+
+# Factor de costo de bcrypt para hashes nuevos (log2 de las iteraciones)
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+# Hilos dedicados a bcrypt por worker; bcrypt libera el GIL mientras calcula
+BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', '2'))
+# Operaciones bcrypt admitidas a la vez por worker (en ejecución + en cola); el exceso recibe 503.
+# En WSGI debe ser menor que los hilos del worker (GUNICORN_THREADS): gunicorn.conf.py usa la mitad
+BCRYPT_MAX_PENDING = int(os.environ.get('BCRYPT_MAX_PENDING', '8'))
+BCRYPT_RETRY_AFTER = int(os.environ.get('BCRYPT_RETRY_AFTER', '1'))
+# Entradas máximas de la caché LRU de tokens verificados (0 la desactiva)
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', '10000'))
+
+class _BcryptPool:
+    """Pool acotado para bcrypt con control de admisión y métricas de espera y cómputo."""
+
+    def __init__(self, workers, max_pending):
+        self.pid = os.getpid()
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stats = {
+            'completed': 0,
+            'rejected': 0,
+            'queue_wait_total': 0.0,
+            'queue_wait_max': 0.0,
+            'hash_time_total': 0.0,
+            'hash_time_max': 0.0,
+        }
+
+    @contextmanager
+    def _admitted(self):
+        """Reserva un lugar entre las operaciones pendientes; sin lugar responde 503 sin esperar."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._stats['rejected'] += 1
+                raise ServiceUnavailable(
+                    "Demasiadas solicitudes de autenticación en curso. Intente nuevamente.",
+                    retry_after=BCRYPT_RETRY_AFTER
+                )
+            self._pending += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def run(self, func, *args):
+        """Ejecuta `func` en el pool y espera el resultado (hilo de gunicorn gthread)."""
+        with self._admitted():
+            return self._executor.submit(self._timed, time.monotonic(), func, *args).result()
+
+    async def run_async(self, func, *args):
+        """Igual que `run`, pero espera el resultado sin bloquear el event loop (modo ASGI)."""
+        with self._admitted():
+            return await asyncio.wrap_future(self._executor.submit(self._timed, time.monotonic(), func, *args))
+
+    def _timed(self, submitted, func, *args):
+        started = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            finished = time.monotonic()
+            observe_component('bcrypt', finished - started)
+            with self._lock:
+                self._stats['completed'] += 1
+                self._stats['queue_wait_total'] += started - submitted
+                self._stats['queue_wait_max'] = max(self._stats['queue_wait_max'], started - submitted)
+                self._stats['hash_time_total'] += finished - started
+                self._stats['hash_time_max'] = max(self._stats['hash_time_max'], finished - started)
+
+    def stats(self):
+        with self._lock:
+            completed = self._stats['completed']
+            return {
+                'pid': self.pid,
+                'rounds': BCRYPT_ROUNDS,
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self._pending,
+                'completed': completed,
+                'rejected': self._stats['rejected'],
+                'queue_wait_avg_ms': round(self._stats['queue_wait_total'] / completed * 1000, 3) if completed else 0.0,
+                'queue_wait_max_ms': round(self._stats['queue_wait_max'] * 1000, 3),
+                'hash_time_avg_ms': round(self._stats['hash_time_total'] / completed * 1000, 3) if completed else 0.0,
+                'hash_time_max_ms': round(self._stats['hash_time_max'] * 1000, 3),
+            }
+
+_bcrypt_pool = None
+_bcrypt_pool_lock = threading.Lock()
+
+def _after_fork_in_child():
+    global _bcrypt_pool_lock
+    _bcrypt_pool_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def _get_bcrypt_pool():
+    """Devuelve el pool de bcrypt del proceso actual (los hilos no sobreviven a un fork())."""
+    global _bcrypt_pool
+    pool = _bcrypt_pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _bcrypt_pool_lock:
+        if _bcrypt_pool is None or _bcrypt_pool.pid != os.getpid():
+            _bcrypt_pool = _BcryptPool(BCRYPT_WORKERS, BCRYPT_MAX_PENDING)
+        return _bcrypt_pool
+
+def _bcrypt_hash(password):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+
+def _bcrypt_check(hashed_password_bytes, password):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password_bytes)
 
 def hash_password(password):
-    """Genera un hash seguro de la contraseña usando bcrypt."""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    """Genera un hash seguro de la contraseña usando bcrypt (en el pool dedicado)."""
+    return _get_bcrypt_pool().run(_bcrypt_hash, password)
 
 def check_password(hashed_password_bytes, password):
-    """Verifica una contraseña contra su hash de bcrypt."""
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password_bytes)
+    """Verifica una contraseña contra su hash de bcrypt (en el pool dedicado)."""
+    return _get_bcrypt_pool().run(_bcrypt_check, hashed_password_bytes, password)
 
-def create_jwt(user_id, role, username=None):
-    """Crea un nuevo token JWT."""
+async def hash_password_async(password):
+    """Versión asíncrona de hash_password (modo ASGI): el cómputo ocurre en el pool de bcrypt."""
+    return await _get_bcrypt_pool().run_async(_bcrypt_hash, password)
+
+async def check_password_async(hashed_password_bytes, password):
+    """Versión asíncrona de check_password (modo ASGI)."""
+    return await _get_bcrypt_pool().run_async(_bcrypt_check, hashed_password_bytes, password)
+
+def hash_passwords(passwords, workers=None):
+    """
+    Hashea muchas contraseñas en paralelo usando todos los núcleos (bcrypt libera el GIL).
+    Pensado para cargas masivas fuera del servidor web: no pasa por el pool acotado de los workers.
+    """
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt-batch') as executor:
+        return list(executor.map(_bcrypt_hash, passwords))
+
+def bcrypt_stats():
+    """Métricas del pool de bcrypt del worker actual (cola, rechazos, tiempos)."""
+    return _get_bcrypt_pool().stats()
+
+class _TokenCache:
+    """
+    Caché LRU de tokens ya verificados: digest SHA-256 del token -> claims de g.user.
+    Cada entrada vence en el `exp` del token y la caché se vacía si cambia SECRET_KEY.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._secret_key = None
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'clears': 0}
+
+    def _check_secret(self, secret_key):
+        if secret_key != self._secret_key:
+            if self._entries:
+                self._stats['clears'] += 1
+            self._entries.clear()
+            self._secret_key = secret_key
+
+    def get(self, digest, secret_key):
+        with self._lock:
+            self._check_secret(secret_key)
+            entry = self._entries.get(digest)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            claims, exp = entry
+            if time.time() >= exp:
+                # Vencido: se descarta y jwt.decode genera el 401 habitual
+                del self._entries[digest]
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(digest)
+            self._stats['hits'] += 1
+            return claims
+
+    def put(self, digest, secret_key, claims, exp):
+        with self._lock:
+            self._check_secret(secret_key)
+            self._entries[digest] = (claims, exp)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats['clears'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        stats['maxsize'] = self.maxsize
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+_token_cache = _TokenCache(TOKEN_CACHE_SIZE)
+
+def clear_token_cache():
+    """Vacía la caché de tokens verificados (p. ej. tras rotar SECRET_KEY manualmente)."""
+    _token_cache.clear()
+
+def token_cache_stats():
+    """Contadores de aciertos y fallos de la caché de tokens del worker actual."""
+    return _token_cache.stats()
+
+def resolve_secret_key():
+    """Configuración segura del secreto JWT (compartida por el modo WSGI y el ASGI)."""
+    secret_key = os.environ.get('JWT_SECRET_KEY')
+    env_mode = os.environ.get('ENV', 'development').lower()
+    
+    if not secret_key:
+        if env_mode == 'production':
+            raise RuntimeError("JWT_SECRET_KEY es obligatorio en producción. "
+                              "Configure una clave segura de al menos 32 caracteres.")
+        else:
+            # Solo para desarrollo
+            warnings.warn("⚠️  Usando secreto temporal para desarrollo. "
+                         "Configure JWT_SECRET_KEY para producción.", 
+                         UserWarning, stacklevel=3)
+            secret_key = 'dev-secret-temp-' + str(os.urandom(16).hex())
+    return secret_key
+
+@timed_call('jwt')
+def encode_jwt(user_id, role, username, secret_key):
+    """Firma un JWT con el secreto indicado; devuelve None si falla."""
     try:
         payload = {
             'sub': user_id,
@@ -24,35 +259,58 @@ def create_jwt(user_id, role, username=None):
         }
         if username:
             payload['username'] = username
-        secret_key = current_app.config.get('SECRET_KEY')
         return jwt.encode(payload, secret_key, algorithm='HS256')
     except Exception as e:
         print(f"Error creating JWT: {e}")
         return None
 
+def create_jwt(user_id, role, username=None):
+    """Crea un nuevo token JWT."""
+    return encode_jwt(user_id, role, username, current_app.config.get('SECRET_KEY'))
+
+class TokenError(Exception):
+    """El header Authorization no contiene un JWT válido; el mensaje es la respuesta 401."""
+
+@timed_call('jwt')
+def verify_token(auth_header, secret_key):
+    """
+    Verifica el header `Authorization: Bearer <token>` y devuelve los claims del usuario
+    ({'id', 'role', 'username'}), usando la caché de tokens verificados. Lanza TokenError.
+    """
+    if not auth_header.startswith("Bearer "):
+        raise TokenError("Token de autorización ausente o en formato incorrecto (se espera 'Bearer <token>')")
+    
+    token = auth_header.split(" ")[1]
+    digest = hashlib.sha256(token.encode('utf-8')).digest() if TOKEN_CACHE_SIZE > 0 else None
+    claims = _token_cache.get(digest, secret_key) if digest else None
+    if claims is not None:
+        return dict(claims)
+    
+    try:
+        payload = jwt.decode(token, secret_key, algorithms=['HS256'])
+    except jwt.ExpiredSignatureError:
+        raise TokenError("El token ha expirado. Por favor, inicie sesión de nuevo.")
+    except jwt.InvalidTokenError:
+        raise TokenError("Token inválido. No se pudo autenticar.")
+    user = {
+        'id': payload['sub'], 
+        'role': payload['role'],
+        'username': payload.get('username')
+    }
+    if digest and 'exp' in payload:
+        _token_cache.put(digest, secret_key, dict(user), payload['exp'])
+    return user
+
 def token_required(f):
     """Decorador que protege endpoints verificando el JWT."""
     @wraps(f)
     def decorated(*args, **kwargs):
         from flask_restx import abort
         
-        auth_header = request.headers.get("Authorization", "")
-        if not auth_header.startswith("Bearer "):
-            abort(401, "Token de autorización ausente o en formato incorrecto (se espera 'Bearer <token>')")
-        
-        token = auth_header.split(" ")[1]
         try:
-            secret_key = current_app.config.get('SECRET_KEY')
-            payload = jwt.decode(token, secret_key, algorithms=['HS256'])
-            g.user = {
-                'id': payload['sub'], 
-                'role': payload['role'],
-                'username': payload.get('username')
-            }
-        except jwt.ExpiredSignatureError:
-            abort(401, "El token ha expirado. Por favor, inicie sesión de nuevo.")
-        except jwt.InvalidTokenError:
-            abort(401, "Token inválido. No se pudo autenticar.")
+            g.user = verify_token(request.headers.get("Authorization", ""), current_app.config.get('SECRET_KEY'))
+        except TokenError as e:
+            abort(401, str(e))
         
         return f(*args, **kwargs)
     return decorated
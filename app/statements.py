@@ -0,0 +1,405 @@
+# app/statements.py
+"""
+Estados de cuenta en CSV a partir del libro bank.transactions.
+
+Los movimientos se leen con un cursor con nombre (del lado del servidor) en lotes de
+STATEMENT_FETCH_SIZE filas y se escriben a medida que llegan, comprimidos con gzip si se
+pide: la memoria del worker no depende del número de movimientos. El rango de fechas poda
+las particiones mensuales del libro.
+
+- En línea (GET /bank/statement): la descarga retiene un worker y una conexión hasta
+  terminar, por eso se admiten como máximo STATEMENT_MAX_STREAMS a la vez en todo el
+  despliegue (advisory locks de transacción) y rangos de hasta STATEMENT_SYNC_MAX_ROWS
+  movimientos.
+- En segundo plano (POST /bank/statements/jobs): el trabajo queda en bank.statement_jobs
+  y un hilo de cualquier worker lo toma con su propia conexión (fuera del pool) y escribe
+  un .csv.gz en EXPORT_DIR. Si el worker muere a mitad, el trabajo se reencola hasta
+  EXPORT_JOB_MAX_ATTEMPTS veces.
+"""
+import contextlib
+import csv
+import io
+import os
+import threading
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta, timezone
+
+import psycopg2
+from werkzeug.exceptions import ServiceUnavailable
+
+from .custom_logger import log_event
+from .db import get_connection
+from .idempotency import once
+from .queries import (
+    STATEMENT_SQL, STATEMENT_COUNT_SQL, STATEMENT_SLOT_SQL, STATEMENT_JOB_CLAIM_SQL,
+    STATEMENT_JOB_INSERT_SQL, STATEMENT_JOB_SQL
+)
+
+STATEMENT_FETCH_SIZE = int(os.environ.get('STATEMENT_FETCH_SIZE', '2000'))
+# Movimientos máximos de un estado de cuenta en línea; los rangos mayores van como trabajo
+STATEMENT_SYNC_MAX_ROWS = int(os.environ.get('STATEMENT_SYNC_MAX_ROWS', '100000'))
+# Descargas en línea simultáneas en todo el despliegue; el exceso recibe 503
+STATEMENT_MAX_STREAMS = int(os.environ.get('STATEMENT_MAX_STREAMS', '4'))
+STATEMENT_RETRY_AFTER = int(os.environ.get('STATEMENT_RETRY_AFTER', '5'))
+# Directorio de los archivos de trabajos (compartido por los workers del host)
+EXPORT_DIR = os.path.abspath(os.environ.get('EXPORT_DIR', 'exports'))
+# Hilos de exportación en segundo plano por worker
+EXPORT_JOB_WORKERS = int(os.environ.get('EXPORT_JOB_WORKERS', '1'))
+# Horas que se conservan los trabajos terminados y sus archivos
+EXPORT_RETENTION_HOURS = float(os.environ.get('EXPORT_RETENTION_HOURS', '24'))
+EXPORT_JOB_MAX_ATTEMPTS = 3
+
+# Claves de advisory locks ('stmt' y 'sjob' en ASCII), en el espacio de dos enteros
+STATEMENT_SLOT_LOCK_KEY = 0x73746D74
+STATEMENT_JOB_LOCK_KEY = 0x736A6F62
+
+STATEMENT_COLUMNS = ('id', 'created_at', 'instrument', 'kind', 'amount', 'balance_after', 'counterparty')
+
+class StatementError(ValueError):
+    """Rango inválido o demasiado grande para servirse en línea; el mensaje es la respuesta 400."""
+
+def _parse_date(value, name):
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise StatementError(f"El parámetro {name} debe ser una fecha AAAA-MM-DD")
+
+def statement_dates(date_from, date_to):
+    """Días (desde, hasta) del estado de cuenta, ambos inclusive; `hasta` por defecto es hoy (UTC)."""
+    if not date_from:
+        raise StatementError("El parámetro from es obligatorio")
+    start = _parse_date(date_from, 'from')
+    end = _parse_date(date_to, 'to') if date_to else datetime.now(timezone.utc).date()
+    if start > end:
+        raise StatementError("La fecha from no puede ser posterior a to")
+    return start, end
+
+def statement_params(user_id, date_from, date_to):
+    """Parámetros de STATEMENT_SQL: el rango [desde 00:00, hasta + 1 día 00:00) en UTC."""
+    return {
+        'user_id': user_id,
+        'start': datetime.combine(date_from, time.min, timezone.utc),
+        'end': datetime.combine(date_to + timedelta(days=1), time.min, timezone.utc),
+    }
+
+def statement_filename(date_from, date_to, compressed=False):
+    return f"estado_cuenta_{date_from}_{date_to}.csv" + ('.gz' if compressed else '')
+
+class StatementEncoder:
+    """Convierte lotes de filas de STATEMENT_SQL (ya en texto) en bytes CSV, opcionalmente comprimidos con gzip."""
+
+    def __init__(self, compress):
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        self._gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        self.rows = 0
+        self.finished = False
+
+    def _flush(self):
+        data = self._buffer.getvalue().encode('utf-8')
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return self._gzip.compress(data) if self._gzip else data
+
+    def header(self):
+        self._writer.writerow(STATEMENT_COLUMNS)
+        return self._flush()
+
+    def encode(self, rows):
+        self._writer.writerows(rows)
+        self.rows += len(rows)
+        return self._flush()
+
+    def finish(self):
+        self.finished = True
+        return self._gzip.flush() if self._gzip else b''
+
+def iter_statement(conn, user_id, date_from, date_to, encoder, fetch_size=STATEMENT_FETCH_SIZE):
+    """
+    Genera los bytes del estado de cuenta leyendo de `conn` con un cursor con nombre, de a
+    `fetch_size` filas. Al terminar (o si se cierra antes) revierte la transacción de lectura.
+    """
+    cur = conn.cursor(name='statement_export')
+    try:
+        cur.execute(STATEMENT_SQL, statement_params(user_id, date_from, date_to))
+        yield encoder.header()
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            chunk = encoder.encode(rows)
+            if chunk:
+                yield chunk
+        yield encoder.finish()
+    finally:
+        with contextlib.suppress(psycopg2.Error):
+            cur.close()
+        with contextlib.suppress(psycopg2.Error):
+            conn.rollback()
+
+# ---------------- Descarga en línea ----------------
+
+def slot_params():
+    return {'slots': STATEMENT_MAX_STREAMS, 'lock_key': STATEMENT_SLOT_LOCK_KEY}
+
+def count_params(user_id, date_from, date_to):
+    return dict(statement_params(user_id, date_from, date_to), limit=STATEMENT_SYNC_MAX_ROWS + 1)
+
+def check_slot(row):
+    """`row` es el resultado de STATEMENT_SLOT_SQL: sin turno libre se responde 503."""
+    if row is None:
+        raise ServiceUnavailable(
+            "Demasiadas exportaciones de estados de cuenta en curso. Intente nuevamente.",
+            retry_after=STATEMENT_RETRY_AFTER
+        )
+
+def check_size(count):
+    if count > STATEMENT_SYNC_MAX_ROWS:
+        raise StatementError(
+            f"El rango supera {STATEMENT_SYNC_MAX_ROWS} movimientos: solicítelo como trabajo en "
+            "segundo plano (POST /bank/statements/jobs)"
+        )
+
+def open_statement(conn, user_id, date_from, date_to):
+    """
+    Prepara una descarga en línea sobre `conn`: reserva un turno y verifica el tamaño del rango.
+    El turno dura lo que la transacción de `conn`, que iter_statement revierte al terminar.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(STATEMENT_SLOT_SQL, slot_params())
+        check_slot(cur.fetchone())
+        cur.execute(STATEMENT_COUNT_SQL, count_params(user_id, date_from, date_to))
+        check_size(cur.fetchone()[0])
+    finally:
+        cur.close()
+
+# ---------------- Trabajos en segundo plano ----------------
+
+def job_from_row(row):
+    """Respuesta de los endpoints de trabajos a partir de una fila de STATEMENT_JOB_SQL."""
+    (job_id, user_id, date_from, date_to, status, attempts, rows_exported, file_bytes, error,
+     created_at, started_at, finished_at) = row
+    job = {
+        "job_id": job_id,
+        "user_id": user_id,
+        "from": date_from.isoformat(),
+        "to": date_to.isoformat(),
+        "status": status,
+        "attempts": attempts,
+        "rows_exported": rows_exported,
+        "file_bytes": file_bytes,
+        "error": error,
+        "created_at": created_at.isoformat(),
+        "started_at": started_at.isoformat() if started_at else None,
+        "finished_at": finished_at.isoformat() if finished_at else None,
+        "status_url": f"/bank/statements/jobs/{job_id}",
+    }
+    if status == 'done':
+        job["download_url"] = f"/bank/statements/jobs/{job_id}/download"
+    return job
+
+def job_params(requested_by, user_id, date_from, date_to):
+    return {
+        'id': uuid.uuid4().hex, 'requested_by': requested_by, 'user_id': user_id,
+        'date_from': date_from, 'date_to': date_to,
+    }
+
+def job_path(job_id):
+    return os.path.join(EXPORT_DIR, f"{job_id}.csv.gz")
+
+def create_job(conn, requested_by, user_id, date_from, date_to, idempotency=None):
+    """
+    Registra un trabajo de exportación y despierta a los hilos de exportación del worker.
+    Con una Idempotency-Key repetida devuelve el trabajo que se creó con ella.
+    """
+    cur = conn.cursor()
+    def insert():
+        cur.execute(STATEMENT_JOB_INSERT_SQL, job_params(requested_by, user_id, date_from, date_to))
+        return job_from_row(cur.fetchone())
+    try:
+        job = once(conn, idempotency, insert)
+        conn.commit()
+    finally:
+        cur.close()
+    if idempotency is None or not idempotency.replayed:
+        get_job_runner().wake()
+    return job
+
+def get_job(conn, job_id, requested_by):
+    """Trabajo `job_id` pedido por `requested_by`, o None."""
+    cur = conn.cursor()
+    try:
+        cur.execute(STATEMENT_JOB_SQL, {'id': job_id, 'requested_by': requested_by})
+        row = cur.fetchone()
+        conn.rollback()
+    finally:
+        cur.close()
+    return job_from_row(row) if row else None
+
+def claim_job(conn):
+    """Toma el trabajo pendiente más antiguo y retiene su lock de sesión; None si no hay."""
+    cur = conn.cursor()
+    try:
+        cur.execute(STATEMENT_JOB_CLAIM_SQL)
+        row = cur.fetchone()
+        if row is not None:
+            # Antes del commit: quien vea el trabajo en 'running' ya encuentra el lock tomado
+            cur.execute("SELECT pg_advisory_lock(%s, hashtext(%s))", (STATEMENT_JOB_LOCK_KEY, row[0]))
+        conn.commit()
+    finally:
+        cur.close()
+    return row
+
+def requeue_interrupted(conn):
+    """
+    Reencola los trabajos en 'running' cuyo worker murió (nadie retiene su lock); los que ya
+    agotaron EXPORT_JOB_MAX_ATTEMPTS intentos quedan como fallidos. Devuelve cuántos tocó.
+    """
+    cur = conn.cursor()
+    touched = 0
+    try:
+        cur.execute("SELECT id FROM bank.statement_jobs WHERE status = 'running'")
+        for (job_id,) in cur.fetchall():
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s, hashtext(%s))", (STATEMENT_JOB_LOCK_KEY, job_id))
+            if not cur.fetchone()[0]:
+                continue
+            cur.execute("""
+                UPDATE bank.statement_jobs
+                SET status = CASE WHEN attempts >= %(max_attempts)s THEN 'failed' ELSE 'queued' END,
+                    error = CASE WHEN attempts >= %(max_attempts)s THEN 'Trabajo interrumpido' END,
+                    finished_at = CASE WHEN attempts >= %(max_attempts)s THEN now() END
+                WHERE id = %(id)s AND status = 'running'
+            """, {'id': job_id, 'max_attempts': EXPORT_JOB_MAX_ATTEMPTS})
+            touched += cur.rowcount
+        conn.commit()
+    finally:
+        cur.close()
+    return touched
+
+def purge_expired(conn):
+    """Borra los trabajos terminados hace más de EXPORT_RETENTION_HOURS y sus archivos."""
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            DELETE FROM bank.statement_jobs
+            WHERE status IN ('done', 'failed') AND finished_at < now() - %s * interval '1 hour'
+            RETURNING id
+        """, (EXPORT_RETENTION_HOURS,))
+        expired = [job_id for (job_id,) in cur.fetchall()]
+        conn.commit()
+    finally:
+        cur.close()
+    for job_id in expired:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(job_path(job_id))
+    return len(expired)
+
+def export_job(conn, job_id, user_id, date_from, date_to):
+    """Escribe el estado de cuenta comprimido en EXPORT_DIR (vía un .part renombrado). Devuelve (filas, bytes)."""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = job_path(job_id)
+    partial = path + '.part'
+    encoder = StatementEncoder(compress=True)
+    try:
+        with open(partial, 'wb') as f:
+            for chunk in iter_statement(conn, user_id, date_from, date_to, encoder):
+                f.write(chunk)
+        os.replace(partial, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(partial)
+        raise
+    return encoder.rows, os.path.getsize(path)
+
+class _JobRunner:
+    """Hilos de exportación del worker actual; cada wake() procesa los trabajos pendientes."""
+
+    def __init__(self, workers):
+        self.pid = os.getpid()
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='statement-export')
+        self._lock = threading.Lock()
+        self._stats = {'completed': 0, 'failed': 0, 'rows_exported': 0, 'requeued': 0}
+
+    def wake(self):
+        self._executor.submit(self._drain)
+
+    def _drain(self):
+        try:
+            conn = get_connection()
+        except psycopg2.Error as e:
+            log_event('ERROR', f"Exportación en segundo plano sin conexión: {e}", status_code=503)
+            return
+        try:
+            requeued = requeue_interrupted(conn)
+            purge_expired(conn)
+            with self._lock:
+                self._stats['requeued'] += requeued
+            while True:
+                job = claim_job(conn)
+                if job is None:
+                    return
+                self._run(conn, *job)
+        except psycopg2.Error as e:
+            log_event('ERROR', f"Error en la cola de exportaciones: {e}", status_code=500)
+        finally:
+            conn.close()
+
+    def _run(self, conn, job_id, user_id, date_from, date_to):
+        cur = conn.cursor()
+        try:
+            rows, size = export_job(conn, job_id, user_id, date_from, date_to)
+            cur.execute("""
+                UPDATE bank.statement_jobs
+                SET status = 'done', rows_exported = %s, file_bytes = %s, error = NULL, finished_at = now()
+                WHERE id = %s
+            """, (rows, size, job_id))
+            conn.commit()
+            with self._lock:
+                self._stats['completed'] += 1
+                self._stats['rows_exported'] += rows
+            log_event('INFO', f"Estado de cuenta {job_id} exportado: {rows} movimientos", status_code=200, user_id=user_id)
+        except (psycopg2.Error, OSError) as e:
+            conn.rollback()
+            cur.execute("""
+                UPDATE bank.statement_jobs SET status = 'failed', error = %s, finished_at = now() WHERE id = %s
+            """, (str(e)[:500], job_id))
+            conn.commit()
+            with self._lock:
+                self._stats['failed'] += 1
+            log_event('ERROR', f"Exportación {job_id} fallida: {e}", status_code=500, user_id=user_id)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s, hashtext(%s))", (STATEMENT_JOB_LOCK_KEY, job_id))
+            conn.commit()
+            cur.close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pid=self.pid, workers=self.workers)
+
+_runner = None
+_runner_lock = threading.Lock()
+
+def _after_fork_in_child():
+    global _runner_lock
+    _runner_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def get_job_runner():
+    """Hilos de exportación del proceso actual (los hilos no sobreviven a un fork())."""
+    global _runner
+    runner = _runner
+    if runner is not None and runner.pid == os.getpid():
+        return runner
+    with _runner_lock:
+        if _runner is None or _runner.pid != os.getpid():
+            _runner = _JobRunner(EXPORT_JOB_WORKERS)
+        return _runner
+
+def export_stats():
+    """Trabajos de exportación completados, fallidos y reencolados por el worker actual."""
+    return get_job_runner().stats()
@@ -68,4 +68,86 @@ def validar_password(password: str, info_personal: dict) -> bool:
                 if len(parte) > 2 and parte in password.lower():
                     return False
     
-    return True
\ No newline at end of file
+    return True
+
+# ---------------- Validación por lotes (vectorizada) ----------------
+# Las funciones escalares de arriba son la referencia: las versiones por lote deben dar
+# exactamente el mismo resultado para cualquier entrada.
+
+_COEFICIENTES_CEDULA = (2, 1, 2, 1, 2, 1, 2, 1, 2)
+
+def _matriz_codigos(valores):
+    """
+    Convierte una secuencia de valores en una matriz (n, 10) de code points.
+    Devuelve (codigos, longitud_ok, valores): longitud_ok es False para entradas que no son
+    str o cuya longitud no es 10; sus filas quedan en cero.
+    Concatena todo en un solo buffer y extrae las filas por desplazamiento, sin recorrer
+    los caracteres en Python.
+    """
+    import numpy as np
+    valores = valores if isinstance(valores, list) else list(valores)
+    n = len(valores)
+    if all(type(v) is str for v in valores):
+        textos = valores
+    else:
+        textos = [v if isinstance(v, str) else '' for v in valores]
+    longitudes = np.fromiter(map(len, textos), dtype=np.int64, count=n)
+    longitud_ok = longitudes == 10
+    
+    datos = ''.join(textos)
+    if datos.isascii():
+        plano = np.frombuffer(datos.encode('ascii'), dtype=np.uint8)
+    else:
+        plano = np.frombuffer(datos.encode('utf-32-le', errors='surrogatepass'), dtype=np.uint32)
+    if longitud_ok.all():
+        return plano.reshape(n, 10), longitud_ok, valores
+    codigos = np.zeros((n, 10), dtype=plano.dtype)
+    if longitud_ok.any():
+        # Ventana deslizante de 10 caracteres sobre el buffer: cada fila válida es la ventana en su inicio
+        inicios = np.cumsum(longitudes) - longitudes
+        ventanas = np.lib.stride_tricks.sliding_window_view(plano, 10)
+        codigos[longitud_ok] = ventanas[inicios[longitud_ok]]
+    return codigos, longitud_ok, valores
+
+def _aplicar_fallback(resultado, codigos, longitud_ok, valores, validador):
+    """
+    Filas con caracteres no ASCII (p. ej. dígitos Unicode que acepta str.isdigit) se
+    resuelven con la versión escalar; si esta falla al convertir el dígito, la fila es inválida.
+    """
+    import numpy as np
+    for i in np.flatnonzero(longitud_ok & (codigos > 127).any(axis=1)):
+        try:
+            resultado[i] = validador(valores[i])
+        except ValueError:
+            resultado[i] = False
+    return resultado
+
+def validar_cedula_batch(cedulas):
+    """Versión vectorizada de validar_cedula: recibe una secuencia de strings y devuelve una máscara booleana (numpy)."""
+    import numpy as np
+    codigos, longitud_ok, valores = _matriz_codigos(cedulas)
+    if not len(valores):
+        return np.zeros(0, dtype=bool)
+    # Aritmética en uint8: los code points menores a '0' se desbordan a valores > 9
+    digitos = (np.minimum(codigos, 255).astype(np.uint8) if codigos.dtype != np.uint8 else codigos) - np.uint8(48)
+    ok = longitud_ok & (digitos <= 9).all(axis=1)
+    
+    provincia = digitos[:, 0] * np.uint8(10) + digitos[:, 1]
+    ok &= (provincia >= 1) & (provincia <= 24)
+    ok &= digitos[:, 2] < 6
+    
+    productos = digitos[:, :9] * np.array(_COEFICIENTES_CEDULA, dtype=np.uint8)
+    productos -= np.uint8(9) * (productos >= 10)
+    residuo = productos.sum(axis=1, dtype=np.uint16) % 10
+    ok &= (10 - residuo) % 10 == digitos[:, 9]
+    return _aplicar_fallback(ok, codigos, longitud_ok, valores, validar_cedula)
+
+def validar_celular_batch(celulares):
+    """Versión vectorizada de validar_celular: recibe una secuencia de strings y devuelve una máscara booleana (numpy)."""
+    import numpy as np
+    codigos, longitud_ok, valores = _matriz_codigos(celulares)
+    if not len(valores):
+        return np.zeros(0, dtype=bool)
+    ok = longitud_ok & ((codigos >= 48) & (codigos <= 57)).all(axis=1)
+    ok &= (codigos[:, 0] == ord('0')) & (codigos[:, 1] == ord('9'))
+    return _aplicar_fallback(ok, codigos, longitud_ok, valores, validar_celular)
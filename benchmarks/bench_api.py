@@ -0,0 +1,421 @@
+# benchmarks/bench_api.py
+"""
+Suite de carga reproducible de la API bancaria contra un PostgreSQL local desechable.
+
+1. Crea un cluster temporal con initdb/pg_ctl (sin Docker; binarios de --pg-bin, PG_BIN, el
+   PATH o `pg_config --bindir`) y aplica el esquema con init_db(). Con --existing-db usa la
+   base de POSTGRES_HOST/PORT/DB/USER/PASSWORD.
+2. Siembra --users clientes con cuenta y tarjeta (misma contraseña, un solo hash bcrypt con
+   BCRYPT_ROUNDS) y un cajero para los depósitos.
+3. Levanta la API (--mode wsgi: gunicorn, app.main; asgi: uvicorn, app.asgi) con --workers
+   workers y RATE_LIMIT_ENABLED=0 (toda la carga sale de una IP).
+4. --concurrency usuarios virtuales, repartidos en --client-procs procesos, eligen operaciones
+   según --mix con un generador por usuario derivado de --seed; una petición en vuelo por
+   usuario. Tras --warmup segundos se mide durante --duration segundos.
+
+Informa por operación peticiones por segundo, latencias p50/p95/p99 y códigos de estado
+(4xx son rechazos de negocio; 5xx y fallos de conexión, errores). --json guarda el resultado;
+--baseline lo compara con uno guardado y termina con código 1 si alguna operación perdió
+más de --tolerance de throughput o subió más de --tolerance su p95 o p99.
+
+Uso:
+    python -m benchmarks.bench_api [--mode wsgi|asgi] [--workers 2] [--users 1000]
+        [--concurrency 32] [--duration 30] [--warmup 5] [--seed 1]
+        [--mix login=2,balance=15,transactions=8,deposit=10,withdraw=20,transfer=20,credit_payment=15,pay_credit=10]
+        [--json benchmarks/baseline.json] [--baseline benchmarks/baseline.json] [--tolerance 0.10]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+
+PASSWORD = 'Bench-Api-2024!'
+DEFAULT_MIX = 'login=2,balance=15,transactions=8,deposit=10,withdraw=20,transfer=20,credit_payment=15,pay_credit=10'
+
+SERVERS = {
+    'wsgi': lambda port, workers: ['gunicorn', '-c', 'gunicorn.conf.py', '--workers', str(workers),
+                                   '--bind', f'127.0.0.1:{port}', 'app.main:app'],
+    'asgi': lambda port, workers: ['uvicorn', 'app.asgi:app', '--workers', str(workers), '--host', '127.0.0.1',
+                                   '--port', str(port), '--log-level', 'warning'],
+}
+
+# ---------------- PostgreSQL desechable ----------------
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def pg_bin_dir(explicit):
+    """Directorio con initdb y pg_ctl."""
+    candidates = [explicit, os.environ.get('PG_BIN')]
+    if shutil.which('initdb'):
+        candidates.append(os.path.dirname(shutil.which('initdb')))
+    if shutil.which('pg_config'):
+        candidates.append(subprocess.run(['pg_config', '--bindir'], capture_output=True, text=True).stdout.strip())
+    for directory in filter(None, candidates):
+        if os.path.isfile(os.path.join(directory, 'initdb')) and os.path.isfile(os.path.join(directory, 'pg_ctl')):
+            return directory
+    raise SystemExit("No se encontraron initdb y pg_ctl: indique --pg-bin o PG_BIN, o use --existing-db")
+
+class LocalPostgres:
+    """Cluster temporal en un directorio propio; se detiene y se borra al salir."""
+
+    def __init__(self, bin_dir, port):
+        self.bin_dir = bin_dir
+        self.port = port
+        self.root = tempfile.mkdtemp(prefix='corebank-bench-pg-')
+        self.data = os.path.join(self.root, 'data')
+
+    def _run(self, tool, *args):
+        subprocess.run([os.path.join(self.bin_dir, tool), *args], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def __enter__(self):
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            raise SystemExit("initdb no se puede ejecutar como root: use un usuario sin privilegios o --existing-db")
+        try:
+            self._run('initdb', '-D', self.data, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8', '--no-sync')
+            self._run('pg_ctl', '-D', self.data, '-l', os.path.join(self.root, 'postgres.log'), '-w', 'start', '-o',
+                      f"-p {self.port} -k {self.root} -c listen_addresses=127.0.0.1 -c max_connections=200")
+        except subprocess.CalledProcessError as e:
+            shutil.rmtree(self.root, ignore_errors=True)
+            raise SystemExit(f"No se pudo iniciar PostgreSQL: {e.stderr.decode(errors='replace').strip()}")
+        import psycopg2
+        conn = psycopg2.connect(host='127.0.0.1', port=self.port, user='postgres', dbname='postgres')
+        conn.autocommit = True
+        conn.cursor().execute("CREATE DATABASE corebank")
+        conn.close()
+        return {'POSTGRES_HOST': '127.0.0.1', 'POSTGRES_PORT': str(self.port), 'POSTGRES_DB': 'corebank',
+                'POSTGRES_USER': 'postgres', 'POSTGRES_PASSWORD': ''}
+
+    def __exit__(self, *exc):
+        subprocess.run([os.path.join(self.bin_dir, 'pg_ctl'), '-D', self.data, '-m', 'fast', '-w', 'stop'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+# ---------------- Datos ----------------
+
+def seed(count, secret_key):
+    """
+    Aplica el esquema y crea `count` clientes y un cajero. Devuelve los usuarios como
+    (username, número de cuenta, token) y el token del cajero.
+    """
+    # Se importan después de fijar POSTGRES_* en el entorno (app.db los lee al importarse)
+    from psycopg2.extras import execute_values
+    from app.db import get_connection, init_db
+    from app.security import encode_jwt, hash_passwords
+
+    init_db()
+    prefix = f"bench_{secrets.token_hex(4)}"
+    hashed = hash_passwords([PASSWORD], workers=1)[0]
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        rows = [(f"{prefix}_{i}", hashed, 'cliente', 'Bench Api', f"{prefix}_{i}@bench.local") for i in range(count)]
+        rows.append((f"{prefix}_cajero", hashed, 'cajero', 'Bench Cajero', f"{prefix}_cajero@bench.local"))
+        users = execute_values(
+            cur, "INSERT INTO bank.users (username, password, role, full_name, email) VALUES %s RETURNING id, username, role",
+            rows, page_size=1000, fetch=True
+        )
+        accounts = execute_values(
+            cur, "INSERT INTO bank.accounts (balance, user_id) VALUES %s RETURNING id, user_id",
+            [(10 ** 9, user_id) for user_id, _, _ in users], page_size=1000, fetch=True
+        )
+        execute_values(cur, "INSERT INTO bank.credit_cards (limit_credit, balance, user_id) VALUES %s",
+                       [(10 ** 9, 0, user_id) for user_id, _, _ in users], page_size=1000)
+        cur.execute("ANALYZE")
+        conn.commit()
+        cur.execute("SHOW server_version")
+        server_version = cur.fetchone()[0]
+    finally:
+        conn.close()
+    account_of = {user_id: account_id for account_id, user_id in accounts}
+    clients, cajero = [], None
+    for user_id, username, role in users:
+        token = encode_jwt(user_id, role, username, secret_key)
+        if role == 'cajero':
+            cajero = token
+        else:
+            clients.append((username, account_of[user_id], token))
+    return clients, cajero, server_version
+
+# ---------------- Carga ----------------
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Operación desconocida {name!r}; válidas: {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def _amount(rng):
+    return round(rng.uniform(0.01, 5), 2)
+
+def _other(rng, user, clients):
+    """Otro cliente al azar (transferirse a sí mismo se rechaza con 400)."""
+    target = rng.choice(clients)
+    while target is user and len(clients) > 1:
+        target = rng.choice(clients)
+    return target
+
+# Operación -> (método, ruta, cuerpo(rng, usuario, clientes) o None)
+OPERATIONS = {
+    'login': ('POST', '/auth/login', lambda rng, user, clients: {'username': user[0], 'password': PASSWORD}),
+    'balance': ('GET', '/bank/balance', None),
+    'transactions': ('GET', '/bank/transactions?limit=20', None),
+    'deposit': ('POST', '/bank/deposit',
+                lambda rng, user, clients: {'account_number': rng.choice(clients)[1], 'amount': _amount(rng)}),
+    'withdraw': ('POST', '/bank/withdraw', lambda rng, user, clients: {'amount': _amount(rng)}),
+    'transfer': ('POST', '/bank/transfer',
+                 lambda rng, user, clients: {'target_username': _other(rng, user, clients)[0], 'amount': _amount(rng)}),
+    'credit_payment': ('POST', '/bank/credit-payment', lambda rng, user, clients: {'amount': _amount(rng)}),
+    'pay_credit': ('POST', '/bank/pay-credit-balance', lambda rng, user, clients: {'amount': _amount(rng)}),
+}
+
+async def _drive(base_url, users, clients, cajero, mix, seeds, measure_from, until):
+    """Un usuario virtual por semilla; devuelve {operación: {'latencies': [...], 'status': {...}}}."""
+    results = {name: {'latencies': [], 'status': {}} for name in mix}
+    names, weights = list(mix), list(mix.values())
+    limits = httpx.Limits(max_connections=len(seeds), max_keepalive_connections=len(seeds))
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def virtual_user(index, seed_value):
+            rng = random.Random(seed_value)
+            user = users[index % len(users)]
+            token = user[2]
+            while True:
+                name = rng.choices(names, weights)[0]
+                method, path, body = OPERATIONS[name]
+                auth = cajero if name == 'deposit' else token
+                headers = {} if name == 'login' else {'Authorization': f'Bearer {auth}'}
+                payload = body(rng, user, clients) if body else None
+                started = time.time()
+                if started >= until:
+                    return
+                try:
+                    response = await client.request(method, path, json=payload, headers=headers)
+                    status = str(response.status_code)
+                    if name == 'login' and response.status_code == 200:
+                        token = response.json()['token']
+                except httpx.HTTPError:
+                    status = 'error'
+                elapsed = time.time() - started
+                if started >= measure_from:
+                    results[name]['latencies'].append(elapsed)
+                    results[name]['status'][status] = results[name]['status'].get(status, 0) + 1
+        await asyncio.gather(*(virtual_user(index, seed_value) for index, seed_value in seeds))
+    return results
+
+def run_client(base_url, users, clients, cajero, mix, seeds, measure_from, until):
+    """Proceso cliente: su propio event loop y sus usuarios virtuales."""
+    return asyncio.run(_drive(base_url, users, clients, cajero, mix, seeds, measure_from, until))
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+def summarize(latencies, status, duration):
+    ordered = sorted(latencies)
+    errors = sum(count for code, count in status.items() if code == 'error' or code.startswith('5'))
+    rejected = sum(count for code, count in status.items() if code.startswith('4'))
+    return {
+        'requests': len(ordered),
+        'throughput': round(len(ordered) / duration, 2),
+        'p50_ms': round(_percentile(ordered, 0.50) * 1000, 3),
+        'p95_ms': round(_percentile(ordered, 0.95) * 1000, 3),
+        'p99_ms': round(_percentile(ordered, 0.99) * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        'rejected': rejected,
+        'errors': errors,
+        'status': dict(sorted(status.items())),
+    }
+
+# ---------------- Comparación ----------------
+
+def compare(current, baseline, tolerance, min_requests=50):
+    """Regresiones de `current` frente a `baseline`: (operación, métrica, antes, ahora)."""
+    regressions = []
+    for name, before in baseline['operations'].items():
+        now = current['operations'].get(name)
+        if now is None or before['requests'] < min_requests or now['requests'] < min_requests:
+            continue
+        if now['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append((name, 'throughput', before['throughput'], now['throughput']))
+        for metric in ('p95_ms', 'p99_ms'):
+            if now[metric] > before[metric] * (1 + tolerance):
+                regressions.append((name, metric, before[metric], now[metric]))
+    return regressions
+
+def print_report(result, baseline=None):
+    header = f"{'operación':<15} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'4xx':>6} {'err':>6}"
+    print(header)
+    print('-' * len(header))
+    previous = dict(baseline['operations'], total=baseline['total']) if baseline else {}
+    for name, stats in list(result['operations'].items()) + [('total', result['total'])]:
+        line = (f"{name:<15} {stats['throughput']:>9.1f} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} "
+                f"{stats['p99_ms']:>9.2f} {stats['rejected']:>6} {stats['errors']:>6}")
+        before = previous.get(name)
+        if before and before['throughput'] and before['p95_ms']:
+            line += (f"   ({(stats['throughput'] / before['throughput'] - 1) * 100:+.1f}% req/s, "
+                     f"{(stats['p95_ms'] / before['p95_ms'] - 1) * 100:+.1f}% p95)")
+        print(line)
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _cpu_model():
+    try:
+        with open('/proc/cpuinfo', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or None
+
+def _memory_gb():
+    try:
+        return round(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30, 1)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def wait_ready(base_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(base_url + '/ops/stats', timeout=1).status_code == 401:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"El servidor en {base_url} no respondió en {timeout}s")
+
+def benchmark(args, env):
+    clients, cajero, server_version = seed(args.users, env['JWT_SECRET_KEY'])
+    port = args.port or free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    server = subprocess.Popen(SERVERS[args.mode](port, args.workers), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(base_url)
+        procs = max(1, min(args.client_procs, args.concurrency))
+        seeds = [(index, args.seed * 1_000_003 + index) for index in range(args.concurrency)]
+        measure_from = time.time() + 1 + args.warmup
+        until = measure_from + args.duration
+        with ProcessPoolExecutor(max_workers=procs) as executor:
+            futures = [executor.submit(run_client, base_url, clients, clients, cajero, args.mix, seeds[i::procs],
+                                       measure_from, until) for i in range(procs)]
+            parts = [future.result() for future in futures]
+    finally:
+        server.terminate()
+        server.wait()
+
+    operations, all_latencies, all_status = {}, [], {}
+    for name in args.mix:
+        latencies = [value for part in parts for value in part[name]['latencies']]
+        status = {}
+        for part in parts:
+            for code, count in part[name]['status'].items():
+                status[code] = status.get(code, 0) + count
+                all_status[code] = all_status.get(code, 0) + count
+        all_latencies += latencies
+        operations[name] = summarize(latencies, status, args.duration)
+    return {
+        'meta': {
+            'revision': _git_revision(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'mode': args.mode,
+            'workers': args.workers,
+            'existing_db': args.existing_db,
+            'users': args.users,
+            'concurrency': args.concurrency,
+            'client_procs': procs,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'seed': args.seed,
+            'mix': args.mix,
+            'bcrypt_rounds': int(env.get('BCRYPT_ROUNDS', '12')),
+            'postgres': server_version,
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'cpu_model': _cpu_model(),
+            'memory_gb': _memory_gb(),
+            'platform': platform.platform(),
+        },
+        'operations': operations,
+        'total': summarize(all_latencies, all_status, args.duration),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=sorted(SERVERS), default='wsgi')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--client-procs', type=int, default=2, help='Procesos que generan la carga')
+    parser.add_argument('--duration', type=float, default=30, help='Segundos medidos')
+    parser.add_argument('--warmup', type=float, default=5, help='Segundos de carga previos, sin medir')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help='operación=peso,...')
+    parser.add_argument('--port', type=int, default=0, help='Puerto de la API (0: uno libre)')
+    parser.add_argument('--existing-db', action='store_true', help='Usar la base de POSTGRES_* en lugar de un cluster temporal')
+    parser.add_argument('--pg-bin', help='Directorio con initdb y pg_ctl')
+    parser.add_argument('--json', help='Archivo donde guardar el resultado (sirve como línea base)')
+    parser.add_argument('--baseline', help='Resultado guardado con el que comparar')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Empeoramiento admitido (0.10 = 10%%)')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    env = dict(os.environ)
+    env.setdefault('JWT_SECRET_KEY', 'bench-api-' + 'x' * 32)
+    env['RATE_LIMIT_ENABLED'] = '0'
+    with contextlib.ExitStack() as stack:
+        if not args.existing_db:
+            env.update(stack.enter_context(LocalPostgres(pg_bin_dir(args.pg_bin), free_port())))
+        os.environ.update(env)
+        # Este proceso no es parte del servidor: no debe sumar series a su /metrics
+        os.environ['METRICS_ENABLED'] = '0'
+        print(f"{args.mode}, {args.workers} workers, {args.users} usuarios, {args.concurrency} concurrentes, "
+              f"{args.warmup:g}+{args.duration:g} s, semilla {args.seed}")
+        result = benchmark(args, env)
+
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Resultado guardado en {args.json}")
+    if baseline:
+        regressions = compare(result, baseline, args.tolerance)
+        for name, metric, before, now in regressions:
+            print(f"REGRESIÓN {name} {metric}: {before} -> {now}")
+        if regressions:
+            return 1
+        print(f"Sin regresiones frente a {args.baseline} (tolerancia {args.tolerance:.0%})")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
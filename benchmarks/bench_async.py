@@ -0,0 +1,114 @@
+# benchmarks/bench_async.py
+"""
+Throughput y latencia del modo WSGI (gunicorn, app.main) frente al modo ASGI (uvicorn, app.asgi).
+
+Levanta un proceso de cada modo con un solo worker, crea `--concurrency` clientes con saldo
+directamente en la base (tokens firmados con JWT_SECRET_KEY, sin login) y dispara retiros
+(POST /bank/withdraw), una petición en vuelo por cliente. Informa peticiones por segundo y
+latencias p50/p99 de cada modo.
+
+Uso (con POSTGRES_HOST/PORT/DB/USER/PASSWORD apuntando a una base migrada y
+requirements-async.txt instalado):
+    python -m benchmarks.bench_async [--requests 2000] [--concurrency 64]
+"""
+import argparse
+import asyncio
+import os
+import secrets
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from app.db import get_connection
+from app.security import encode_jwt
+
+SERVERS = {
+    'wsgi (gunicorn)': lambda port: ['gunicorn', '-c', 'gunicorn.conf.py', '--workers', '1', '--bind', f'127.0.0.1:{port}', 'app.main:app'],
+    'asgi (uvicorn)': lambda port: ['uvicorn', 'app.asgi:app', '--workers', '1', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+}
+
+def create_users(count, balance, secret_key):
+    """Clientes con cuenta y saldo, insertados sin pasar por /auth/register; devuelve sus tokens."""
+    prefix = f"bench_async_{secrets.token_hex(4)}"
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        tokens = []
+        for i in range(count):
+            username = f"{prefix}_{i}"
+            cur.execute(
+                "INSERT INTO bank.users (username, password, role, full_name, email) VALUES (%s, %s, 'cliente', %s, %s) RETURNING id",
+                (username, b'-', 'Bench Async', f"{username}@bench.local")
+            )
+            user_id = cur.fetchone()[0]
+            cur.execute("INSERT INTO bank.accounts (balance, user_id) VALUES (%s, %s)", (balance, user_id))
+            tokens.append(encode_jwt(user_id, 'cliente', username, secret_key))
+        conn.commit()
+    finally:
+        conn.close()
+    return tokens
+
+def wait_ready(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(base_url + '/ops/stats', timeout=1).status_code == 401:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"El servidor en {base_url} no respondió en {timeout}s")
+
+async def load(base_url, tokens, total):
+    """Dispara `total` retiros, uno en vuelo por token (cuentas distintas, sin contención de filas)."""
+    latencies = []
+    errors = 0
+    pending = iter(range(total))
+    limits = httpx.Limits(max_connections=len(tokens), max_keepalive_connections=len(tokens))
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def worker(token):
+            nonlocal errors
+            headers = {'Authorization': f'Bearer {token}'}
+            for _ in pending:
+                start = time.perf_counter()
+                response = await client.post('/bank/withdraw', json={'amount': 0.01}, headers=headers)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(token) for token in tokens))
+    return time.perf_counter() - started, latencies, errors
+
+def run(name, command, args, env):
+    base_url = f'http://127.0.0.1:{args.port}'
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(base_url)
+        tokens = create_users(args.concurrency, args.requests, env['JWT_SECRET_KEY'])
+        asyncio.run(load(base_url, tokens, min(args.requests, 100)))  # calentamiento
+        elapsed, latencies, errors = asyncio.run(load(base_url, tokens, args.requests))
+    finally:
+        server.terminate()
+        server.wait()
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{name:<18} {args.requests / elapsed:8.0f} req/s   p50 {quantiles[49] * 1000:7.1f} ms   "
+          f"p99 {quantiles[98] * 1000:7.1f} ms   errores {errors}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--port', type=int, default=18080)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault('JWT_SECRET_KEY', 'bench-async-' + 'x' * 32)
+    print(f"{args.requests} retiros, {args.concurrency} concurrentes, 1 worker por modo")
+    for name, command in SERVERS.items():
+        run(name, command(args.port), args, env)
+
+if __name__ == '__main__':
+    sys.exit(main())
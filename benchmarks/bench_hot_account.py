@@ -0,0 +1,163 @@
+# benchmarks/bench_hot_account.py
+"""
+Contención en una cuenta caliente: muchos hilos acreditan la misma cuenta (depósitos de
+cajero y transferencias de nómina desde cuentas distintas) con las sentencias de
+app/queries.py, primero con un solo saldo y luego con --slots sub-saldos (app/hot_accounts.py),
+mientras un hilo pliega los sub-saldos cada --fold-interval segundos.
+
+Reporta operaciones por segundo y latencias de cada modo, y verifica que el saldo lógico
+final de la cuenta es el inicial más lo acreditado y coincide con la suma de su libro.
+
+Uso (con POSTGRES_HOST/PORT/DB/USER/PASSWORD apuntando a la base migrada):
+    python -m benchmarks.bench_hot_account [--threads 32] [--duration 10] [--slots 16]
+"""
+import argparse
+import random
+import statistics
+import sys
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from app.db import get_connection
+from app.hot_accounts import configure, fold
+from app.queries import BALANCE_SQL, DEPOSIT_SQL, TRANSFER_SQL
+
+def crear_cliente(cur, username, saldo):
+    cur.execute(
+        "INSERT INTO bank.users (username, password, role, full_name, email) VALUES (%s, %s, 'cliente', %s, %s) RETURNING id",
+        (username, b'-', username, f"{username}@bench.local")
+    )
+    user_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO bank.accounts (balance, user_id) VALUES (%s, %s) RETURNING id", (saldo, user_id))
+    return user_id, cur.fetchone()[0]
+
+def saldo_y_libro(cur, user_id):
+    cur.execute(BALANCE_SQL, {'user_id': user_id})
+    saldo = cur.fetchone()[0]
+    cur.execute("SELECT coalesce(sum(amount), 0) FROM bank.transactions WHERE user_id = %s AND instrument = 'account'", (user_id,))
+    return saldo, cur.fetchone()[0]
+
+def correr(args, slots):
+    """Una pasada de --duration segundos contra una cuenta nueva con `slots` sub-saldos."""
+    sufijo = uuid.uuid4().hex[:8]
+    conn = get_connection()
+    cur = conn.cursor()
+    hot_user, hot_account = crear_cliente(cur, f"hot{sufijo}", Decimal('0'))
+    cajero = crear_cliente(cur, f"cajero{sufijo}", Decimal('0'))[0]
+    pagadores = [crear_cliente(cur, f"payroll{sufijo}{i}", Decimal('1000000'))[0] for i in range(args.threads)]
+    conn.commit()
+    if slots:
+        configure(conn, hot_account, slots)
+
+    latencias = []
+    acreditado = []
+    errores = []
+    lock = threading.Lock()
+    fin = time.monotonic() + args.duration
+    arranque = threading.Barrier(args.threads + 1)
+
+    def trabajador(i):
+        rnd = random.Random(i)
+        c = get_connection()
+        k = c.cursor()
+        propias, total = [], Decimal('0')
+        arranque.wait()
+        try:
+            while time.monotonic() < fin:
+                monto = Decimal(rnd.randint(1, 100))
+                inicio = time.perf_counter()
+                try:
+                    if rnd.random() < args.transfer_ratio:
+                        k.execute(TRANSFER_SQL, {'sender_id': pagadores[i], 'target_username': f"hot{sufijo}", 'amount': monto})
+                        ok = k.fetchone()[3] is not None
+                    else:
+                        k.execute(DEPOSIT_SQL, {'account_id': hot_account, 'amount': monto, 'cajero_id': cajero})
+                        ok = k.fetchone() is not None
+                    c.commit()
+                except Exception as e:
+                    c.rollback()
+                    with lock:
+                        errores.append(repr(e))
+                    continue
+                propias.append(time.perf_counter() - inicio)
+                if ok:
+                    total += monto
+        finally:
+            k.close()
+            c.close()
+            with lock:
+                latencias.extend(propias)
+                acreditado.append(total)
+
+    def plegador():
+        c = get_connection()
+        try:
+            while time.monotonic() < fin:
+                time.sleep(args.fold_interval)
+                fold(c)
+        finally:
+            c.close()
+
+    hilos = [threading.Thread(target=trabajador, args=(i,)) for i in range(args.threads)]
+    for h in hilos:
+        h.start()
+    if slots:
+        hilos.append(threading.Thread(target=plegador))
+        hilos[-1].start()
+    arranque.wait()
+    inicio = time.monotonic()
+    for h in hilos:
+        h.join()
+    duracion = time.monotonic() - inicio
+
+    saldo, libro = saldo_y_libro(cur, hot_user)
+    conn.rollback()
+    cur.close()
+    conn.close()
+    latencias.sort()
+    return {
+        'slots': slots,
+        'ops': len(latencias),
+        'ops_s': len(latencias) / duracion,
+        'p50_ms': statistics.median(latencias) * 1000 if latencias else 0.0,
+        'p99_ms': latencias[int(len(latencias) * 0.99)] * 1000 if latencias else 0.0,
+        'saldo': saldo,
+        'libro': libro,
+        'esperado': sum(acreditado),
+        'errores': errores,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=32, help='Créditos concurrentes')
+    parser.add_argument('--duration', type=float, default=10, help='Segundos medidos por modo')
+    parser.add_argument('--slots', type=int, default=16, help='Sub-saldos de la cuenta caliente')
+    parser.add_argument('--transfer-ratio', type=float, default=0.5, help='Fracción de transferencias (el resto son depósitos)')
+    parser.add_argument('--fold-interval', type=float, default=1.0, help='Segundos entre plegados')
+    args = parser.parse_args()
+
+    resultados = [correr(args, 0), correr(args, args.slots)]
+    print(f"{'sub-saldos':>10} {'ops':>8} {'ops/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for r in resultados:
+        print(f"{r['slots']:>10} {r['ops']:>8} {r['ops_s']:>10.0f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+    base, caliente = resultados
+    if base['ops_s']:
+        print(f"Mejora con {args.slots} sub-saldos: x{caliente['ops_s'] / base['ops_s']:.2f}")
+
+    fallos = []
+    for r in resultados:
+        if r['saldo'] != r['esperado']:
+            fallos.append(f"{r['slots']} sub-saldos: saldo {r['saldo']}, esperado {r['esperado']}")
+        if r['saldo'] != r['libro']:
+            fallos.append(f"{r['slots']} sub-saldos: saldo {r['saldo']}, libro {r['libro']}")
+        if r['errores']:
+            fallos.append(f"{r['slots']} sub-saldos: {len(r['errores'])} errores, p. ej. {r['errores'][0]}")
+    if fallos:
+        print("FALLO: " + "; ".join(fallos))
+        sys.exit(1)
+    print("OK")
+
+if __name__ == '__main__':
+    main()
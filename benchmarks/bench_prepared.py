@@ -0,0 +1,142 @@
+# benchmarks/bench_prepared.py
+"""
+Sentencias preparadas (app/db.py) contra cur.execute con el SQL completo en cada ejecución:
+mismas sentencias de app/queries.py y mismas conexiones del pool (TimedConnection), con la
+caché de sentencias preparadas desactivada o activada.
+
+Por sentencia reporta la latencia media y p99 vista por el cliente y, si PostgreSQL corre en
+esta máquina y /proc del backend es legible, el tiempo de CPU del proceso backend por
+ejecución (utime + stime). Los depósitos se revierten: la base no cambia salvo el cliente
+de prueba. "depósito tx" mide el depósito a mitad de una transacción abierta por la consulta
+de idempotencia, como en once() (app/idempotency.py).
+
+Uso (con POSTGRES_HOST/PORT/DB/USER/PASSWORD apuntando a la base migrada):
+    python -m benchmarks.bench_prepared [--iterations 5000] [--warmup 200]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+from decimal import Decimal
+
+from app.db import TimedConnection, get_connection, prepared_statement_stats
+from app.ledger import FIRST_PAGE
+from app.queries import BALANCE_SQL, DEPOSIT_SQL, IDEMPOTENCY_LOOKUP_SQL, LOGIN_SQL, TRANSACTIONS_PAGE_SQL
+
+def crear_cliente(cur, username):
+    cur.execute(
+        "INSERT INTO bank.users (username, password, role, full_name, email) VALUES (%s, %s, 'cliente', %s, %s) RETURNING id",
+        (username, b'-', username, f"{username}@bench.local")
+    )
+    user_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO bank.accounts (balance, user_id) VALUES (1000, %s) RETURNING id", (user_id,))
+    account_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO bank.credit_cards (limit_credit, balance, user_id) VALUES (500, 0, %s)", (user_id,))
+    cur.execute("""
+        INSERT INTO bank.transactions (user_id, instrument, kind, amount, balance_after)
+        SELECT %s, 'account', 'deposit', 1, 1000 FROM generate_series(1, 200)
+    """, (user_id,))
+    return user_id, account_id
+
+def cpu_backend(conn):
+    """Segundos de CPU consumidos por el backend de `conn`, o None si no se pueden leer."""
+    try:
+        with open(f"/proc/{conn.info.backend_pid}/stat") as f:
+            campos = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(campos[11]) + int(campos[12])) / os.sysconf('SC_CLK_TCK')
+
+def medir(conn, sql, params, args, commit, abrir=None):
+    """`abrir` = (sql, params) que se ejecuta sin medir antes de cada ejecución, en su misma transacción."""
+    cur = conn.cursor()
+    try:
+        for _ in range(args.warmup):
+            if abrir:
+                cur.execute(*abrir)
+                cur.fetchall()
+            cur.execute(sql, params)
+            cur.fetchall()
+            commit()
+        latencias = []
+        cpu_inicio = cpu_backend(conn)
+        for _ in range(args.iterations):
+            if abrir:
+                cur.execute(*abrir)
+                cur.fetchall()
+            inicio = time.perf_counter()
+            cur.execute(sql, params)
+            cur.fetchall()
+            latencias.append(time.perf_counter() - inicio)
+            commit()
+        cpu_fin = cpu_backend(conn)
+    finally:
+        cur.close()
+    latencias.sort()
+    cpu = (cpu_fin - cpu_inicio) / args.iterations if cpu_inicio is not None and cpu_fin is not None else None
+    return statistics.mean(latencias) * 1e6, latencias[int(len(latencias) * 0.99)] * 1e6, cpu
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=5000, help='Ejecuciones medidas por sentencia y modo')
+    parser.add_argument('--warmup', type=int, default=200, help='Ejecuciones previas sin medir')
+    args = parser.parse_args()
+
+    conn = get_connection()
+    cur = conn.cursor()
+    username = f"prep{uuid.uuid4().hex[:8]}"
+    user_id, account_id = crear_cliente(cur, username)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    deposito = {'account_id': account_id, 'amount': Decimal('1'), 'cajero_id': user_id}
+    idempotencia = (IDEMPOTENCY_LOOKUP_SQL, {'user_id': user_id, 'key': 'bench', 'ttl': 24})
+    casos = [
+        ('login', LOGIN_SQL, {'username': username}, False, None),
+        ('saldo', BALANCE_SQL, {'user_id': user_id}, False, None),
+        ('historial', TRANSACTIONS_PAGE_SQL,
+         {'user_id': user_id, 'before_created_at': FIRST_PAGE[0], 'before_id': FIRST_PAGE[1], 'limit': 50}, False, None),
+        ('depósito', DEPOSIT_SQL, deposito, True, None),
+        ('depósito tx', DEPOSIT_SQL, deposito, True, idempotencia),
+    ]
+    print(f"{'sentencia':<12} {'modo':<10} {'media µs':>9} {'p99 µs':>9} {'CPU µs':>8}")
+    fallos = []
+    for nombre, sql, params, revertir, abrir in casos:
+        resultados = {}
+        for preparada in (False, True):
+            conn = get_connection(TimedConnection)
+            conn.prepare_statements = preparada
+            # Lecturas en autocommit; el depósito se revierte tras cada ejecución
+            conn.autocommit = not revertir
+            commit = conn.rollback if revertir else (lambda: None)
+            try:
+                media, p99, cpu = medir(conn, sql, params, args, commit, abrir)
+            finally:
+                conn.close()
+            resultados[preparada] = (media, cpu)
+            modo = 'preparada' if preparada else 'execute'
+            cpu_texto = f"{cpu * 1e6:>8.1f}" if cpu is not None else f"{'-':>8}"
+            print(f"{nombre:<12} {modo:<10} {media:>9.1f} {p99:>9.1f} {cpu_texto}")
+        (media_plana, cpu_plana), (media_prep, cpu_prep) = resultados[False], resultados[True]
+        mejora = f"latencia x{media_plana / media_prep:.2f}"
+        if cpu_plana and cpu_prep:
+            mejora += f", CPU del servidor x{cpu_plana / cpu_prep:.2f}"
+        print(f"{'':<12} {mejora}")
+        if media_prep > media_plana * 1.1:
+            fallos.append(f"{nombre}: {media_prep:.1f} µs preparada contra {media_plana:.1f} µs")
+
+    stats = prepared_statement_stats()
+    print(f"PREPARE: {stats['prepares']}, ejecuciones preparadas: {stats['executions']}, "
+          f"fallos al preparar: {stats['prepare_failures']}")
+    if stats['prepare_failures']:
+        fallos.append(f"{stats['prepare_failures']} sentencias no se pudieron preparar")
+    if fallos:
+        print("FALLO: " + "; ".join(fallos))
+        sys.exit(1)
+    print("OK")
+
+if __name__ == '__main__':
+    main()
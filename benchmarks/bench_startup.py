@@ -0,0 +1,72 @@
+# benchmarks/bench_startup.py
+"""
+Tiempo de arranque en frío de un worker y latencia de sus primeras peticiones.
+
+Cada corrida ocurre en un proceso nuevo (como un worker recién creado al escalar) y mide:
+  - import: importar app.main y construir la aplicación con create_app(),
+  - warm: warm_worker() (solo en modo "warm", lo que hace gunicorn.conf.py en post_fork),
+  - primera y segunda petición: POST /auth/login con un usuario inexistente (consulta a la
+    base, sin bcrypt) y GET /ops/stats sin token (401).
+Se informa la mediana de las corridas para cada modo.
+
+Uso (con POSTGRES_HOST/PORT/DB/USER/PASSWORD apuntando a una base migrada):
+    python -m benchmarks.bench_startup [--runs 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+def child(mode):
+    """Se ejecuta en el proceso hijo: mide e imprime un JSON con los tiempos en ms."""
+    t0 = time.perf_counter()
+    from app.main import app, warm_worker
+    t_import = time.perf_counter() - t0
+
+    t_warm = warm_worker(app) if mode == 'warm' else 0.0
+
+    client = app.test_client()
+    def timed(method, url, **kwargs):
+        start = time.perf_counter()
+        getattr(client, method)(url, **kwargs)
+        return time.perf_counter() - start
+
+    login = {'json': {'username': 'bench_no_existe', 'password': 'x'}}
+    result = {
+        'import': t_import,
+        'warm': t_warm,
+        'first_login': timed('post', '/auth/login', **login),
+        'second_login': timed('post', '/auth/login', **login),
+        'first_stats': timed('get', '/ops/stats'),
+        'second_stats': timed('get', '/ops/stats'),
+    }
+    print(json.dumps({k: round(v * 1000, 3) for k, v in result.items()}))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--child', choices=('cold', 'warm'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    env = dict(os.environ)
+    env.setdefault('JWT_SECRET_KEY', 'bench-startup-' + 'x' * 32)
+    for mode in ('cold', 'warm'):
+        runs = []
+        for _ in range(args.runs):
+            out = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.bench_startup', '--child', mode],
+                env=env, capture_output=True, text=True, check=True
+            ).stdout
+            runs.append(json.loads(out.strip().splitlines()[-1]))
+        print(f"{mode} ({args.runs} corridas, mediana en ms):")
+        for key in runs[0]:
+            print(f"  {key:<14} {statistics.median(r[key] for r in runs):9.2f}")
+
+if __name__ == '__main__':
+    main()
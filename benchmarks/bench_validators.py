@@ -0,0 +1,97 @@
+# benchmarks/bench_validators.py
+"""
+Benchmark y verificación de equivalencia de los validadores por lote de app.validators.
+
+Primero compara validar_cedula_batch / validar_celular_batch contra las funciones
+escalares (la referencia) sobre entradas aleatorias que cubren los casos límite:
+longitudes incorrectas, no dígitos, dígitos Unicode, NUL finales y valores que no
+son str. Luego mide ambas versiones sobre N entradas realistas.
+
+Uso (desde la raíz del repositorio, requiere numpy):
+    python -m benchmarks.bench_validators [--n 1000000] [--fuzz 200000] [--seed 1]
+"""
+import argparse
+import random
+import time
+
+from app.validators import validar_cedula, validar_celular, validar_cedula_batch, validar_celular_batch
+
+# Caracteres con los que se construyen entradas adversas
+ALFABETO_RARO = '0123456789' * 4 + 'a -+.\x00' + '٣٤²０９'
+
+def cedula_valida(rnd):
+    provincia = rnd.randint(1, 24)
+    d = [provincia // 10, provincia % 10, rnd.randint(0, 5)] + [rnd.randint(0, 9) for _ in range(6)]
+    suma = sum((x * c - 9 if x * c >= 10 else x * c) for x, c in zip(d, (2, 1, 2, 1, 2, 1, 2, 1, 2)))
+    d.append((10 - suma % 10) % 10)
+    return ''.join(map(str, d))
+
+def entrada_realista(rnd, tipo):
+    """Mezcla típica de un archivo de socio: mayoría válidas, algunas con errores de digitación."""
+    r = rnd.random()
+    if tipo == 'cedula':
+        valor = cedula_valida(rnd)
+    else:
+        valor = '09' + ''.join(rnd.choice('0123456789') for _ in range(8))
+    if r < 0.1:
+        i = rnd.randrange(10)
+        valor = valor[:i] + rnd.choice('0123456789') + valor[i + 1:]
+    elif r < 0.13:
+        valor = valor[:9]
+    elif r < 0.15:
+        valor = valor + ' '
+    return valor
+
+def entrada_adversa(rnd):
+    r = rnd.random()
+    if r < 0.02:
+        return rnd.choice([None, 1712345678, b'1712345678', ''])
+    if r < 0.4:
+        return cedula_valida(rnd) if rnd.random() < 0.5 else '09' + ''.join(rnd.choice('0123456789') for _ in range(8))
+    longitud = rnd.choice([9, 10, 10, 10, 11, 12])
+    base = list(cedula_valida(rnd) + '00')[:longitud]
+    for _ in range(rnd.randint(1, 2)):
+        base[rnd.randrange(longitud)] = rnd.choice(ALFABETO_RARO)
+    return ''.join(base)
+
+def verificar(valores):
+    for escalar, lote in ((validar_cedula, validar_cedula_batch), (validar_celular, validar_celular_batch)):
+        esperado = []
+        for v in valores:
+            try:
+                esperado.append(escalar(v))
+            except ValueError:
+                esperado.append(False)
+        obtenido = lote(valores).tolist()
+        diferencias = [v for v, a, b in zip(valores, esperado, obtenido) if a != b]
+        assert not diferencias, f"{lote.__name__} difiere de {escalar.__name__} en {diferencias[:5]!r}"
+
+def medir(nombre, funcion, valores):
+    inicio = time.perf_counter()
+    resultado = funcion(valores)
+    duracion = time.perf_counter() - inicio
+    print(f"  {nombre:<24} {duracion * 1000:9.1f} ms  ({len(valores) / duracion / 1e6:6.2f} M/s)")
+    return duracion, resultado
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, default=1_000_000, help='Entradas para el benchmark')
+    parser.add_argument('--fuzz', type=int, default=200_000, help='Entradas aleatorias para la verificación')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+
+    verificar([entrada_adversa(rnd) for _ in range(args.fuzz)])
+    print(f"Equivalencia verificada sobre {args.fuzz} entradas aleatorias")
+
+    for tipo, escalar, lote in (('cedula', validar_cedula, validar_cedula_batch),
+                                ('celular', validar_celular, validar_celular_batch)):
+        valores = [entrada_realista(rnd, tipo) for _ in range(args.n)]
+        print(f"{tipo} ({args.n} entradas):")
+        t_escalar, esperado = medir('escalar', lambda vs: [escalar(v) for v in vs], valores)
+        t_lote, obtenido = medir('lote (numpy)', lote, valores)
+        assert obtenido.tolist() == esperado
+        print(f"  aceleración: {t_escalar / t_lote:.1f}x")
+
+if __name__ == '__main__':
+    main()
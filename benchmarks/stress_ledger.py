@@ -0,0 +1,173 @@
+# benchmarks/stress_ledger.py
+"""
+Prueba de concurrencia de las sentencias de app/queries.py contra una base real.
+
+Crea dos clientes temporales con cuenta y tarjeta, los fondea y lanza muchos hilos
+que retiran, transfieren en ambos sentidos, compran a crédito y abonan a la tarjeta
+desde la cuenta. Al final verifica que:
+  - ningún saldo quedó negativo y ninguna deuda supera el límite,
+  - el dinero se conserva (saldo final = inicial - retiros - abonos exitosos;
+    deuda final = compras - abonos exitosos),
+  - no hubo deadlocks ni errores de base de datos.
+Los clientes temporales y sus movimientos se borran al terminar, aun si falla.
+
+Uso (con POSTGRES_HOST/PORT/DB/USER/PASSWORD apuntando a la base):
+    python -m benchmarks.stress_ledger [--threads 32] [--ops 200]
+"""
+import argparse
+import random
+import sys
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from app.db import get_connection
+from app.queries import WITHDRAW_SQL, TRANSFER_SQL, CREDIT_PAYMENT_SQL, PAY_CREDIT_BALANCE_SQL
+
+def crear_cliente(cur, username, saldo, limite):
+    cur.execute(
+        "INSERT INTO bank.users (username, password, role, full_name, email) VALUES (%s, %s, 'cliente', %s, %s) RETURNING id",
+        (username, b'-', username, f"{username}@stress.local")
+    )
+    user_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO bank.accounts (balance, user_id) VALUES (%s, %s)", (saldo, user_id))
+    cur.execute("INSERT INTO bank.credit_cards (limit_credit, balance, user_id) VALUES (%s, 0, %s)", (limite, user_id))
+    return user_id
+
+def borrar_clientes(cur, ids):
+    cur.execute("DELETE FROM bank.transactions WHERE user_id = ANY(%s)", (ids,))
+    cur.execute("DELETE FROM bank.idempotency_keys WHERE user_id = ANY(%s)", (ids,))
+    cur.execute(
+        "DELETE FROM bank.account_slots WHERE account_id IN (SELECT id FROM bank.accounts WHERE user_id = ANY(%s))",
+        (ids,)
+    )
+    cur.execute("DELETE FROM bank.accounts WHERE user_id = ANY(%s)", (ids,))
+    cur.execute("DELETE FROM bank.credit_cards WHERE user_id = ANY(%s)", (ids,))
+    cur.execute("DELETE FROM bank.users WHERE id = ANY(%s)", (ids,))
+
+def saldos_finales(cur, ids):
+    cur.execute(
+        """
+        SELECT a.balance + (SELECT coalesce(sum(s.balance), 0) FROM bank.account_slots s WHERE s.account_id = a.id),
+               c.limit_credit, c.balance
+        FROM bank.accounts a JOIN bank.credit_cards c ON c.user_id = a.user_id
+        WHERE a.user_id = ANY(%s) ORDER BY a.user_id
+        """,
+        (ids,)
+    )
+    return cur.fetchall()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--ops', type=int, default=200, help='Operaciones por hilo')
+    parser.add_argument('--initial', type=Decimal, default=Decimal('100000'))
+    parser.add_argument('--limit', type=Decimal, default=Decimal('5000'), help='Límite de crédito de cada tarjeta')
+    args = parser.parse_args()
+
+    sufijo = uuid.uuid4().hex[:8]
+    usuarios = [f"stressa{sufijo}", f"stressb{sufijo}"]
+    conn = get_connection()
+    cur = conn.cursor()
+    ids = []
+    try:
+        for u in usuarios:
+            ids.append(crear_cliente(cur, u, args.initial, args.limit))
+        conn.commit()
+        fallos = estresar(args, usuarios, ids, cur)
+    finally:
+        conn.rollback()
+        if ids:
+            borrar_clientes(cur, ids)
+            conn.commit()
+        cur.close()
+        conn.close()
+    if fallos:
+        print("FALLO: " + "; ".join(fallos))
+        sys.exit(1)
+    print("OK")
+
+def estresar(args, usuarios, ids, cur):
+    """Lanza los hilos y devuelve la lista de invariantes violadas."""
+    # Por hilo: (retirado, comprado a crédito, abonado a tarjetas)
+    totales = []
+    errores = []
+    lock = threading.Lock()
+
+    def trabajador(semilla):
+        rnd = random.Random(semilla)
+        c = get_connection()
+        k = c.cursor()
+        retirado = comprado = abonado = Decimal('0')
+        try:
+            for _ in range(args.ops):
+                origen = rnd.randrange(2)
+                monto = Decimal(rnd.randint(1, 60))
+                operacion = rnd.randrange(4)
+                try:
+                    if operacion == 0:
+                        k.execute(WITHDRAW_SQL, {'user_id': ids[origen], 'amount': monto})
+                        _, nuevo = k.fetchone()
+                        if nuevo is not None:
+                            retirado += monto
+                    elif operacion == 1:
+                        k.execute(TRANSFER_SQL, {'sender_id': ids[origen], 'target_username': usuarios[1 - origen], 'amount': monto})
+                        k.fetchone()
+                    elif operacion == 2:
+                        k.execute(CREDIT_PAYMENT_SQL, {'user_id': ids[origen], 'amount': monto})
+                        _, _, deuda_nueva = k.fetchone()
+                        if deuda_nueva is not None:
+                            comprado += monto
+                    else:
+                        k.execute(PAY_CREDIT_BALANCE_SQL, {'user_id': ids[origen], 'amount': monto})
+                        saldo, _, saldo_nuevo, _ = k.fetchone()
+                        if saldo_nuevo is not None:
+                            # Se abona como máximo la deuda: lo abonado es lo que salió de la cuenta
+                            abonado += saldo - saldo_nuevo
+                    c.commit()
+                except Exception as e:
+                    c.rollback()
+                    with lock:
+                        errores.append(repr(e))
+        finally:
+            k.close()
+            c.close()
+            with lock:
+                totales.append((retirado, comprado, abonado))
+
+    inicio = time.monotonic()
+    hilos = [threading.Thread(target=trabajador, args=(i,)) for i in range(args.threads)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    duracion = time.monotonic() - inicio
+
+    filas = saldos_finales(cur, ids)
+    saldos = [saldo for saldo, _, _ in filas]
+    deudas = [deuda for _, _, deuda in filas]
+    retirado, comprado, abonado = (sum(t[i] for t in totales) for i in range(3))
+
+    operaciones = args.threads * args.ops
+    esperado = args.initial * 2 - retirado - abonado
+    deuda_esperada = comprado - abonado
+    print(f"{operaciones} operaciones en {duracion:.2f}s ({operaciones / duracion:.0f} ops/s)")
+    print(f"Saldos finales: {saldos} (suma {sum(saldos)}, esperada {esperado})")
+    print(f"Deudas finales: {deudas} (suma {sum(deudas)}, esperada {deuda_esperada})")
+
+    fallos = []
+    if any(s < 0 for s in saldos):
+        fallos.append("saldo negativo")
+    if any(d < 0 or d > limite for _, limite, d in filas):
+        fallos.append("deuda fuera de [0, límite]")
+    if sum(saldos) != esperado:
+        fallos.append("el dinero no se conserva")
+    if sum(deudas) != deuda_esperada:
+        fallos.append("la deuda no cuadra con compras y abonos")
+    if errores:
+        fallos.append(f"{len(errores)} errores de base de datos, p. ej. {errores[0]}")
+    return fallos
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+# gunicorn.conf.py
+# Configuración de gunicorn: la aplicación se carga una vez en el master (preload_app) y
+# los workers la heredan por copy-on-write. Pools de conexiones, escritor de logs y pool
+# de bcrypt son por proceso y se crean en cada worker después del fork. Cada worker atiende
+# GUNICORN_THREADS solicitudes a la vez (gthread); bcrypt admite a lo sumo BCRYPT_MAX_PENDING
+# de ellas, así una ráfaga de logins recibe 503 en vez de ocupar todos los hilos.
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', '4'))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+# Por defecto bcrypt usa la mitad de los hilos; los demás quedan para el resto de las rutas
+os.environ.setdefault('BCRYPT_MAX_PENDING', str(max(1, threads // 2)))
+preload_app = True
+
+def post_fork(server, worker):
+    """Prepara el worker (conexiones, hilos, inicialización de Flask) antes de aceptar tráfico."""
+    from app.main import app, warm_worker
+    elapsed = warm_worker(app)
+    server.log.info("Worker %s listo en %.1f ms", worker.pid, elapsed * 1000)
+
+def on_starting(server):
+    """Descarta las métricas de ejecuciones anteriores (METRICS_DIR) antes de crear los workers."""
+    from app.metrics import reset
+    reset()
+    if int(os.environ['BCRYPT_MAX_PENDING']) >= threads:
+        server.log.warning("BCRYPT_MAX_PENDING (%s) >= GUNICORN_THREADS (%s): una ráfaga de logins "
+                           "puede ocupar todos los hilos de un worker", os.environ['BCRYPT_MAX_PENDING'], threads)